@@ -18,12 +18,17 @@ Tests various functions for the Google Ads Links cloud function.
 """
 
 import base64
+import io
 import json
 import unittest
 from absl.testing import absltest
 from absl.testing import parameterized
 import ads_links
 from cloudevents.http import CloudEvent
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+from shared import credential_profiles
+from shared import link_handler
+from shared import rate_limiter
 
 
 class GoogleAdsLinksTest(parameterized.TestCase):
@@ -47,6 +52,13 @@ class GoogleAdsLinksTest(parameterized.TestCase):
         'property_id': '1234567',
         'name': 'properties/1234567/adsLinks/abcdefg',
     }
+    link_handler.ga_clients.clear()
+    link_handler.breakers.clear()
+    for index in link_handler.indexes.values():
+      index.clear()
+    self.enter_context(unittest.mock.patch.object(
+        link_handler, 'limiter',
+        rate_limiter.AdaptiveRateLimiter(rate=1000, max_rate=1000)))
 
   def test_main_missing_data_raises_error(self):
     missing_data = CloudEvent(self.attributes, {'message': {}})
@@ -62,16 +74,18 @@ class GoogleAdsLinksTest(parameterized.TestCase):
     error_message = 'Missing keys: client_id,action'
     self.assertEqual(error_message, ads_links.main(missing_keys))
 
-  @unittest.mock.patch('ads_links.AnalyticsAdminServiceClient')
+  @unittest.mock.patch('shared.link_handler.AnalyticsAdminServiceClient')
   def test_get_ga_client_creates_admin_client(self, mock_analytics_client):
-    ads_links.get_ga_client(
-        self.data['refresh_token'],
-        self.data['token_uri'],
-        self.data['client_id'],
-        self.data['client_secret'],
-        self.data['scopes'])
+    link_handler.get_ga_client(self.data)
     mock_analytics_client.assert_called()
 
+  @unittest.mock.patch('shared.link_handler.AnalyticsAdminServiceClient')
+  def test_get_ga_client_reuses_admin_client(self, mock_analytics_client):
+    self.assertIs(
+        link_handler.get_ga_client(self.data),
+        link_handler.get_ga_client(dict(self.data)))
+    mock_analytics_client.assert_called_once()
+
   @parameterized.named_parameters(
       dict(testcase_name='test_main_calls_create_google_ads_link',
            action='create',
@@ -85,7 +99,7 @@ class GoogleAdsLinksTest(parameterized.TestCase):
       dict(testcase_name='test_main_calls_list_google_ads_links',
            action='list',
            result='listed'))
-  @unittest.mock.patch('ads_links.get_ga_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
   def test_main_calling_google_ads_link_methods(
       self, mock_ga_client, action, result):
     self.data['action'] = action
@@ -102,6 +116,132 @@ class GoogleAdsLinksTest(parameterized.TestCase):
       mock_ga_client().list_google_ads_links.return_value = result
     self.assertEqual(result, ads_links.main(cloud_event))
 
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_creates_google_ads_link(self, mock_ga_client):
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().list_google_ads_links.return_value = []
+    mock_ga_client().create_google_ads_link.return_value = 'created'
+    self.assertEqual('created', ads_links.main(cloud_event))
+    mock_ga_client().create_google_ads_link.assert_called_once_with(
+        parent='properties/1234567',
+        google_ads_link=GoogleAdsLink(
+            customer_id='123', ads_personalization_enabled=True))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_skips_creating_existing_link(self, mock_ga_client):
+    existing_link = GoogleAdsLink(
+        name='properties/1234567/googleAdsLinks/abcdefg',
+        customer_id='123',
+        ads_personalization_enabled=True)
+    mock_ga_client().list_google_ads_links.return_value = [existing_link]
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual(existing_link, ads_links.main(cloud_event))
+    self.assertEqual(existing_link, ads_links.main(cloud_event))
+    mock_ga_client().create_google_ads_link.assert_not_called()
+    mock_ga_client().list_google_ads_links.assert_called_once()
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_updates_existing_link_with_changed_settings(
+      self, mock_ga_client):
+    mock_ga_client().list_google_ads_links.return_value = [GoogleAdsLink(
+        name='properties/1234567/googleAdsLinks/abcdefg',
+        customer_id='123',
+        ads_personalization_enabled=False)]
+    mock_ga_client().update_google_ads_link.return_value = 'updated'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual('updated', ads_links.main(cloud_event))
+    mock_ga_client().update_google_ads_link.assert_called_once_with(
+        google_ads_link=GoogleAdsLink(
+            name='properties/1234567/googleAdsLinks/abcdefg',
+            ads_personalization_enabled=True),
+        update_mask='ads_personalization_enabled')
+    mock_ga_client().create_google_ads_link.assert_not_called()
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_runs_each_operation_in_batch(self, mock_ga_client):
+    operations = [
+        {'action': 'create', 'customer_id': '1'},
+        {'action': 'delete', 'name': 'properties/1234567/googleAdsLinks/1'},
+        {'action': 'create', 'customer_id': '2'},
+    ]
+    del self.data['action']
+    self.data['operations'] = operations
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().create_google_ads_link.side_effect = [
+        'created', Exception('already exists')]
+    mock_ga_client().delete_google_ads_link.return_value = 'deleted'
+    self.assertEqual(
+        [{'index': 0, 'action': 'create', 'response': 'created'},
+         {'index': 1, 'action': 'delete', 'response': 'deleted'},
+         {'index': 2, 'action': 'create', 'error': 'already exists',
+          'error_class': 'unknown', 'retry_after': ''}],
+        ads_links.main(cloud_event))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_resolves_credential_profile(self, mock_ga_client):
+    credentials = {
+        key: self.data.pop(key)
+        for key in ('client_id', 'client_secret', 'refresh_token',
+                    'token_uri', 'scopes')}
+    self.data['credential_profile'] = 'agency'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().create_google_ads_link.return_value = 'created'
+    profiles = credential_profiles.CredentialProfiles(
+        project_id='project',
+        fetch_secret=lambda name: json.dumps(credentials))
+    with unittest.mock.patch.object(link_handler, 'profiles', profiles):
+      self.assertEqual('created', ads_links.main(cloud_event))
+    self.assertEqual(
+        credentials,
+        {key: mock_ga_client.call_args.args[0][key] for key in credentials})
+
+  @unittest.mock.patch('shared.link_handler.get_storage_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_lists_many_properties_into_export(
+      self, mock_ga_client, mock_storage_client):
+    del self.data['property_id']
+    self.data['action'] = 'list'
+    self.data['property_ids'] = ['1', '2']
+    self.data['export_uri'] = 'gs://exports/links.ndjson'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    page = unittest.mock.Mock(next_page_token='')
+
+    def list_links(request):
+      page.google_ads_links = [GoogleAdsLink(
+          name=f"{request['parent']}/googleAdsLinks/a", customer_id='123')]
+      return unittest.mock.Mock(pages=iter([page]))
+
+    mock_ga_client().list_google_ads_links.side_effect = list_links
+    mock_ga_client().list_google_ads_links.__name__ = 'list_google_ads_links'
+    mock_storage_client().bucket().blob().open.return_value = io.BytesIO()
+    summary = ads_links.main(cloud_event)
+    self.assertEqual(
+        {'properties': 2, 'links': 2, 'failed_properties': {},
+         'export_uri': 'gs://exports/links.ndjson'},
+        summary)
+    mock_storage_client().bucket.assert_called_with('exports')
+    mock_storage_client().bucket().blob.assert_called_with('links.ndjson')
+
+  def test_main_bulk_list_without_export_uri_returns_error(self):
+    self.data['action'] = 'list'
+    self.data['account_id'] = '99'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual('Missing keys: export_uri', ads_links.main(cloud_event))
+
 
 if __name__ == '__main__':
   absltest.main()
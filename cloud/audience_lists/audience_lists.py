@@ -0,0 +1,358 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Creates audience lists for many properties and exports their rows.
+
+The Cloud Storage version of the audience list export in
+new_analytics/audienceLists.js. A pub/sub message lists the audience lists:
+
+    {"audience_lists": [
+        {"property_id": "123", "audience": "properties/123/audiences/4",
+         "dimensions": ["deviceId"]},
+        {"audience_list": "properties/123/audienceLists/5"}],
+     "format": "csv"}
+
+Audience lists without a name are created first. The state of every list is
+then checked from a pool of worker threads, waiting twice as long between
+checks of the same list each time, until it is active, failed or the
+AUDIENCE_LIST_TIMEOUT has passed. Each active list is exported while the
+others are still being checked.
+
+The rows of a list are queried a page at a time and each page is streamed to
+gs://OUTPUT_BUCKET/audience_lists/<property ID>/<list ID>.<format>, so memory
+only holds one page per export. There is a string column for each dimension
+of the list, and the BigQuery schema of those columns is written next to the
+export as <list ID>.schema.json.
+"""
+
+import base64
+from collections.abc import Callable, Iterable, Iterator, Mapping
+import concurrent.futures
+import contextvars
+import heapq
+import json
+import os
+import time
+from typing import Any
+
+from cloudevents.http import CloudEvent
+import functions_framework
+import google.auth.transport.requests
+import google.oauth2.credentials
+from google.analytics.data_v1alpha import AlphaAnalyticsDataClient
+from google.analytics.data_v1alpha import AudienceDimension
+from google.analytics.data_v1alpha import AudienceList
+from google.cloud import storage
+
+from shared import errors
+from shared import metrics
+from shared import rate_limiter
+from shared import results_writer
+
+OUTPUT_BUCKET = os.environ.get('OUTPUT_BUCKET')
+CLIENT_ID = os.environ.get('CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
+REFRESH_TOKEN = os.environ.get('REFRESH_TOKEN')
+TOKEN_URI = os.environ.get('TOKEN_URI')
+# The format of the exports: csv or ndjson.
+EXPORT_FORMAT = os.environ.get('AUDIENCE_LIST_FORMAT', 'csv')
+# Number of requests sent and exports written at the same time.
+MAX_WORKERS = int(os.environ.get('AUDIENCE_LIST_WORKERS', 8))
+# Number of rows queried per page, at most 250000.
+PAGE_ROWS = int(os.environ.get('AUDIENCE_LIST_PAGE_ROWS', 100000))
+# The delay before the first check of a new list, which doubles for each
+# later check up to the longest delay.
+POLL_DELAY = float(os.environ.get('AUDIENCE_LIST_POLL_DELAY', 10))
+MAX_POLL_DELAY = float(os.environ.get('AUDIENCE_LIST_MAX_POLL_DELAY', 120))
+# Lists that are not active after this many seconds are not exported.
+TIMEOUT = float(os.environ.get('AUDIENCE_LIST_TIMEOUT', 3000))
+
+PREFIX = 'audience_lists/'
+AUDIENCE_LISTS_KEY = 'audience_lists'
+FORMAT_KEY = 'format'
+
+storage_client = storage.Client()
+limiter = rate_limiter.AdaptiveRateLimiter.from_env()
+
+
+@functions_framework.cloud_event
+@metrics.instrumented('audience_lists')
+def main(cloud_event: CloudEvent) -> list[dict[str, Any]]:
+  """Creates and exports the audience lists of a pub/sub message.
+
+  Args:
+      cloud_event: The cloud event with the pub/sub message.
+
+  Returns:
+      The outcome of each audience list.
+  """
+  message = cloud_event.data['message']
+  data = json.loads(base64.b64decode(message['data']).decode())
+  outcomes = export_audience_lists(
+      get_data_client(),
+      data[AUDIENCE_LISTS_KEY],
+      storage_client.bucket(OUTPUT_BUCKET),
+      data.get(FORMAT_KEY, EXPORT_FORMAT))
+  for outcome in outcomes:
+    print(json.dumps(outcome))
+  return outcomes
+
+
+def export_audience_lists(
+    data_client: Any,
+    requests: Iterable[Mapping[str, Any]],
+    bucket: storage.Bucket,
+    file_format: str = 'csv',
+    max_workers: int = MAX_WORKERS,
+    clock: Callable[[], float] = time.monotonic,
+    sleep: Callable[[float], None] = time.sleep,
+) -> list[dict[str, Any]]:
+  """Creates audience lists, waits for them and exports their rows.
+
+  Args:
+      data_client: The Data API client shared by every worker.
+      requests: Each has either the name of an existing audience list, or
+        the property ID, the audience and the dimensions of a new one.
+      bucket: The bucket the exports are written to.
+      file_format: One of results_writer.FORMATS.
+      max_workers: The number of requests sent and exports written at the
+        same time.
+      clock: Returns the current time in seconds.
+      sleep: Sleeps for a number of seconds.
+
+  Returns:
+      The outcome of each request, in order: the name of the audience list,
+      its state, and the URI and number of rows of the export, or the error.
+  """
+  requests = list(requests)
+  outcomes = [
+      {
+          'property_id': str(request.get('property_id', '')),
+          'audience': request.get('audience', ''),
+          'audience_list': request.get('audience_list', ''),
+      }
+      for request in requests]
+  deadline = clock() + TIMEOUT
+  # The lists to check, as the time of the check, the index of the request
+  # and the delay before the next check.
+  polls = []
+  exports = {}
+
+  def fail(index, error):
+    outcomes[index]['state'] = 'FAILED'
+    if isinstance(error, Exception):
+      outcomes[index][errors.ERROR_CLASS_KEY] = errors.classify(error).value
+    outcomes[index][errors.ERROR_KEY] = str(error)
+
+  def submit(executor, func, *args):
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+  with (
+      concurrent.futures.ThreadPoolExecutor(
+          max_workers=max_workers) as executor,
+      # Exports run in their own pool, so that checks do not wait for them.
+      concurrent.futures.ThreadPoolExecutor(
+          max_workers=max_workers) as export_executor,
+  ):
+    created = {
+        submit(executor, create_audience_list, data_client, request): index
+        for index, request in enumerate(requests)
+        if not request.get('audience_list')}
+    for index, outcome in enumerate(outcomes):
+      if outcome['audience_list']:
+        heapq.heappush(polls, (clock(), index, POLL_DELAY))
+    for future in concurrent.futures.as_completed(created):
+      index = created[future]
+      try:
+        outcomes[index]['audience_list'] = future.result()
+      except Exception as e:
+        fail(index, e)
+        continue
+      # A new list is never ready straight away.
+      heapq.heappush(polls, (clock() + POLL_DELAY, index, POLL_DELAY))
+
+    while polls:
+      sleep(max(polls[0][0] - clock(), 0))
+      checks = {}
+      while polls and polls[0][0] <= clock():
+        _, index, delay = heapq.heappop(polls)
+        future = submit(
+            executor, get_audience_list, data_client,
+            outcomes[index]['audience_list'])
+        checks[future] = (index, delay)
+      for future in concurrent.futures.as_completed(checks):
+        index, delay = checks[future]
+        try:
+          audience_list = future.result()
+        except Exception as e:
+          fail(index, e)
+          continue
+        state = AudienceList.State(audience_list.state).name
+        outcomes[index]['state'] = state
+        if state == 'ACTIVE':
+          future = submit(
+              export_executor, export_rows, data_client, audience_list,
+              bucket, file_format)
+          exports[future] = index
+        elif state == 'FAILED':
+          fail(index, audience_list.error_message or 'Audience list failed')
+        elif clock() + delay > deadline:
+          fail(index, f'Audience list was still {state} after {TIMEOUT}s')
+        else:
+          heapq.heappush(
+              polls,
+              (clock() + delay, index, min(delay * 2, MAX_POLL_DELAY)))
+
+    for future in concurrent.futures.as_completed(exports):
+      index = exports[future]
+      try:
+        outcomes[index].update(future.result())
+      except Exception as e:
+        fail(index, e)
+  return outcomes
+
+
+def create_audience_list(data_client: Any, request: Mapping[str, Any]) -> str:
+  """Creates an audience list and returns its name.
+
+  Args:
+      data_client: The Data API client.
+      request: The property ID, the audience and the dimensions, either as a
+        list or as a comma separated string.
+
+  Returns:
+      The name of the audience list, which is still being created.
+
+  Raises:
+      ValueError: If the request is missing a field.
+  """
+  missing = [
+      field for field in ('property_id', 'audience', 'dimensions')
+      if not request.get(field)]
+  if missing:
+    raise ValueError(f"Audience list request is missing {','.join(missing)}")
+  dimensions = request['dimensions']
+  if isinstance(dimensions, str):
+    dimensions = dimensions.split(',')
+  audience = str(request['audience'])
+  if '/' not in audience:
+    audience = f"properties/{request['property_id']}/audiences/{audience}"
+  operation = rate_limiter.call_with_retry(
+      limiter,
+      data_client.create_audience_list,
+      parent=f"properties/{request['property_id']}",
+      audience_list=AudienceList(
+          audience=audience,
+          dimensions=[
+              AudienceDimension(dimension_name=dimension.strip())
+              for dimension in dimensions]))
+  # The operation holds the new list as soon as it is created, in the
+  # CREATING state.
+  return AudienceList.deserialize(operation.operation.response.value).name
+
+
+def get_audience_list(data_client: Any, name: str) -> Any:
+  """Returns an audience list, with its state."""
+  return rate_limiter.call_with_retry(
+      limiter, data_client.get_audience_list, name=name)
+
+
+def export_rows(
+    data_client: Any,
+    audience_list: Any,
+    bucket: storage.Bucket,
+    file_format: str = 'csv',
+) -> dict[str, Any]:
+  """Streams the rows of an active audience list to Cloud Storage.
+
+  Args:
+      data_client: The Data API client.
+      audience_list: The audience list.
+      bucket: The bucket the export and its schema are written to.
+      file_format: One of results_writer.FORMATS.
+
+  Returns:
+      The URI of the export and its number of rows.
+  """
+  _, property_id, _, list_id = audience_list.name.split('/')
+  extension, _ = results_writer.FORMATS[file_format]
+  name = f'{PREFIX}{property_id}/{list_id}'
+  bucket.blob(f'{name}.schema.json').upload_from_string(
+      json.dumps(schema_fields(audience_list)),
+      content_type='application/json')
+  with results_writer.ExportWriter(
+      bucket.blob(f'{name}.{extension}').open('wb'), file_format) as writer:
+    for record in query_rows(data_client, audience_list):
+      writer.write(record)
+  return {
+      'export_uri': f'gs://{bucket.name}/{name}.{extension}',
+      'rows': writer.count,
+  }
+
+
+def query_rows(
+    data_client: Any,
+    audience_list: Any,
+    page_rows: int | None = None,
+) -> Iterator[dict[str, str]]:
+  """Yields the rows of an audience list, querying one page at a time.
+
+  Args:
+      data_client: The Data API client.
+      audience_list: The audience list.
+      page_rows: The number of rows queried per page. Defaults to PAGE_ROWS.
+
+  Yields:
+      The dimension values of each row, keyed by dimension name.
+  """
+  names = [field['name'] for field in schema_fields(audience_list)]
+  offset = 0
+  while True:
+    response = rate_limiter.call_with_retry(
+        limiter,
+        data_client.query_audience_list,
+        request={
+            'name': audience_list.name,
+            'offset': offset,
+            'limit': page_rows or PAGE_ROWS,
+        })
+    for row in response.audience_rows:
+      yield dict(zip(names, (value.value for value in row.dimension_values)))
+    offset += len(response.audience_rows)
+    if not response.audience_rows or offset >= response.row_count:
+      return
+
+
+def schema_fields(audience_list: Any) -> list[dict[str, str]]:
+  """Returns the BigQuery schema of the rows of an audience list.
+
+  Like constructTableSchemaFields in new_analytics/audienceLists.js, each
+  dimension is a string field.
+  """
+  return [
+      {'name': dimension.dimension_name, 'type': 'STRING'}
+      for dimension in audience_list.dimensions]
+
+
+def get_data_client(
+    client_class: Callable[..., Any] = AlphaAnalyticsDataClient) -> Any:
+  credentials = google.oauth2.credentials.Credentials(
+      None,
+      refresh_token=REFRESH_TOKEN,
+      token_uri=TOKEN_URI,
+      client_id=CLIENT_ID,
+      client_secret=CLIENT_SECRET)
+  with metrics.span('token_refresh'):
+    credentials.refresh(google.auth.transport.requests.Request())
+  return client_class(credentials=credentials)
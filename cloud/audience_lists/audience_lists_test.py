@@ -0,0 +1,171 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the audience list export."""
+
+import json
+import threading
+import types
+from unittest import mock
+
+from absl.testing import absltest
+from google.analytics.data_v1alpha import AudienceDimension
+from google.analytics.data_v1alpha import AudienceList
+from google.analytics.data_v1alpha import AudienceRow
+from google.analytics.data_v1alpha import QueryAudienceListResponse
+from google.api_core import exceptions
+from google.longrunning import operations_pb2
+from google.protobuf import any_pb2
+
+from shared import testing
+
+with mock.patch('google.cloud.storage.Client'):
+  import audience_lists
+
+State = AudienceList.State
+
+
+class FakeDataClient:
+  """Serves audience lists whose state moves through a list of states."""
+
+  def __init__(self, states, rows):
+    self._states = states
+    self._rows = rows
+    self._lock = threading.Lock()
+    self.created = []
+    self.gets = []
+    self.queries = []
+
+  def create_audience_list(self, parent, audience_list):
+    with self._lock:
+      self.created.append((parent, audience_list))
+      name = f'{parent}/audienceLists/{len(self.created)}'
+    response = any_pb2.Any()
+    response.Pack(AudienceList.pb(AudienceList(
+        name=name, dimensions=audience_list.dimensions,
+        state=State.CREATING)))
+    return types.SimpleNamespace(
+        operation=operations_pb2.Operation(response=response))
+
+  def get_audience_list(self, name):
+    with self._lock:
+      self.gets.append(name)
+      state = self._states[name].pop(0)
+    if isinstance(state, Exception):
+      raise state
+    return AudienceList(
+        name=name,
+        state=state,
+        dimensions=[
+            AudienceDimension(dimension_name=dimension)
+            for dimension in ('deviceId', 'isAdsPersonalizationAllowed')],
+        error_message='quota' if state == State.FAILED else '')
+
+  def query_audience_list(self, request):
+    with self._lock:
+      self.queries.append((request['offset'], request['limit']))
+    rows = self._rows[request['offset']:request['offset'] + request['limit']]
+    return QueryAudienceListResponse(
+        row_count=len(self._rows),
+        audience_rows=[
+            AudienceRow(dimension_values=[{'value': value} for value in row])
+            for row in rows])
+
+
+class AudienceListsTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(mock.patch.object(
+        audience_lists, 'limiter',
+        audience_lists.rate_limiter.AdaptiveRateLimiter(
+            rate=1000, max_rate=1000)))
+    self.enter_context(mock.patch.object(audience_lists, 'PAGE_ROWS', 2))
+    self.enter_context(mock.patch.object(audience_lists, 'POLL_DELAY', 10))
+    self.enter_context(
+        mock.patch.object(audience_lists, 'MAX_POLL_DELAY', 20))
+    self.enter_context(mock.patch.object(audience_lists, 'TIMEOUT', 100))
+    self.bucket = testing.FakeBucket(name='exports')
+    self.clock = testing.FakeClock()
+
+  def export(self, data_client, requests, file_format='csv'):
+    return audience_lists.export_audience_lists(
+        data_client, requests, self.bucket, file_format, max_workers=4,
+        clock=self.clock, sleep=self.clock.sleep)
+
+  def test_creates_polls_and_streams_pages(self):
+    data_client = FakeDataClient(
+        {
+            'properties/1/audienceLists/1': [
+                State.CREATING, State.CREATING, State.ACTIVE],
+            'properties/1/audienceLists/5': [State.ACTIVE],
+        },
+        [['a', 'true'], ['b', 'false'], ['c', 'true']])
+    outcomes = self.export(data_client, [
+        {'property_id': 1, 'audience': '4',
+         'dimensions': 'deviceId, isAdsPersonalizationAllowed'},
+        {'audience_list': 'properties/1/audienceLists/5'},
+    ])
+    self.assertEqual({
+        'property_id': '1',
+        'audience': '4',
+        'audience_list': 'properties/1/audienceLists/1',
+        'state': 'ACTIVE',
+        'export_uri': 'gs://exports/audience_lists/1/1.csv',
+        'rows': 3,
+    }, outcomes[0])
+    self.assertEqual('ACTIVE', outcomes[1]['state'])
+    parent, audience_list = data_client.created[0]
+    self.assertEqual('properties/1', parent)
+    self.assertEqual('properties/1/audiences/4', audience_list.audience)
+    self.assertEqual(
+        ['deviceId', 'isAdsPersonalizationAllowed'],
+        [d.dimension_name for d in audience_list.dimensions])
+    self.assertEqual(
+        'deviceId,isAdsPersonalizationAllowed\r\na,true\r\nb,false\r\n'
+        'c,true\r\n',
+        self.bucket.text('audience_lists/1/1.csv'))
+    self.assertEqual(
+        [{'name': 'deviceId', 'type': 'STRING'},
+         {'name': 'isAdsPersonalizationAllowed', 'type': 'STRING'}],
+        json.loads(self.bucket.objects['audience_lists/1/1.schema.json']))
+    # The rows of both lists are queried a page at a time.
+    self.assertCountEqual([(0, 2), (2, 2)] * 2, data_client.queries)
+    # The new list is checked after 10, 20 and 40 seconds.
+    self.assertEqual(40, self.clock.now)
+
+  def test_failed_and_slow_lists_are_not_exported(self):
+    data_client = FakeDataClient(
+        {
+            'properties/1/audienceLists/1': [State.FAILED],
+            'properties/1/audienceLists/2': [State.CREATING] * 20,
+            'properties/1/audienceLists/3': [
+                exceptions.PermissionDenied('no access')],
+        },
+        [])
+    outcomes = self.export(data_client, [
+        {'audience_list': f'properties/1/audienceLists/{index}'}
+        for index in range(1, 4)] + [{'property_id': '1'}])
+    self.assertEqual(
+        ['FAILED'] * 4, [outcome['state'] for outcome in outcomes])
+    self.assertEqual('quota', outcomes[0]['error'])
+    self.assertIn('still CREATING', outcomes[1]['error'])
+    self.assertEqual('permission', outcomes[2]['error_class'])
+    self.assertEqual('invalid_argument', outcomes[3]['error_class'])
+    self.assertEmpty(data_client.queries)
+    self.assertEmpty(self.bucket.objects)
+
+
+if __name__ == '__main__':
+  absltest.main()
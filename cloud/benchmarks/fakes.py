@@ -0,0 +1,291 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-ins for the Admin API, Cloud Storage and Pub/Sub.
+
+The fakes keep their state in memory and count every call, so the benchmarks
+can report how many requests each function sends. The Admin API fake adds
+latency, random errors and a requests per second quota so that retries and
+rate limiting are exercised the way they are against the real API. The
+Cloud Storage fake is the one the tests use, from shared.testing.
+"""
+
+import asyncio
+import collections
+from collections.abc import Callable, Iterator
+from concurrent import futures
+import random
+import threading
+import time
+from typing import Any
+
+from google.analytics.admin import AnalyticsAdminServiceClient
+from google.api_core import exceptions
+
+from shared import testing
+
+FakeStorageClient = testing.FakeStorageClient
+FakeBucket = testing.FakeBucket
+FakeBlob = testing.FakeBlob
+
+_ACTIONS = ('list_', 'get_', 'create_', 'update_', 'delete_')
+
+
+class FakeAdminApi:
+  """A fake of the synchronous Admin API client for link resources.
+
+  Any list, get, create, update or delete method of the real client is
+  accepted and applied to an in-memory store, keyed by the resource type in
+  the method name. Methods that do not exist on the real client raise
+  AttributeError, just like the real client.
+  """
+
+  def __init__(
+      self,
+      latency: float = 0.0,
+      error_rate: float = 0.0,
+      quota: float | None = None,
+      seed: int = 0,
+      clock: Callable[[], float] = time.monotonic,
+      sleep: Callable[[float], None] = time.sleep,
+  ) -> None:
+    """Initializes the fake.
+
+    Args:
+        latency: The average number of seconds each request takes.
+        error_rate: The fraction of requests that fail with UNAVAILABLE.
+        quota: The number of requests accepted per second. Further requests
+          in the same second fail with RESOURCE_EXHAUSTED. None disables the
+          quota.
+        seed: Makes the latency and errors repeatable.
+        clock: Returns the current time in seconds.
+        sleep: Blocks for the given number of seconds.
+    """
+    self.latency = latency
+    self.error_rate = error_rate
+    self.quota = quota
+    self.calls = collections.Counter()
+    self.errors = collections.Counter()
+    self._random = random.Random(seed)
+    self._clock = clock
+    self._sleep = sleep
+    self._lock = threading.Lock()
+    self._window = (0, 0)
+    self._next_id = 0
+    # Links keyed by resource type, then by parent, then by name.
+    self._resources = collections.defaultdict(
+        lambda: collections.defaultdict(dict))
+
+  def __getattr__(self, method: str) -> Callable[..., Any]:
+    if not method.startswith(_ACTIONS) or not hasattr(
+        AnalyticsAdminServiceClient, method):
+      raise AttributeError(method)
+
+    def call(**kwargs):
+      self._sleep(self.delay())
+      return self.request(method, kwargs)
+
+    call.__name__ = method
+    return call
+
+  def delay(self) -> float:
+    """Returns a random latency for one request."""
+    with self._lock:
+      return self.latency * self._random.uniform(0.5, 1.5)
+
+  def request(self, method: str, kwargs: dict[str, Any]) -> Any:
+    """Counts a request and applies it once the latency has passed.
+
+    Args:
+        method: The name of the client method.
+        kwargs: The keyword arguments of the request.
+
+    Returns:
+        The response of the request.
+    """
+    with self._lock:
+      self.calls[method] += 1
+      if self.quota is not None:
+        second = int(self._clock())
+        window, count = self._window
+        count = count + 1 if window == second else 1
+        self._window = (second, count)
+        if count > self.quota:
+          self.errors['RESOURCE_EXHAUSTED'] += 1
+          raise exceptions.ResourceExhausted(
+              'Exhausted property requests per second quota.')
+      if self._random.random() < self.error_rate:
+        self.errors['UNAVAILABLE'] += 1
+        raise exceptions.ServiceUnavailable('The service is unavailable.')
+      # Requests may be passed as a request mapping or as keyword arguments.
+      kwargs = dict(kwargs.pop('request', None) or {}, **kwargs)
+      action, resource = method.split('_', 1)
+      if action == 'list':
+        # list_google_ads_links lists google_ads_link resources.
+        links = list(self._resources[resource[:-1]][kwargs['parent']].values())
+        return _FakePager(
+            links, kwargs.get('page_size'), kwargs.get('page_token'))
+      if action == 'create':
+        parent = kwargs.pop('parent')
+        (message,) = kwargs.values()
+        self._next_id += 1
+        created = type(message)(mapping=message)
+        created.name = f'{parent}/{_collection(resource)}/{self._next_id}'
+        self._resources[resource][parent][created.name] = created
+        return created
+      if action == 'update':
+        mask = kwargs.pop('update_mask', None) or '*'
+        (message,) = kwargs.values()
+        existing = self._find(resource, message.name)
+        paths = mask.split(',') if isinstance(mask, str) else mask.paths
+        if '*' in paths:
+          paths = [
+              field for field in type(message).to_dict(message)
+              if field != 'name']
+        for path in paths:
+          setattr(existing, path, getattr(message, path))
+        return existing
+      existing = self._find(resource, kwargs['name'])
+      if action == 'delete':
+        parent = existing.name.rsplit('/', 2)[0]
+        del self._resources[resource][parent][existing.name]
+        return None
+      return existing
+
+  def _find(self, resource: str, name: str) -> Any:
+    parent = name.rsplit('/', 2)[0]
+    existing = self._resources[resource][parent].get(name)
+    if existing is None:
+      self.errors['NOT_FOUND'] += 1
+      raise exceptions.NotFound(f'{name} not found.')
+    return existing
+
+
+class FakeAsyncAdminApi:
+  """A fake of the async Admin API client that shares a FakeAdminApi.
+
+  Requests wait for their latency on the event loop, and list methods return
+  async iterables like the pagers of the real async client.
+  """
+
+  def __init__(self, api: FakeAdminApi) -> None:
+    self._api = api
+    self.transport = _FakeTransport()
+
+  def __getattr__(self, method: str) -> Callable[..., Any]:
+    getattr(self._api, method)
+
+    async def call(**kwargs):
+      await asyncio.sleep(self._api.delay())
+      response = self._api.request(method, kwargs)
+      if method.startswith('list_'):
+        return _FakeAsyncPager(response)
+      return response
+
+    call.__name__ = method
+    return call
+
+
+class _FakePager(list):
+  """The first page of a list response, iterable like the real pagers."""
+
+  def __init__(
+      self,
+      items: list[Any],
+      page_size: int | None = None,
+      page_token: str | None = None,
+  ) -> None:
+    start = int(page_token or 0)
+    end = start + page_size if page_size else len(items)
+    super().__init__(items[start:end])
+    self.next_page_token = str(end) if end < len(items) else ''
+
+  @property
+  def pages(self) -> Iterator['_FakePage']:
+    yield _FakePage(self, self.next_page_token)
+
+
+class _FakePage:
+  """A response page. Its repeated field, whatever the name, is the items."""
+
+  def __init__(self, items: list[Any], next_page_token: str) -> None:
+    self._items = items
+    self.next_page_token = next_page_token
+
+  def __getattr__(self, field: str) -> list[Any]:
+    return self._items
+
+
+class _FakeAsyncPager:
+
+  def __init__(self, items: list[Any]) -> None:
+    self._items = iter(items)
+
+  def __aiter__(self) -> '_FakeAsyncPager':
+    return self
+
+  async def __anext__(self) -> Any:
+    try:
+      return next(self._items)
+    except StopIteration:
+      raise StopAsyncIteration from None
+
+
+class _FakeTransport:
+
+  async def close(self) -> None:
+    pass
+
+
+class FakePublisher:
+  """A fake of the Pub/Sub publisher client that keeps published messages."""
+
+  def __init__(self, error_rate: float = 0.0, seed: int = 0) -> None:
+    """Initializes the fake.
+
+    Args:
+        error_rate: The fraction of messages that fail to publish.
+        seed: Makes the errors repeatable.
+    """
+    self.error_rate = error_rate
+    self.calls = collections.Counter()
+    # Published messages keyed by topic, in the order they were published.
+    self.messages = collections.defaultdict(list)
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def publish(
+      self, topic: str, data: bytes, ordering_key: str = '', **attributes: Any
+  ) -> futures.Future:
+    del ordering_key, attributes  # Unused.
+    future = futures.Future()
+    with self._lock:
+      self.calls['publish'] += 1
+      if self._random.random() < self.error_rate:
+        future.set_exception(
+            exceptions.ServiceUnavailable('The service is unavailable.'))
+        return future
+      self.messages[topic].append(data)
+    future.set_result(str(self.calls['publish']))
+    return future
+
+  def resume_publish(self, topic: str, ordering_key: str) -> None:
+    del topic, ordering_key  # Unused.
+    self.calls['resume_publish'] += 1
+
+
+def _collection(resource: str) -> str:
+  """Returns the collection ID for a resource, like googleAdsLinks."""
+  first, *rest = resource.split('_')
+  return first + ''.join(part[0].upper() + part[1:] for part in rest) + 's'
@@ -0,0 +1,95 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the benchmark fakes."""
+
+import asyncio
+
+from absl.testing import absltest
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+from google.api_core import exceptions
+
+from benchmarks import fakes
+
+
+class FakeAdminApiTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.now = 0.0
+    self.api = fakes.FakeAdminApi(clock=lambda: self.now, sleep=lambda _: None)
+
+  def test_create_list_update_and_delete_links(self):
+    created = self.api.create_google_ads_link(
+        parent='properties/1',
+        google_ads_link=GoogleAdsLink(customer_id='111'))
+    self.assertEqual('properties/1/googleAdsLinks/1', created.name)
+    self.assertEqual(
+        [created], self.api.list_google_ads_links(parent='properties/1'))
+    self.api.update_google_ads_link(
+        google_ads_link=GoogleAdsLink(
+            name=created.name, ads_personalization_enabled=True),
+        update_mask='ads_personalization_enabled')
+    self.assertTrue(created.ads_personalization_enabled)
+    self.api.delete_google_ads_link(name=created.name)
+    self.assertEmpty(self.api.list_google_ads_links(parent='properties/1'))
+    self.assertEqual(2, self.api.calls['list_google_ads_links'])
+
+  def test_unknown_methods_raise_attribute_error(self):
+    with self.assertRaises(AttributeError):
+      self.api.create_display_video_360_advertiser_link
+
+  def test_quota_raises_resource_exhausted(self):
+    self.api.quota = 1
+    self.api.list_google_ads_links(parent='properties/1')
+    with self.assertRaises(exceptions.ResourceExhausted):
+      self.api.list_google_ads_links(parent='properties/1')
+    self.now = 1.0
+    self.api.list_google_ads_links(parent='properties/1')
+    self.assertEqual({'RESOURCE_EXHAUSTED': 1}, self.api.errors)
+
+  def test_error_rate_raises_service_unavailable(self):
+    self.api.error_rate = 1.0
+    with self.assertRaises(exceptions.ServiceUnavailable):
+      self.api.list_google_ads_links(parent='properties/1')
+
+  def test_async_client_shares_links(self):
+    async_api = fakes.FakeAsyncAdminApi(self.api)
+
+    async def create_and_list():
+      await async_api.create_google_ads_link(
+          parent='properties/1',
+          google_ads_link=GoogleAdsLink(customer_id='111'))
+      pager = await async_api.list_google_ads_links(parent='properties/1')
+      return [link.customer_id async for link in pager]
+
+    self.assertEqual(['111'], asyncio.run(create_and_list()))
+
+
+class FakePublisherTest(absltest.TestCase):
+
+  def test_publish_keeps_messages(self):
+    publisher = fakes.FakePublisher()
+    future = publisher.publish('topic', b'data', ordering_key='1')
+    self.assertIsNone(future.exception())
+    self.assertEqual({'topic': [b'data']}, publisher.messages)
+
+  def test_publish_fails_at_error_rate(self):
+    publisher = fakes.FakePublisher(error_rate=1.0)
+    future = publisher.publish('topic', b'data')
+    self.assertIsInstance(future.exception(), exceptions.ServiceUnavailable)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,184 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the time it takes to import each cloud function.
+
+Importing the module of a function, including the clients it creates at
+module scope, is the part of a cold start that the code controls. Each import
+runs in a new interpreter, as on a new instance, and the report lists the
+median import time, the heavy libraries that were loaded and the top-level
+imports that took the longest according to python -X importtime.
+
+The Cloud Storage and Pub/Sub clients are pointed at emulator addresses so
+that they can be created without credentials. No requests are sent.
+
+Usage, from the cloud directory:
+    python -m benchmarks.import_time --function ads_links --repeat 5
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks import run_benchmark
+
+# Libraries that are slow to import and only needed on some paths.
+HEAVY_MODULES = (
+    'pandas',
+    'pyarrow',
+    'google.cloud.storage',
+    'google.cloud.pubsub_v1',
+    'google.cloud.logging',
+    'google.cloud.secretmanager',
+)
+
+ENVIRONMENT = {
+    'STORAGE_EMULATOR_HOST': 'http://localhost:9023',
+    'PUBSUB_EMULATOR_HOST': 'localhost:8085',
+    'GOOGLE_CLOUD_PROJECT': 'benchmark',
+}
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'loaded': [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+@dataclasses.dataclass
+class ImportReport:
+  """The import time of one function.
+
+  Attributes:
+      function: The name of the function.
+      seconds: The median time to import the module of the function.
+      loaded: The HEAVY_MODULES that importing the function loaded.
+      slowest: The slowest top-level imports, as (module, seconds) pairs.
+  """
+  function: str
+  seconds: float
+  loaded: list[str]
+  slowest: list[tuple[str, float]]
+
+  def summary(self) -> str:
+    """Returns the report as a few lines of text."""
+    slowest = ', '.join(
+        f'{module}={seconds * 1000:.0f}ms' for module, seconds in self.slowest)
+    return '\n'.join([
+        f'{self.function}: imported in {self.seconds * 1000:.0f}ms',
+        f"  heavy modules: {', '.join(self.loaded) or 'none'}",
+        f'  slowest imports: {slowest}',
+    ])
+
+
+def import_once(function: str) -> tuple[dict[str, object], str]:
+  """Imports a function in a new interpreter.
+
+  Args:
+      function: One of run_benchmark.FUNCTIONS.
+
+  Returns:
+      The measurements printed by the interpreter, and the python -X
+      importtime log it wrote to stderr.
+  """
+  directory, module = run_benchmark.FUNCTIONS[function]
+  path = os.pathsep.join([
+      os.path.join(run_benchmark.CLOUD_DIR, directory),
+      run_benchmark.CLOUD_DIR])
+  process = subprocess.run(
+      [sys.executable, '-X', 'importtime', '-c',
+       _SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+      env=os.environ | ENVIRONMENT | {'PYTHONPATH': path},
+      capture_output=True,
+      text=True,
+      check=True)
+  return json.loads(process.stdout.splitlines()[-1]), process.stderr
+
+
+def slowest_imports(log: str, top: int = 5) -> list[tuple[str, float]]:
+  """Returns the slowest top-level imports in a python -X importtime log.
+
+  Args:
+      log: The log, with lines like
+        "import time:  self [us] | cumulative | imported package".
+      top: The number of imports to return.
+
+  Returns:
+      (module, cumulative seconds) pairs, slowest first. Top-level imports are
+      the ones imported by the module of the function itself.
+  """
+  imports = []
+  for line in log.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    _, cumulative, name = line.split('|')
+    # Imports are indented by two spaces per level. The function's own module
+    # is at the first level, so its imports are at the second.
+    if not cumulative.strip().isdigit() or len(name) - len(
+        name.lstrip()) != 3:
+      continue
+    imports.append((name.strip(), int(cumulative) / 1e6))
+  return sorted(imports, key=lambda item: item[1], reverse=True)[:top]
+
+
+def measure(function: str, repeat: int = 5) -> ImportReport:
+  """Imports a function repeatedly and reports the median.
+
+  Args:
+      function: One of run_benchmark.FUNCTIONS.
+      repeat: The number of new interpreters the function is imported in.
+
+  Returns:
+      The report. The loaded and slowest modules are from the last import.
+  """
+  times = []
+  for _ in range(repeat):
+    result, log = import_once(function)
+    times.append(result['seconds'])
+  return ImportReport(
+      function=function,
+      seconds=statistics.median(times),
+      loaded=result['loaded'],
+      slowest=slowest_imports(log))
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--function', choices=[*run_benchmark.FUNCTIONS, 'all'], default='all')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--json', action='store_true')
+  args = parser.parse_args()
+  functions = (
+      list(run_benchmark.FUNCTIONS) if args.function == 'all'
+      else [args.function])
+  for function in functions:
+    report = measure(function, args.repeat)
+    if args.json:
+      print(json.dumps(dataclasses.asdict(report)))
+    else:
+      print(report.summary())
+
+
+if __name__ == '__main__':
+  main()
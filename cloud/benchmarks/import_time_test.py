@@ -0,0 +1,46 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the import time benchmark."""
+
+from absl.testing import absltest
+
+from benchmarks import import_time
+
+LOG = """\
+import time: self [us] | cumulative | imported package
+import time:       100 |       2000 |     google.protobuf
+import time:       300 |     400000 |   google.analytics.admin
+import time:        50 |        50 |   json
+import time:       900 |      90000 |   functions_framework
+import time:      1000 |     600000 | ads_links
+"""
+
+
+class ImportTimeTest(absltest.TestCase):
+
+  def test_slowest_imports_lists_imports_of_function_module(self):
+    self.assertEqual(
+        [('google.analytics.admin', 0.4), ('functions_framework', 0.09)],
+        import_time.slowest_imports(LOG, top=2))
+
+  def test_link_functions_do_not_load_pandas_or_storage(self):
+    report = import_time.measure('ads_links', repeat=1)
+    self.assertGreater(report.seconds, 0)
+    self.assertNotIn('pandas', report.loaded)
+    self.assertNotIn('google.cloud.storage', report.loaded)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,438 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the throughput of the cloud functions against local fakes.
+
+Each function runs through its real entry point with the Admin API, Cloud
+Storage and Pub/Sub replaced by the fakes in benchmarks.fakes. The report
+lists the rows processed per second, the p50 and p99 latency of each unit of
+work, the peak resident memory, the number of calls sent to each fake and the
+time spent in each stage recorded by shared.metrics.
+
+The unit of work is a row for the linker, a call to MessageBatcher.add for the
+message publisher and a pub/sub message for the link functions.
+
+Usage, from the cloud directory:
+    python -m benchmarks.run_benchmark --function linker --rows 100000 \
+        --latency 0.05 --set MAX_WORKERS=32
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import dataclasses
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Any
+from unittest import mock
+
+from cloudevents.http import CloudEvent
+
+from benchmarks import fakes
+from benchmarks import synthetic_data
+from shared import checkpoint
+from shared import metrics
+from shared import rate_limiter
+from shared import validation
+
+CLOUD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The directory and module name of each function.
+FUNCTIONS = {
+    'linker': ('linker', 'main'),
+    'message_publisher': ('message_publisher', 'message_publisher'),
+    'ads_links': ('ads_links', 'ads_links'),
+    'dv360_links': ('dv360_links', 'dv360_links'),
+    'links': ('links', 'links'),
+}
+
+EVENT_ATTRIBUTES = {'source': 'benchmark', 'type': 'benchmark'}
+CREDENTIALS = {
+    'client_id': 'benchmark',
+    'client_secret': 'benchmark',
+    'refresh_token': 'benchmark',
+    'token_uri': 'https://oauth2.googleapis.com/token',
+    'scopes': ['https://www.googleapis.com/auth/analytics.edit'],
+}
+
+
+@dataclasses.dataclass
+class Options:
+  """How a benchmark is run.
+
+  Attributes:
+      rows: The number of rows in the synthetic input.
+      properties: The number of properties the rows are spread over.
+      latency: The average number of seconds each Admin API request takes.
+      error_rate: The fraction of Admin API requests that fail with
+        UNAVAILABLE.
+      quota: The number of Admin API requests accepted per second.
+      publish_error_rate: The fraction of messages that fail to publish.
+      batch_size: The number of operations in each message for the link
+        functions and the message publisher.
+      concurrency: The number of messages the link functions handle at once,
+        like an instance with that many concurrent requests.
+      settings: Module constants of the function to override, such as
+        MAX_WORKERS. Constants the function does not define are ignored.
+  """
+  rows: int = 1000
+  properties: int | None = None
+  latency: float = 0.0
+  error_rate: float = 0.0
+  quota: float | None = None
+  publish_error_rate: float = 0.0
+  batch_size: int = 1
+  concurrency: int = 1
+  settings: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class Report:
+  """The measurements of one benchmark run."""
+  function: str
+  rows: int
+  seconds: float
+  p50_ms: float
+  p99_ms: float
+  peak_rss_mb: float
+  calls: dict[str, int]
+  errors: dict[str, int]
+  # Seconds spent in each stage, summed over every invocation.
+  spans: dict[str, float] = dataclasses.field(default_factory=dict)
+
+  @property
+  def rows_per_second(self) -> float:
+    return self.rows / self.seconds if self.seconds else 0.0
+
+  def summary(self) -> str:
+    calls = ', '.join(f'{k}={v}' for k, v in sorted(self.calls.items()))
+    errors = ', '.join(f'{k}={v}' for k, v in sorted(self.errors.items()))
+    spans = ', '.join(
+        f'{k}={v:.2f}s' for k, v in sorted(self.spans.items()))
+    return (
+        f'{self.function}: {self.rows} rows in {self.seconds:.2f}s '
+        f'({self.rows_per_second:.1f} rows/s), '
+        f'p50 {self.p50_ms:.2f}ms, p99 {self.p99_ms:.2f}ms, '
+        f'peak RSS {self.peak_rss_mb:.1f}MB\n'
+        f'  calls: {calls or "none"}\n'
+        f'  errors: {errors or "none"}\n'
+        f'  stages: {spans or "none"}')
+
+
+def import_function(function: str) -> Any:
+  """Imports the module of a function without connecting to Google Cloud."""
+  directory, module = FUNCTIONS[function]
+  path = os.path.join(CLOUD_DIR, directory)
+  if path not in sys.path:
+    sys.path.insert(0, path)
+  with mock.patch('google.cloud.storage.Client'), \
+      mock.patch('google.cloud.pubsub_v1.PublisherClient'):
+    return importlib.import_module(module)
+
+
+def run_function(function: str, options: Options) -> Report:
+  """Runs one benchmark in the current process.
+
+  Args:
+      function: One of FUNCTIONS.
+      options: How the benchmark is run.
+
+  Returns:
+      The measurements of the run. The peak memory is the peak of the whole
+      process, so run each benchmark in a new process to compare them.
+  """
+  module = import_function(function)
+  api = fakes.FakeAdminApi(
+      latency=options.latency,
+      error_rate=options.error_rate,
+      quota=options.quota)
+  storage_client = fakes.FakeStorageClient()
+  publisher = fakes.FakePublisher(error_rate=options.publish_error_rate)
+  latencies = []
+  errors = {}
+  snapshots = []
+  with contextlib.ExitStack() as stack, \
+      tempfile.TemporaryDirectory() as temp_dir:
+    # The metrics of each invocation are added to the report instead of being
+    # printed.
+    stack.enter_context(mock.patch.object(
+        metrics.Metrics, 'emit',
+        lambda collector: snapshots.append(collector.snapshot())))
+    for name, value in options.settings.items():
+      if not hasattr(module, name):
+        continue
+      stack.enter_context(
+          mock.patch.object(module, name, _coerce(getattr(module, name), value)))
+    if hasattr(module, 'limiter'):
+      stack.enter_context(mock.patch.object(
+          module, 'limiter', rate_limiter.AdaptiveRateLimiter.from_env()))
+    runner = {
+        'linker': _run_linker,
+        'message_publisher': _run_message_publisher,
+        'ads_links': _run_link_function,
+        'dv360_links': _run_link_function,
+        'links': _run_link_function,
+    }[function]
+    start = time.perf_counter()
+    runner(module, options, stack, temp_dir, api, storage_client, publisher,
+           latencies, errors)
+    seconds = time.perf_counter() - start
+  calls = dict(api.calls)
+  calls.update({f'storage.{k}': v for k, v in storage_client.calls.items()})
+  calls.update({f'pubsub.{k}': v for k, v in publisher.calls.items()})
+  errors.update(api.errors)
+  spans = {}
+  for snapshot in snapshots:
+    for stage, span in snapshot['spans'].items():
+      spans[stage] = spans.get(stage, 0.0) + span['seconds']
+  return Report(
+      function=function,
+      rows=options.rows,
+      seconds=seconds,
+      p50_ms=percentile(latencies, 50) * 1000,
+      p99_ms=percentile(latencies, 99) * 1000,
+      peak_rss_mb=peak_rss_mb(),
+      calls=calls,
+      errors=errors,
+      spans=spans)
+
+
+def _run_linker(module, options, stack, temp_dir, api, storage_client,
+                publisher, latencies, errors):
+  del publisher, errors  # Unused.
+  path = os.path.join(temp_dir, 'links.csv')
+  with open(path, 'w', newline='') as file:
+    synthetic_data.write_csv(file, 'linker', options.rows, options.properties)
+  storage_client.bucket('input').add_file('links.csv', path)
+  async_api = fakes.FakeAsyncAdminApi(api)
+
+  def get_ga_client(client_class=None):
+    if client_class is module.AnalyticsAdminServiceAsyncClient:
+      return async_api
+    return api
+
+  create_link = module.create_link
+  create_link_async = module.create_link_async
+
+  def timed_create_link(*args):
+    start = time.perf_counter()
+    try:
+      return create_link(*args)
+    finally:
+      latencies.append(time.perf_counter() - start)
+
+  async def timed_create_link_async(*args):
+    start = time.perf_counter()
+    try:
+      return await create_link_async(*args)
+    finally:
+      latencies.append(time.perf_counter() - start)
+
+  for name, value in (
+      ('storage_client', storage_client),
+      ('OUTPUT_BUCKET', 'output'),
+      ('CHECKPOINT_BUCKET', 'output'),
+      ('get_ga_client', get_ga_client),
+      ('create_link', timed_create_link),
+      ('create_link_async', timed_create_link_async)):
+    stack.enter_context(mock.patch.object(module, name, value))
+  _run_storage_events(module, storage_client, 'links.csv')
+
+
+def _run_message_publisher(module, options, stack, temp_dir, api,
+                           storage_client, publisher, latencies, errors):
+  del api, errors  # Unused.
+  path = os.path.join(temp_dir, 'ads_link.csv')
+  with open(path, 'w', newline='') as file:
+    synthetic_data.write_csv(
+        file, 'publisher', options.rows, options.properties)
+  storage_client.bucket('input').add_file('ads_link.csv', path)
+  add = module.MessageBatcher.add
+
+  def timed_add(*args):
+    start = time.perf_counter()
+    try:
+      return add(*args)
+    finally:
+      latencies.append(time.perf_counter() - start)
+
+  stack.enter_context(mock.patch.object(module, 'storage_client', storage_client))
+  stack.enter_context(mock.patch.object(module, 'publisher', publisher))
+  # The credentials check refreshes a token, which the fakes do not serve.
+  stack.enter_context(mock.patch.object(module, 'check_credentials'))
+  stack.enter_context(mock.patch.object(module.MessageBatcher, 'add', timed_add))
+  stack.enter_context(mock.patch.object(
+      module, 'MessageBatcher', functools.partial(
+          module.MessageBatcher, batch_size=options.batch_size)))
+  _run_storage_events(
+      module, storage_client, 'ads_link.csv', os.path.getsize(path))
+
+
+def _run_storage_events(module, storage_client, name, size=None):
+  """Triggers a function for an uploaded file and any continuations.
+
+  The shards of a file that the function splits are run at the same time,
+  like the separate instances they would be deployed on.
+  """
+  pending = [{'bucket': 'input', 'name': name, 'generation': '1'}]
+  if size is not None:
+    pending[0]['size'] = str(size)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=64) as executor:
+    while pending:
+      list(executor.map(
+          lambda data: module.main(CloudEvent(EVENT_ATTRIBUTES, data)),
+          pending))
+      pending = [
+          {'bucket': 'input', 'name': blob.name, 'generation': '1'}
+          for blob in storage_client.bucket('input').list_blobs()
+          if blob.name.endswith(
+              (checkpoint.CONTINUATION_SUFFIX, checkpoint.SHARD_SUFFIX))]
+
+
+def _run_link_function(module, options, stack, temp_dir, api, storage_client,
+                       publisher, latencies, errors):
+  del storage_client, publisher  # Unused.
+  path = os.path.join(temp_dir, 'operations.csv')
+  with open(path, 'w', newline='') as file:
+    synthetic_data.write_csv(
+        file, 'publisher', options.rows, options.properties)
+  events = []
+  batch = []
+  # The rows are read as the message publisher reads them.
+  for row in validation.validated_records(
+      path, {None: validation.MESSAGE_SCHEMA}):
+    row.pop(validation.REJECTED_KEY, None)
+    batch.append(row)
+    if len(batch) >= options.batch_size:
+      events.append(_message_event(batch))
+      batch = []
+  if batch:
+    events.append(_message_event(batch))
+  # Every link function handles its messages with the shared link handler.
+  handler = module.link_handler
+  stack.enter_context(mock.patch.object(
+      handler, 'AnalyticsAdminServiceClient', lambda credentials: api))
+  stack.enter_context(mock.patch.object(
+      handler, 'limiter', rate_limiter.AdaptiveRateLimiter.from_env()))
+  # The DV360 link function sends its logs to Cloud Logging.
+  stack.enter_context(mock.patch('google.cloud.logging.Client'))
+  if getattr(module, 'LINK_TYPE', '') is None:
+    # The synthetic messages describe Google Ads links.
+    stack.enter_context(mock.patch.object(module, 'LINK_TYPE', 'ads_link'))
+  handler.ga_clients.clear()
+  for index in handler.indexes.values():
+    index.clear()
+
+  def handle(event):
+    start = time.perf_counter()
+    try:
+      module.main(event)
+    except Exception as e:
+      name = f'raised {type(e).__name__}'
+      errors[name] = errors.get(name, 0) + 1
+    finally:
+      latencies.append(time.perf_counter() - start)
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=options.concurrency) as executor:
+    list(executor.map(handle, events))
+
+
+def _message_event(rows):
+  if len(rows) == 1:
+    data = CREDENTIALS | rows[0] | {'enable_logging': False}
+  else:
+    data = CREDENTIALS | {'operations': rows, 'enable_logging': False}
+  encoded = base64.b64encode(json.dumps(data).encode('utf-8'))
+  return CloudEvent(EVENT_ATTRIBUTES, {'message': {'data': encoded}})
+
+
+def _coerce(current: Any, value: str) -> Any:
+  """Converts a setting to the type of the constant it overrides."""
+  if isinstance(current, bool):
+    return value.strip().lower() == 'true'
+  if current is None or isinstance(current, str):
+    return value
+  return type(current)(value)
+
+
+def percentile(values: list[float], percent: float) -> float:
+  """Returns the nearest-rank percentile of the values, or 0 if empty."""
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  rank = max(1, -(-len(ordered) * percent // 100))
+  return ordered[int(rank) - 1]
+
+
+def peak_rss_mb() -> float:
+  """Returns the peak resident memory of the process in megabytes."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes and macOS reports bytes.
+  return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--function', choices=[*FUNCTIONS, 'all'], default='all')
+  parser.add_argument('--rows', type=int, default=1000)
+  parser.add_argument('--properties', type=int)
+  parser.add_argument('--latency', type=float, default=0.0)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  parser.add_argument('--quota', type=float)
+  parser.add_argument('--publish-error-rate', type=float, default=0.0)
+  parser.add_argument('--batch-size', type=int, default=1)
+  parser.add_argument('--concurrency', type=int, default=1)
+  parser.add_argument(
+      '--set', action='append', default=[], metavar='NAME=VALUE',
+      help='Overrides a module constant of the function, such as '
+      'MAX_WORKERS=32 or ASYNC_ENGINE=true.')
+  parser.add_argument('--json', action='store_true')
+  args = parser.parse_args()
+  options = Options(
+      rows=args.rows,
+      properties=args.properties,
+      latency=args.latency,
+      error_rate=args.error_rate,
+      quota=args.quota,
+      publish_error_rate=args.publish_error_rate,
+      batch_size=args.batch_size,
+      concurrency=args.concurrency,
+      settings=dict(setting.split('=', 1) for setting in args.set))
+  functions = list(FUNCTIONS) if args.function == 'all' else [args.function]
+  for function in functions:
+    # Each benchmark runs in a new process so that the peak memory and the
+    # module state of one function do not affect the next.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context('spawn')) as executor:
+      report = executor.submit(run_function, function, options).result()
+    if args.json:
+      print(json.dumps(dataclasses.asdict(report)
+                       | {'rows_per_second': report.rows_per_second}))
+    else:
+      print(report.summary())
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the benchmark runner."""
+
+import csv
+import io
+import os
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+
+from benchmarks import run_benchmark
+from benchmarks import synthetic_data
+
+
+class SyntheticDataTest(absltest.TestCase):
+
+  def test_write_csv_writes_linker_rows(self):
+    file = io.StringIO()
+    self.assertEqual(
+        20, synthetic_data.write_csv(file, 'linker', 20, properties=3))
+    rows = list(csv.DictReader(io.StringIO(file.getvalue())))
+    self.assertLen(rows, 20)
+    self.assertEqual(list(synthetic_data.LINKER_COLUMNS), list(rows[0]))
+    self.assertLessEqual(len({row['ga4_property_id'] for row in rows}), 3)
+
+  def test_write_csv_is_repeatable(self):
+    first, second = io.StringIO(), io.StringIO()
+    synthetic_data.write_csv(first, 'publisher', 10, seed=1)
+    synthetic_data.write_csv(second, 'publisher', 10, seed=1)
+    self.assertEqual(first.getvalue(), second.getvalue())
+
+
+class RunBenchmarkTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(mock.patch.dict(os.environ, {
+        'REQUESTS_PER_SECOND': '1000',
+        'MAX_REQUESTS_PER_SECOND': '1000',
+    }))
+
+  @parameterized.parameters(
+      ('linker', {}, 'list_google_ads_links'),
+      ('linker', {'ASYNC_ENGINE': 'true'}, 'list_google_ads_links'),
+      ('message_publisher', {}, 'pubsub.publish'),
+      ('ads_links', {}, 'create_google_ads_link'),
+      ('dv360_links', {}, 'create_display_video360_advertiser_link'),
+      ('links', {}, 'create_google_ads_link'),
+  )
+  def test_run_function_reports_rows_and_calls(
+      self, function, settings, expected_call):
+    report = run_benchmark.run_function(
+        function, run_benchmark.Options(rows=30, settings=settings))
+    self.assertEqual(30, report.rows)
+    self.assertGreater(report.rows_per_second, 0)
+    self.assertGreater(report.calls[expected_call], 0)
+    self.assertGreater(report.peak_rss_mb, 0)
+    self.assertEmpty(report.errors)
+
+  def test_run_function_publishes_every_row_of_sharded_file(self):
+    report = run_benchmark.run_function(
+        'message_publisher',
+        run_benchmark.Options(
+            rows=100, settings={'SHARDS': '4', 'MIN_SHARD_BYTES': '1'}))
+    self.assertEqual(100, report.calls['pubsub.publish'])
+    self.assertEqual(4, report.calls['storage.delete'])
+
+  def test_percentile(self):
+    values = [float(value) for value in range(1, 101)]
+    self.assertEqual(50.0, run_benchmark.percentile(values, 50))
+    self.assertEqual(99.0, run_benchmark.percentile(values, 99))
+    self.assertEqual(0.0, run_benchmark.percentile([], 99))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,183 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generates synthetic input files for the benchmarks.
+
+Linker files follow the linker input CSV format. Publisher files hold the rows
+that the message publisher copies into the messages for the Google Ads and
+DV360 link functions.
+
+Usage:
+    python -m benchmarks.synthetic_data --format linker --rows 1000000 \
+        --output links.csv
+"""
+
+import argparse
+from collections.abc import Iterator, Sequence
+import csv
+import random
+from typing import Any, TextIO
+
+LINKER_COLUMNS = (
+    'request_type',
+    'ga4_property_id',
+    'ads_customer_id',
+    'ads_personalization_enabled',
+    'dv360_advertiser_id',
+    'dv360_campaign_data_sharing_enabled',
+    'dv360_cost_data_sharing_enabled',
+    'dv360_proposal_validation_email',
+)
+LINKER_REQUEST_TYPES = ('ads', 'dv360', 'dv360_link_proposal')
+
+PUBLISHER_COLUMNS = (
+    'action',
+    'property_id',
+    'name',
+    'customer_id',
+    'advertiser_id',
+    'ads_personalization_enabled',
+    'campaign_data_sharing_enabled',
+    'cost_data_sharing_enabled',
+)
+
+FORMATS = ('linker', 'publisher')
+
+
+def linker_rows(
+    rows: int,
+    properties: int | None = None,
+    request_types: Sequence[str] = LINKER_REQUEST_TYPES,
+    seed: int = 0,
+) -> Iterator[dict[str, Any]]:
+  """Yields rows in the linker input format.
+
+  Args:
+      rows: The number of rows.
+      properties: The number of distinct properties the rows are spread over.
+        Defaults to one property for every ten rows.
+      request_types: The request types to pick from at random.
+      seed: Makes the generated rows repeatable.
+
+  Yields:
+      A dictionary for each row, keyed by LINKER_COLUMNS.
+  """
+  rng = random.Random(seed)
+  properties = properties or max(1, rows // 10)
+  for index in range(rows):
+    yield {
+        'request_type': rng.choice(request_types),
+        'ga4_property_id': 100000000 + rng.randrange(properties),
+        # Platform IDs are unique so that every row describes a new link.
+        'ads_customer_id': 1000000000 + index,
+        'ads_personalization_enabled': _bool(rng),
+        'dv360_advertiser_id': 2000000000 + index,
+        'dv360_campaign_data_sharing_enabled': _bool(rng),
+        'dv360_cost_data_sharing_enabled': _bool(rng),
+        'dv360_proposal_validation_email': f'user{index}@example.com',
+    }
+
+
+def publisher_rows(
+    rows: int,
+    properties: int | None = None,
+    seed: int = 0,
+) -> Iterator[dict[str, Any]]:
+  """Yields create operations in the message publisher input format.
+
+  Every row holds the keys that both the Google Ads and the DV360 link
+  functions require.
+
+  Args:
+      rows: The number of rows.
+      properties: The number of distinct properties the rows are spread over.
+        Defaults to one property for every ten rows.
+      seed: Makes the generated rows repeatable.
+
+  Yields:
+      A dictionary for each row, keyed by PUBLISHER_COLUMNS.
+  """
+  rng = random.Random(seed)
+  properties = properties or max(1, rows // 10)
+  for index in range(rows):
+    yield {
+        'action': 'create',
+        'property_id': 100000000 + rng.randrange(properties),
+        'name': 'n/a',
+        'customer_id': 1000000000 + index,
+        'advertiser_id': 2000000000 + index,
+        'ads_personalization_enabled': _bool(rng),
+        'campaign_data_sharing_enabled': _bool(rng),
+        'cost_data_sharing_enabled': _bool(rng),
+    }
+
+
+def write_csv(
+    file: TextIO,
+    file_format: str,
+    rows: int,
+    properties: int | None = None,
+    seed: int = 0,
+) -> int:
+  """Writes a synthetic input file.
+
+  Rows are generated and written one at a time, so files with millions of
+  rows do not have to fit in memory.
+
+  Args:
+      file: A text file opened for writing.
+      file_format: One of FORMATS.
+      rows: The number of rows.
+      properties: The number of distinct properties the rows are spread over.
+      seed: Makes the generated rows repeatable.
+
+  Returns:
+      The number of rows written.
+  """
+  if file_format == 'linker':
+    columns, records = LINKER_COLUMNS, linker_rows(rows, properties, seed=seed)
+  elif file_format == 'publisher':
+    columns, records = PUBLISHER_COLUMNS, publisher_rows(
+        rows, properties, seed=seed)
+  else:
+    raise ValueError(f'Unknown format: {file_format}')
+  writer = csv.DictWriter(file, fieldnames=columns)
+  writer.writeheader()
+  count = 0
+  for record in records:
+    writer.writerow(record)
+    count += 1
+  return count
+
+
+def _bool(rng: random.Random) -> str:
+  return 'true' if rng.random() < 0.5 else 'false'
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--format', choices=FORMATS, default='linker')
+  parser.add_argument('--rows', type=int, default=1000)
+  parser.add_argument('--properties', type=int)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', required=True)
+  args = parser.parse_args()
+  with open(args.output, 'w', newline='') as file:
+    count = write_csv(
+        file, args.format, args.rows, args.properties, args.seed)
+  print(f'Wrote {count} rows to {args.output}')
+
+
+if __name__ == '__main__':
+  main()
@@ -24,6 +24,7 @@ import unittest
 from absl.testing import absltest
 from cloudevents.http import CloudEvent
 import dv360_links
+from shared import link_handler
 
 
 class DV360LinksTest(absltest.TestCase):
@@ -49,8 +50,12 @@ class DV360LinksTest(absltest.TestCase):
         'property_id': '1234567',
         'name': 'properties/1234567/displayVideo360Link/abcdefg',
     }
+    link_handler.ga_clients.clear()
+    for index in link_handler.indexes.values():
+      index.clear()
+    dv360_links.setup_logging.cache_clear()
 
-    self.enter_context(
+    self.log_client = self.enter_context(
         unittest.mock.patch.object(
             dv360_links.google.cloud.logging, 'Client', autospec=True
         )
@@ -71,30 +76,26 @@ class DV360LinksTest(absltest.TestCase):
     error_message = 'Missing keys: client_id,action'
     self.assertEqual(error_message, dv360_links.main(missing_keys))
 
-  @unittest.mock.patch('dv360_links.AnalyticsAdminServiceClient')
-  def test_get_ga_client_creates_admin_client(self, mock_analytics_client):
-    dv360_links.get_ga_client(
-        self.data['refresh_token'],
-        self.data['token_uri'],
-        self.data['client_id'],
-        self.data['client_secret'],
-        self.data['scopes'],
-    )
-    mock_analytics_client.assert_called()
+  def test_main_sets_up_logging_once(self):
+    missing_data = CloudEvent(self.attributes, {'message': {}})
+    dv360_links.main(missing_data)
+    dv360_links.main(missing_data)
+    self.log_client.assert_called_once()
+    self.log_client().setup_logging.assert_called_once()
 
-  @unittest.mock.patch('dv360_links.get_ga_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
   def test_main_calls_create_dv360_link(self, mock_ga_client):
     encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
     cloud_event = CloudEvent(
         self.attributes, {'message': {'data': encoded_data}}
     )
     result = 'created'
-    mock_ga_client().create_display_video_360_advertiser_link.return_value = (
+    mock_ga_client().create_display_video360_advertiser_link.return_value = (
         result
     )
     self.assertEqual(result, dv360_links.main(cloud_event))
 
-  @unittest.mock.patch('dv360_links.get_ga_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
   def test_main_calls_update_dv360_link(self, mock_ga_client):
     self.data['action'] = 'update'
     encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
@@ -102,12 +103,12 @@ class DV360LinksTest(absltest.TestCase):
         self.attributes, {'message': {'data': encoded_data}}
     )
     result = 'updated'
-    mock_ga_client().update_display_video_360_advertiser_link.return_value = (
+    mock_ga_client().update_display_video360_advertiser_link.return_value = (
         result
     )
     self.assertEqual(result, dv360_links.main(cloud_event))
 
-  @unittest.mock.patch('dv360_links.get_ga_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
   def test_main_calls_delete_dv360_link(self, mock_ga_client):
     self.data['action'] = 'delete'
     encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
@@ -115,12 +116,12 @@ class DV360LinksTest(absltest.TestCase):
         self.attributes, {'message': {'data': encoded_data}}
     )
     result = 'deleted'
-    mock_ga_client().delete_display_video_360_advertiser_link.return_value = (
+    mock_ga_client().delete_display_video360_advertiser_link.return_value = (
         result
     )
     self.assertEqual(result, dv360_links.main(cloud_event))
 
-  @unittest.mock.patch('dv360_links.get_ga_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
   def test_main_calls_list_dv360_links(self, mock_ga_client):
     self.data['action'] = 'list'
     encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
@@ -128,11 +129,38 @@ class DV360LinksTest(absltest.TestCase):
         self.attributes, {'message': {'data': encoded_data}}
     )
     result = 'listed'
-    mock_ga_client().list_display_video_360_advertiser_links.return_value = (
+    mock_ga_client().list_display_video360_advertiser_links.return_value = (
         result
     )
     self.assertEqual(result, dv360_links.main(cloud_event))
 
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_runs_each_operation_in_batch(self, mock_ga_client):
+    del self.data['action']
+    del self.data['advertiser_id']
+    self.data['operations'] = [
+        {'action': 'create', 'advertiser_id': '1'},
+        {'action': 'create'},
+    ]
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}}
+    )
+    mock_ga_client().create_display_video360_advertiser_link.return_value = (
+        'created'
+    )
+    self.assertEqual(
+        [
+            {'index': 0, 'action': 'create', 'response': 'created'},
+            {
+                'index': 1,
+                'action': 'create',
+                'error': 'Missing keys: advertiser_id',
+            },
+        ],
+        dv360_links.main(cloud_event),
+    )
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -0,0 +1,526 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Crawls every account and property into a columnar inventory snapshot.
+
+The account summaries are listed first, then the properties of each account,
+and then the data streams, custom dimensions, custom metrics and links of
+every type in shared.link_resources of each property. The lists of many
+properties are sent at the same time from a pool of worker threads, paced by
+one rate limiter, and the records are written as they arrive, so memory only
+holds the parts that are being filled.
+
+A snapshot is written to the OUTPUT_BUCKET as one table per resource,
+partitioned by account:
+
+    inventory/snapshot=<ID>/<table>/account=<account ID>/part-<row>.parquet
+
+Each record has the account ID, the property ID and the fields of the
+resource, with nested fields as JSON. Lists that failed are written to the
+errors table instead of stopping the crawl. Once every account has been
+written, a manifest with the parts of each table and account is saved next
+to the tables and as inventory/latest.json.
+
+Later snapshots refresh the latest one incrementally. The change history of
+each account is searched since the last snapshot that crawled it started,
+which the manifest keeps for each account, and only the
+resources that changed, new properties and lists that failed are listed
+again. The other records are carried over: the manifest points at the parts
+of earlier snapshots for tables without changes, so those parts must be kept
+for as long as later snapshots are.
+
+The function is triggered by a pub/sub message, such as one sent by Cloud
+Scheduler. A message with an "account_ids" list only refreshes those
+accounts, and one with "full" set to true lists everything again.
+"""
+
+import base64
+from collections.abc import Callable, Iterable, Iterator, Mapping
+import concurrent.futures
+import contextvars
+import datetime
+import json
+import os
+import time
+from typing import Any
+
+from cloudevents.http import CloudEvent
+import functions_framework
+import google.auth.transport.requests
+import google.oauth2.credentials
+from google.analytics.admin import AnalyticsAdminServiceClient
+from google.api_core import exceptions
+from google.cloud import storage
+
+from shared import bulk_list
+from shared import circuit_breaker
+from shared import errors
+from shared import link_resources
+from shared import metrics
+from shared import rate_limiter
+from shared import results_writer
+
+OUTPUT_BUCKET = os.environ.get('OUTPUT_BUCKET')
+CLIENT_ID = os.environ.get('CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
+REFRESH_TOKEN = os.environ.get('REFRESH_TOKEN')
+TOKEN_URI = os.environ.get('TOKEN_URI')
+# The format of the snapshot parts: parquet, ndjson or csv.
+INVENTORY_FORMAT = os.environ.get('INVENTORY_FORMAT', 'parquet')
+# Number of lists sent at the same time.
+MAX_WORKERS = int(os.environ.get('INVENTORY_WORKERS', 16))
+# Parts are written once they hold this many records.
+PART_ROWS = int(os.environ.get('INVENTORY_PART_ROWS', 100000))
+
+PREFIX = 'inventory/'
+MANIFEST_NAME = '_manifest.json'
+LATEST_NAME = f'{PREFIX}latest.json'
+ACCOUNTS_TABLE = 'accounts'
+PROPERTIES_TABLE = 'properties'
+ERRORS_TABLE = 'errors'
+ACCOUNT_IDS_KEY = 'account_ids'
+FULL_KEY = 'full'
+
+# The resources listed for each property, keyed by table, as the client
+# method that lists them and the field of the response that holds them.
+PROPERTY_TABLES = {
+    'data_streams': ('list_data_streams', 'data_streams'),
+    'custom_dimensions': ('list_custom_dimensions', 'custom_dimensions'),
+    'custom_metrics': ('list_custom_metrics', 'custom_metrics'),
+} | {
+    f'{link_type}s': (resource.list_method, resource.list_field)
+    for link_type, resource in link_resources.LINK_TYPES.items()
+}
+# The table of each collection in resource names, such as googleAdsLinks,
+# lowercased since some are not the camel case of their field.
+_COLLECTIONS = {
+    field.replace('_', ''): table
+    for table, (_, field) in PROPERTY_TABLES.items()
+}
+
+storage_client = storage.Client()
+limiter = rate_limiter.AdaptiveRateLimiter.from_env()
+
+
+class SnapshotWriter:
+  """Writes the tables of a snapshot, partitioned by account.
+
+  Not safe to share between threads: records are written by the thread that
+  collects the lists.
+  """
+
+  def __init__(
+      self,
+      bucket: storage.Bucket,
+      snapshot_id: str,
+      file_format: str = 'parquet',
+      part_rows: int | None = None,
+  ) -> None:
+    """Initializes the writer.
+
+    Args:
+        bucket: The bucket the snapshot is written to.
+        snapshot_id: The ID of the snapshot, such as the time it started.
+        file_format: One of results_writer.FORMATS.
+        part_rows: Parts are written once they hold this many records.
+          Defaults to PART_ROWS.
+    """
+    self._bucket = bucket
+    self.snapshot_id = snapshot_id
+    self.prefix = f'{PREFIX}snapshot={snapshot_id}/'
+    self._format = file_format
+    self._part_rows = part_rows or PART_ROWS
+    self._writers = {}
+    self.rows = {}
+    # The rows and parts of each table, keyed by account ID and then by
+    # table.
+    self.rows_by_account = {}
+    self.parts = {}
+    # The time the change history of each account is searched from when
+    # this snapshot is refreshed.
+    self.since_by_account = {}
+
+  def write(
+      self, table: str, account_id: str, record: Mapping[str, Any]) -> None:
+    """Buffers a record of a table until its part is written."""
+    key = (account_id, table)
+    if key not in self._writers:
+      self._writers[key] = results_writer.ResultsWriter(
+          self._bucket,
+          f'{self.prefix}{table}/account={account_id}/',
+          self._format,
+          part_rows=self._part_rows)
+    self._writers[key].write(record)
+    self._count(account_id, table, 1)
+
+  def reuse(
+      self, account_id: str, table: str, parts: list[str], rows: int) -> None:
+    """Adds the parts of a table of an earlier snapshot without copying."""
+    self.parts.setdefault(account_id, {}).setdefault(table, []).extend(parts)
+    self._count(account_id, table, rows)
+
+  def read(self, parts: Iterable[str]) -> Iterator[dict[str, Any]]:
+    """Yields the records of parts of this or an earlier snapshot."""
+    for part in parts:
+      yield from results_writer.read_part(self._bucket, part)
+
+  def _count(self, account_id: str, table: str, rows: int) -> None:
+    self.rows[table] = self.rows.get(table, 0) + rows
+    tables = self.rows_by_account.setdefault(account_id, {})
+    tables[table] = tables.get(table, 0) + rows
+
+  def close_account(self, account_id: str) -> None:
+    """Writes the remaining records of an account once it is crawled."""
+    tables = self.parts.setdefault(account_id, {})
+    for key in [key for key in self._writers if key[0] == account_id]:
+      writer = self._writers.pop(key)
+      writer.close()
+      tables.setdefault(key[1], []).extend(writer.parts)
+
+  def close(self, summary: Mapping[str, Any]) -> dict[str, Any]:
+    """Saves the manifest of the snapshot and makes it the latest one.
+
+    Args:
+        summary: Added to the manifest, such as the number of properties.
+
+    Returns:
+        The manifest.
+    """
+    for account_id in {key[0] for key in self._writers}:
+      self.close_account(account_id)
+    manifest = {
+        'snapshot': self.snapshot_id,
+        'prefix': self.prefix,
+        'format': self._format,
+        'rows': self.rows,
+        'rows_by_account': self.rows_by_account,
+        'parts': self.parts,
+        'since_by_account': self.since_by_account,
+        **summary,
+    }
+    data = json.dumps(manifest)
+    for name in (f'{self.prefix}{MANIFEST_NAME}', LATEST_NAME):
+      self._bucket.blob(name).upload_from_string(
+          data, content_type='application/json')
+    return manifest
+
+
+@functions_framework.cloud_event
+@metrics.instrumented('inventory')
+def main(cloud_event: CloudEvent) -> dict[str, Any]:
+  """Refreshes the latest snapshot into a new one.
+
+  Args:
+      cloud_event: The cloud event with the pub/sub message.
+
+  Returns:
+      The manifest of the new snapshot.
+  """
+  start_time = time.time()
+  data = {}
+  message = (cloud_event.data or {}).get('message', {})
+  if message.get('data'):
+    data = json.loads(base64.b64decode(message['data']).decode())
+  bucket = storage_client.bucket(OUTPUT_BUCKET)
+  previous = None if data.get(FULL_KEY) else load_latest(bucket)
+  if previous and previous['format'] != INVENTORY_FORMAT:
+    previous = None
+  snapshot_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(start_time))
+  writer = SnapshotWriter(bucket, snapshot_id, INVENTORY_FORMAT)
+  summary = crawl(
+      get_ga_client(), writer, data.get(ACCOUNT_IDS_KEY), previous=previous,
+      started=start_time)
+  manifest = writer.close(summary | {
+      'started': start_time,
+      'finished': time.time(),
+  })
+  print(
+      f"Inventory snapshot {snapshot_id}: {summary['properties']} "
+      f"properties, {summary.get('unchanged', 0)} unchanged accounts, "
+      f"{manifest['rows']} rows, {summary['errors']} errors")
+  return manifest
+
+
+def load_latest(bucket: storage.Bucket) -> dict[str, Any] | None:
+  """Returns the manifest of the latest snapshot, or None if there is none."""
+  try:
+    return json.loads(bucket.blob(LATEST_NAME).download_as_text())
+  except exceptions.NotFound:
+    return None
+
+
+def crawl(
+    ga_client: Any,
+    writer: SnapshotWriter,
+    account_ids: Iterable[str] | None = None,
+    max_workers: int = MAX_WORKERS,
+    previous: Mapping[str, Any] | None = None,
+    started: float | None = None,
+) -> dict[str, Any]:
+  """Lists every resource of the accounts into a snapshot.
+
+  With a previous snapshot, the change history of each account is searched
+  first, since the time the previous snapshot has for it. Accounts without
+  changes keep the
+  parts of the previous snapshot. For the others, only the resources that
+  changed, the properties that are new and the lists that failed before are
+  listed again, and the records of the rest are carried over.
+
+  Args:
+      ga_client: The Admin API client shared by every worker.
+      writer: The snapshot the records are written to.
+      account_ids: The accounts to crawl. Defaults to every account the
+        credentials can access. Other accounts of the previous snapshot are
+        kept as they were.
+      max_workers: The number of lists sent at the same time.
+      previous: The manifest of the snapshot to refresh. None lists every
+        resource.
+      started: The time the crawl started, which the next refresh searches
+        the change history of the crawled accounts from. Defaults to now.
+
+  Returns:
+      The number of accounts, properties and failed lists, and with a
+      previous snapshot, the number of accounts without changes.
+
+  Raises:
+      CircuitOpenError: If the lists keep failing to authenticate.
+  """
+  wanted = {str(account_id) for account_id in account_ids or ()}
+  summary = {'accounts': 0, 'properties': 0, 'errors': 0}
+  old_parts = previous['parts'] if previous else {}
+  if previous:
+    summary['unchanged'] = 0
+  if started is None:
+    started = time.time()
+  breaker = circuit_breaker.CircuitBreaker()
+  # The number of lists of each account that have not been written yet, so
+  # that its partitions are closed as soon as it is done.
+  remaining = {}
+  pending = {}
+
+  def write_done(futures):
+    for future in futures:
+      account_id, property_id, table = pending.pop(future)
+      try:
+        records = future.result()
+      except Exception as e:
+        breaker.record(e)
+        summary['errors'] += 1
+        writer.write(ERRORS_TABLE, account_id, {
+            'account_id': account_id,
+            'property_id': property_id,
+            'table': table,
+            'error_class': errors.classify(e).value,
+            'error': str(e),
+        })
+      else:
+        breaker.record(None)
+        for record in records:
+          writer.write(table, account_id, record)
+      remaining[account_id] -= 1
+      if not remaining[account_id]:
+        writer.close_account(account_id)
+    breaker.check()
+
+  def since(account_id):
+    # Snapshots from before the time was kept for each account searched
+    # every account since they started.
+    return previous.get('since_by_account', {}).get(
+        account_id, previous['started'])
+
+  def search_changes(account_id):
+    try:
+      changes = account_changes(ga_client, account_id, since(account_id))
+    except Exception as e:  # pylint: disable=broad-except
+      # The account is listed in full instead.
+      breaker.record(e)
+      print(f'Failed to search the changes of account {account_id}: {e}')
+      return None
+    breaker.record(None)
+    return changes
+
+  def keep(account_id, searched):
+    rows = previous['rows_by_account'][account_id]
+    for table, parts in old_parts[account_id].items():
+      writer.reuse(account_id, table, parts, rows.get(table, 0))
+    summary['properties'] += rows.get(PROPERTIES_TABLE, 0)
+    summary['unchanged'] += 1
+    # An account that was not searched still has to be searched from where
+    # the previous snapshot would have.
+    writer.since_by_account[account_id] = (
+        started if searched else since(account_id))
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers) as executor:
+    accounts = {
+        account.account.split('/')[1]: account
+        for account in bulk_list.list_pages(
+            limiter, ga_client.list_account_summaries, {},
+            'account_summaries')}
+    refreshed = [
+        account_id for account_id in accounts
+        if account_id in old_parts and (not wanted or account_id in wanted)]
+    # The changes of each account, or None to list it in full.
+    changes = dict(zip(refreshed, executor.map(
+        lambda account_id: contextvars.copy_context().run(
+            search_changes, account_id),
+        refreshed)))
+    breaker.check()
+    for account_id, account in accounts.items():
+      if wanted and account_id not in wanted:
+        if account_id in old_parts:
+          keep(account_id, searched=False)
+        continue
+      account_changed = changes.get(account_id)
+      old = {}
+      if account_changed is not None:
+        old = old_parts.get(account_id, {})
+      if old and not account_changed and ERRORS_TABLE not in old:
+        keep(account_id, searched=True)
+        continue
+      summary['accounts'] += 1
+      writer.since_by_account[account_id] = started
+      writer.write(ACCOUNTS_TABLE, account_id, {
+          'account_id': account_id,
+          'account': account.account,
+          'display_name': account.display_name,
+      })
+      # The properties and tables to list again, on top of new properties.
+      relist = set(account_changed or ())
+      relist.update(
+          (record['property_id'], record['table'])
+          for record in writer.read(old.get(ERRORS_TABLE, [])))
+      old_ids = {
+          record['property_id']
+          for record in writer.read(old.get(PROPERTIES_TABLE, []))}
+      property_ids = set()
+      remaining[account_id] = 1
+      for ga_property in bulk_list.list_pages(
+          limiter,
+          ga_client.list_properties,
+          {'filter': f'parent:accounts/{account_id}'},
+          'properties'):
+        property_id = ga_property.name.split('/')[1]
+        property_ids.add(property_id)
+        summary['properties'] += 1
+        writer.write(
+            PROPERTIES_TABLE, account_id,
+            _record(account_id, property_id, ga_property))
+        for table, (method, field) in PROPERTY_TABLES.items():
+          if property_id in old_ids and (property_id, table) not in relist:
+            continue
+          future = executor.submit(
+              contextvars.copy_context().run,
+              list_records, ga_client, account_id, property_id, method,
+              field)
+          pending[future] = (account_id, property_id, table)
+          remaining[account_id] += 1
+          # Only a bounded number of finished lists waits to be written.
+          if len(pending) >= max_workers * 2:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            write_done(done)
+      # The records of the properties that were not listed again are carried
+      # over, by keeping the parts of a table when all of them are.
+      for table in PROPERTY_TABLES:
+        if table not in old:
+          continue
+        if old_ids <= property_ids and not any(
+            (property_id, table) in relist for property_id in old_ids):
+          writer.reuse(
+              account_id, table, old[table],
+              previous['rows_by_account'][account_id].get(table, 0))
+          continue
+        for record in writer.read(old[table]):
+          if (record['property_id'] in property_ids
+              and (record['property_id'], table) not in relist):
+            writer.write(table, account_id, record)
+      # The account itself is done once its properties have been listed.
+      remaining[account_id] -= 1
+      if not remaining[account_id]:
+        writer.close_account(account_id)
+    write_done(list(pending))
+  return summary
+
+
+def account_changes(
+    ga_client: Any, account_id: str, since: float) -> set[tuple[str, str]]:
+  """Returns the resources of an account that changed since a time.
+
+  Args:
+      ga_client: The Admin API client.
+      account_id: The ID of the account.
+      since: The time in seconds since the epoch, such as the time the
+        previous snapshot started.
+
+  Returns:
+      The property ID and table of each changed resource. Changes to the
+      account itself have an empty property ID, and changes to resources
+      that are not in the inventory are left out.
+  """
+  changes = set()
+  for event in bulk_list.list_pages(
+      limiter,
+      ga_client.search_change_history_events,
+      {
+          'account': f'accounts/{account_id}',
+          'earliest_change_time': datetime.datetime.fromtimestamp(
+              since, datetime.timezone.utc),
+      },
+      'change_history_events'):
+    for change in event.changes:
+      kind, resource_id, *path = change.resource.split('/')
+      if kind == 'accounts':
+        changes.add(('', ACCOUNTS_TABLE))
+      elif kind == 'properties' and not path:
+        changes.add((resource_id, PROPERTIES_TABLE))
+      elif kind == 'properties' and path[0].lower() in _COLLECTIONS:
+        changes.add((resource_id, _COLLECTIONS[path[0].lower()]))
+  return changes
+
+
+def list_records(
+    ga_client: Any,
+    account_id: str,
+    property_id: str,
+    method: str,
+    field: str,
+) -> list[dict[str, Any]]:
+  """Lists one type of resource of a property as snapshot records."""
+  return [
+      _record(account_id, property_id, item)
+      for item in bulk_list.list_pages(
+          limiter, getattr(ga_client, method),
+          {'parent': f'properties/{property_id}'}, field)]
+
+
+def _record(account_id: str, property_id: str, item: Any) -> dict[str, Any]:
+  return {
+      'account_id': account_id,
+      'property_id': property_id,
+      **type(item).to_dict(item),
+  }
+
+
+def get_ga_client(
+    client_class: Callable[..., Any] = AnalyticsAdminServiceClient) -> Any:
+  credentials = google.oauth2.credentials.Credentials(
+      None,
+      refresh_token=REFRESH_TOKEN,
+      token_uri=TOKEN_URI,
+      client_id=CLIENT_ID,
+      client_secret=CLIENT_SECRET)
+  with metrics.span('token_refresh'):
+    credentials.refresh(google.auth.transport.requests.Request())
+  return client_class(credentials=credentials)
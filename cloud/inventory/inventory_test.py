@@ -0,0 +1,245 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the inventory crawler."""
+
+import json
+import types
+from unittest import mock
+
+from absl.testing import absltest
+from google.analytics.admin_v1alpha.types import AccountSummary
+from google.analytics.admin_v1alpha.types import ChangeHistoryChange
+from google.analytics.admin_v1alpha.types import ChangeHistoryEvent
+from google.analytics.admin_v1alpha.types import DataStream
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+from google.analytics.admin_v1alpha.types import Property
+from google.api_core import exceptions
+
+from shared import testing
+
+with mock.patch('google.cloud.storage.Client'):
+  import inventory
+
+
+class FakeAdminClient:
+  """Serves one page of items for each list or search method and parent."""
+
+  def __init__(self, items):
+    self._items = items
+    self.calls = []
+    # The time the change history of each account was last searched from.
+    self.since = {}
+
+  def __getattr__(self, method):
+    if not method.startswith(('list_', 'search_')):
+      raise AttributeError(method)
+
+    def list_items(request):
+      key = (
+          request.get('parent') or request.get('filter')
+          or request.get('account'))
+      self.calls.append((method, key))
+      if 'earliest_change_time' in request:
+        self.since[key] = request['earliest_change_time'].timestamp()
+      items = self._items.get((method, key), [])
+      if isinstance(items, Exception):
+        raise items
+      fields = dict(inventory.PROPERTY_TABLES.values())
+      fields['search_change_history_events'] = 'change_history_events'
+      page = types.SimpleNamespace(next_page_token='')
+      setattr(page, fields.get(method, method.removeprefix('list_')), items)
+      return types.SimpleNamespace(pages=iter([page]))
+
+    return list_items
+
+
+def records(bucket, table, account_id, snapshot='1'):
+  prefix = f'inventory/snapshot={snapshot}/{table}/account={account_id}/'
+  return [
+      json.loads(line)
+      for name, data in sorted(bucket.objects.items())
+      if name.startswith(prefix)
+      for line in data.splitlines()]
+
+
+def change(resource):
+  return ChangeHistoryEvent(changes=[ChangeHistoryChange(resource=resource)])
+
+
+class InventoryTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(mock.patch.object(
+        inventory, 'limiter',
+        inventory.rate_limiter.AdaptiveRateLimiter(rate=1000, max_rate=1000)))
+    self.bucket = testing.FakeBucket()
+    self.writer = inventory.SnapshotWriter(self.bucket, '1', 'ndjson')
+    self.ga_client = FakeAdminClient({
+        ('list_account_summaries', None): [
+            AccountSummary(account='accounts/10', display_name='Ten'),
+            AccountSummary(account='accounts/20', display_name='Twenty'),
+        ],
+        ('list_properties', 'parent:accounts/10'): [
+            Property(name='properties/1', display_name='One'),
+            Property(name='properties/2', display_name='Two'),
+        ],
+        ('list_properties', 'parent:accounts/20'): [
+            Property(name='properties/3', display_name='Three'),
+        ],
+        ('list_data_streams', 'properties/1'): [
+            DataStream(name='properties/1/dataStreams/5',
+                       web_stream_data={'default_uri': 'https://a'}),
+        ],
+        ('list_google_ads_links', 'properties/3'): [
+            GoogleAdsLink(name='properties/3/googleAdsLinks/7',
+                          customer_id='111'),
+        ],
+        ('list_custom_metrics', 'properties/2'): exceptions.PermissionDenied(
+            'no access'),
+    })
+
+  def test_crawl_writes_tables_partitioned_by_account(self):
+    summary = inventory.crawl(self.ga_client, self.writer, max_workers=4)
+    manifest = self.writer.close(summary)
+    self.assertEqual(
+        {'accounts': 2, 'properties': 3, 'errors': 1}, summary)
+    self.assertEqual(
+        ['1', '2'],
+        [r['property_id'] for r in records(self.bucket, 'properties', '10')])
+    streams = records(self.bucket, 'data_streams', '10')
+    self.assertEqual('properties/1/dataStreams/5', streams[0]['name'])
+    self.assertEqual(
+        'https://a', json.loads(streams[0]['web_stream_data'])['default_uri'])
+    links = records(self.bucket, 'ads_links', '20')
+    self.assertEqual(
+        [('20', '3', '111')],
+        [(r['account_id'], r['property_id'], r['customer_id'])
+         for r in links])
+    self.assertEqual(
+        [('2', 'custom_metrics', 'permission')],
+        [(r['property_id'], r['table'], r['error_class'])
+         for r in records(self.bucket, 'errors', '10')])
+    self.assertEqual(
+        ['inventory/snapshot=1/ads_links/account=20/part-000000000.ndjson'],
+        manifest['parts']['20']['ads_links'])
+    self.assertEqual(
+        manifest, json.loads(self.bucket.objects['inventory/latest.json']))
+    # Every resource of every property is listed once.
+    self.assertLen(
+        [call for call in self.ga_client.calls
+         if call[1] == 'properties/1'],
+        len(inventory.PROPERTY_TABLES))
+
+  def test_crawl_only_lists_requested_accounts(self):
+    summary = inventory.crawl(self.ga_client, self.writer, ['20'])
+    self.assertEqual(1, summary['accounts'])
+    self.assertNotIn(
+        ('list_properties', 'parent:accounts/10'), self.ga_client.calls)
+
+  def test_crawl_stops_when_lists_keep_failing_to_authenticate(self):
+    ga_client = FakeAdminClient({
+        ('list_account_summaries', None): [
+            AccountSummary(account='accounts/10')],
+        ('list_properties', 'parent:accounts/10'): [
+            Property(name=f'properties/{i}') for i in range(50)],
+    })
+    ga_client._items.update({
+        (method, f'properties/{i}'): exceptions.Unauthenticated('revoked')
+        for method, _ in inventory.PROPERTY_TABLES.values()
+        for i in range(50)})
+    self.enter_context(
+        mock.patch.object(inventory.circuit_breaker, 'THRESHOLD', 3))
+    with self.assertRaises(inventory.circuit_breaker.CircuitOpenError):
+      inventory.crawl(ga_client, self.writer, max_workers=2)
+    self.assertLess(len(ga_client.calls), 50)
+
+  def test_refresh_only_lists_changed_resources(self):
+    previous = self.writer.close(
+        inventory.crawl(self.ga_client, self.writer) | {'started': 100.0})
+    self.ga_client._items.update({
+        ('search_change_history_events', 'accounts/10'): [
+            change('properties/1/dataStreams/5'),
+            change('properties/1/conversionEvents/9'),
+        ],
+        ('list_data_streams', 'properties/1'): [
+            DataStream(name='properties/1/dataStreams/5', display_name='New'),
+        ],
+        ('list_custom_metrics', 'properties/2'): [],
+    })
+    self.ga_client.calls = []
+    writer = inventory.SnapshotWriter(self.bucket, '2', 'ndjson')
+    summary = inventory.crawl(self.ga_client, writer, previous=previous)
+    manifest = writer.close(summary)
+    self.assertEqual(
+        {'accounts': 1, 'properties': 3, 'errors': 0, 'unchanged': 1},
+        summary)
+    self.assertCountEqual([
+        ('list_account_summaries', None),
+        ('search_change_history_events', 'accounts/10'),
+        ('search_change_history_events', 'accounts/20'),
+        ('list_properties', 'parent:accounts/10'),
+        ('list_data_streams', 'properties/1'),
+        # The list that failed before is listed again.
+        ('list_custom_metrics', 'properties/2'),
+    ], self.ga_client.calls)
+    self.assertEqual(
+        ['New'],
+        [r['display_name']
+         for r in records(self.bucket, 'data_streams', '10', '2')])
+    # The unchanged account keeps the parts of the previous snapshot.
+    self.assertEqual(previous['parts']['20'], manifest['parts']['20'])
+    self.assertEqual(1, manifest['rows']['ads_links'])
+    self.assertNotIn('errors', manifest['parts']['10'])
+
+  def test_accounts_left_out_keep_searching_from_their_last_crawl(self):
+    previous = self.writer.close(
+        inventory.crawl(self.ga_client, self.writer, started=100.0)
+        | {'started': 100.0})
+    self.assertEqual({'10': 100.0, '20': 100.0}, previous['since_by_account'])
+    writer = inventory.SnapshotWriter(self.bucket, '2', 'ndjson')
+    previous = writer.close(inventory.crawl(
+        self.ga_client, writer, ['10'], previous=previous, started=200.0)
+        | {'started': 200.0})
+    self.assertEqual({'accounts/10': 100.0}, self.ga_client.since)
+    # Account 20 was kept without searching its changes since 100.
+    self.assertEqual({'10': 200.0, '20': 100.0}, previous['since_by_account'])
+    writer = inventory.SnapshotWriter(self.bucket, '3', 'ndjson')
+    writer.close(inventory.crawl(
+        self.ga_client, writer, previous=previous, started=300.0))
+    self.assertEqual(
+        {'accounts/10': 200.0, 'accounts/20': 100.0}, self.ga_client.since)
+    self.assertEqual({'10': 300.0, '20': 300.0}, writer.since_by_account)
+
+  def test_account_changes_maps_resources_to_tables(self):
+    self.ga_client._items[('search_change_history_events', 'accounts/10')] = [
+        change('accounts/10'),
+        change('properties/1'),
+        change('properties/1/customDimensions/2'),
+        change('properties/3/adSenseLinks/4'),
+        change('properties/3/displayVideo360AdvertiserLinkProposals/5'),
+        change('properties/3/dataRetentionSettings'),
+    ]
+    self.assertEqual({
+        ('', 'accounts'),
+        ('1', 'properties'),
+        ('1', 'custom_dimensions'),
+        ('3', 'adsense_links'),
+        ('3', 'dv360_link_proposals'),
+    }, inventory.account_changes(self.ga_client, '10', 100.0))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -12,17 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import datetime
 import functions_framework
+import itertools
 import os
-import io
+import threading
 import time
-import pandas
+import google.auth.transport.requests
 import google.oauth2.credentials
+from google.analytics.admin import AnalyticsAdminServiceAsyncClient
 from google.analytics.admin import AnalyticsAdminServiceClient
-from google.analytics.admin_v1alpha.types import GoogleAdsLink
-from google.analytics.admin_v1alpha.types import DisplayVideo360AdvertiserLink
-from google.analytics.admin_v1alpha.types import DisplayVideo360AdvertiserLinkProposal
 from google.cloud import storage
+from shared import checkpoint
+from shared import circuit_breaker
+from shared import errors
+from shared import link_index
+from shared import link_resources
+from shared import metrics
+from shared import rate_limiter
+from shared import results_writer
+from shared import validation
 
 storage_client = storage.Client()
 
@@ -32,117 +45,540 @@ CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
 ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
 REFRESH_TOKEN = os.environ.get('REFRESH_TOKEN')
 TOKEN_URI = os.environ.get('TOKEN_URI')
-REQUEST_DELAY = .2
+# The journals that track progress through each input file are saved here.
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET') or OUTPUT_BUCKET
+# Number of rows processed between saves of the checkpoint journal. The
+# results of those rows are written to a new part file at the same time.
+CHECKPOINT_INTERVAL = int(os.environ.get('CHECKPOINT_INTERVAL', 500))
+# The format of the results part files: csv, ndjson or parquet.
+RESULTS_FORMAT = os.environ.get('RESULTS_FORMAT', 'csv')
+# Set to slightly less than 1 hour so that the function can trigger
+# another run of itself if it is close to timing out.
+TIMEOUT = 3500
+# Number of rows that are sent to the Admin API at the same time. Every
+# worker shares the same client and the same rate limiter, so the pool size
+# bounds the requests in flight while the limiter bounds the request rate.
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 1))
+# Number of rows per worker that may be queued ahead of the oldest
+# unfinished row, so that workers can move on to other properties while the
+# rows for one property are processed one at a time.
+LOOKAHEAD = int(os.environ.get('LOOKAHEAD', 10))
+# Set to true to send the requests from an asyncio event loop with the async
+# Admin API client instead of from a pool of worker threads.
+ASYNC_ENGINE = os.environ.get('ASYNC_ENGINE', 'false').lower() == 'true'
+# Number of Admin API requests the async engine keeps in flight at once.
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 100))
+
+# The result written for each row, depending on what the link index decided.
+RESULTS = {
+    link_index.Resolution.CREATE: 'created',
+    link_index.Resolution.UPDATE: 'updated',
+    link_index.Resolution.SKIP: 'exists',
+}
+
+# The columns of the input file that hold the link fields of each request
+# type, where they are named differently.
+COLUMNS = {
+    'ads': {'customer_id': 'ads_customer_id'},
+    'dv360': {
+        'advertiser_id': 'dv360_advertiser_id',
+        'campaign_data_sharing_enabled': 'dv360_campaign_data_sharing_enabled',
+        'cost_data_sharing_enabled': 'dv360_cost_data_sharing_enabled',
+    },
+    'dv360_link_proposal': {
+        'advertiser_id': 'dv360_advertiser_id',
+        'campaign_data_sharing_enabled': 'dv360_campaign_data_sharing_enabled',
+        'cost_data_sharing_enabled': 'dv360_cost_data_sharing_enabled',
+        'validation_email': 'dv360_proposal_validation_email',
+    },
+}
+# The type written to the results file for each request type, if it differs.
+REQUEST_TYPES = {'dv360_link_proposal': 'dv360 link proposal'}
+# The checks each row must pass before any request is sent, keyed by request
+# type.
+SCHEMAS = {
+    request_type: validation.link_schema(
+        link_resources.get(request_type),
+        COLUMNS.get(request_type, {}),
+        'ga4_property_id')
+    for request_type in (*link_resources.ALIASES, *link_resources.LINK_TYPES)
+}
+# A file with more rejected rows than this is not processed at all. Rejected
+# rows are only skipped if it is not set.
+MAX_REJECTED_ROWS = os.environ.get('MAX_REJECTED_ROWS')
+
+limiter = rate_limiter.AdaptiveRateLimiter.from_env()
 
 
 @functions_framework.cloud_event
+@metrics.instrumented('linker')
 def main(cloud_event):
     start_time = time.time()
-    data = cloud_event.data
-    ga_client = get_ga_client()
-    bucket = data['bucket']
-    name = data['name']
-    file_name = 'gs://' + bucket + '/' + name
-    df = pandas.read_csv(file_name, on_bad_lines='skip')
-    records = df.to_dict('records')
-    print(records)
-    responses = []
-    for index, row in enumerate(records):
-        if time.time() - start_time < 348000000:
-            if row['request_type'] == 'ads':
-                try:
-                    customer_id = str(row['ads_customer_id'])
-                    parent = f"properties/{row['ga4_property_id']}"
-                    response = ga_client.create_google_ads_link(
-                        parent=parent,
-                        google_ads_link=GoogleAdsLink(
-                            customer_id=customer_id,
-                            ads_personalization_enabled=row['ads_personalization_enabled']))
-                    responses.append({
-                        'ga_propety_id': row['ga4_property_id'],
-                        'platform_id': customer_id,
-                        'type': 'ads',
-                        'link_resource_name': response.name,
-                        'result': 'created'})
-                except Exception as e:
-                    responses.append({
-                        'ga_propety_id': row['ga4_property_id'],
-                        'platform_id': customer_id,
-                        'type': 'ads',
-                        'link_resource_name': 'n/a',
-                        'result': e})
-                time.sleep(REQUEST_DELAY)
-            if row['request_type'] == 'dv360':
-                try:
-                    advertiser_id = str(row['dv360_advertiser_id'])
-                    parent = f"properties/{row['ga4_property_id']}"
-                    dv360_link = DisplayVideo360AdvertiserLink(
-                        advertiser_id=advertiser_id,
-                        ads_personalization_enabled = row['ads_personalization_enabled'],
-                        campaign_data_sharing_enabled = row['dv360_campaign_data_sharing_enabled'],
-                        cost_data_sharing_enabled = row['dv360_cost_data_sharing_enabled'])
-                    response = ga_client.create_display_video360_advertiser_link(
-                        parent=parent,
-                        display_video360_advertiser_link=dv360_link)
-                    responses.append({
-                        'ga_propety_id': row['ga4_property_id'],
-                        'platform_id': advertiser_id,
-                        'type': 'dv360',
-                        'link_resource_name': response.name,
-                        'result': 'created'})
-                except Exception as e:
-                    responses.append({
-                        'ga_propety_id': row['ga4_property_id'],
-                        'platform_id': advertiers_id,
-                        'type': 'dv360',
-                        'link_resource_name': 'n/a',
-                        'result': e})
-                time.sleep(REQUEST_DELAY)
-            if row['request_type'] == 'dv360_link_proposal':
-                try:
-                    advertiser_id = str(row['dv360_advertiser_id'])
-                    parent = f"properties/{row['ga4_property_id']}"
-                    dv360_link_proposal = DisplayVideo360AdvertiserLinkProposal(
-                        advertiser_id=advertiser_id,
-                        ads_personalization_enabled = row['ads_personalization_enabled'],
-                        campaign_data_sharing_enabled = row['dv360_campaign_data_sharing_enabled'],
-                        cost_data_sharing_enabled = row['dv360_cost_data_sharing_enabled'],
-                        validation_email = row['dv360_proposal_validation_email'])
-                    response = ga_client.create_display_video360_advertiser_link(
-                        parent=parent,
-                        display_video360_advertiser_link_proposal=dv360_link_proposal)
-                    responses.append({
-                        'ga_propety_id': row['ga4_property_id'],
-                        'platform_id': advertiser_id,
-                        'type': 'dv360 link proposal',
-                        'link_resource_name': response.name,
-                        'result': 'created'})
-                except Exception as e:
-                    responses.append({
-                        'ga_propety_id': row['ga4_property_id'],
-                        'platform_id': advertiers_id,
-                        'type': 'dv360 link proposal',
-                        'link_resource_name': 'n/a',
-                        'result': e})
-                time.sleep(REQUEST_DELAY)
+    # Retry parts are uploaded with the time their rows are due as their
+    # custom time. Until then the run fails, and the retry policy of the
+    # function delivers the storage event again later.
+    errors.check_due(due_time(cloud_event.data))
+    store = checkpoint.CheckpointStore(storage_client, CHECKPOINT_BUCKET)
+    job = store.resolve(cloud_event.data)
+    if job is None:
+        return
+    if not job.validated and not check_input(store, job):
+        return
+    # Rows before the checkpoint offset were processed by an earlier run.
+    records = itertools.islice(
+        validation.validated_records(
+            store.open_source(job), SCHEMAS, 'request_type'),
+        job.offset,
+        None)
+    # Existing links are listed at most once per property for the whole run.
+    indexes = link_resources.new_indexes()
+    # Results are written next to each other under a prefix for the input
+    # file, one part per checkpoint, so they survive a timeout or crash.
+    results = results_writer.ResultsWriter(
+        storage_client.bucket(OUTPUT_BUCKET),
+        f'results/{job.name}/{job.generation}/',
+        RESULTS_FORMAT,
+        offset=job.offset)
+    # Rows that failed with an error worth retrying are written back to the
+    # input bucket as CSV, which runs the function again on just those rows
+    # once the last of them is due. Rows that failed for good are written to
+    # a dead letter report instead. Both are named after the input row their
+    # part starts at, like the results.
+    retries = results_writer.ResultsWriter(
+        storage_client.bucket(job.bucket),
+        f'{checkpoint.RETRIES_PREFIX}{job.name}/{job.generation}/')
+    dead_letters = results_writer.ResultsWriter(
+        storage_client.bucket(OUTPUT_BUCKET),
+        f'{errors.DEAD_LETTER_PREFIX}{job.name}/{job.generation}/',
+        RESULTS_FORMAT)
+    part_offset = job.offset
+    # The time the last retry in the current part is due.
+    retry_due = None
+    # Opens once rows keep failing to authenticate, since every other row
+    # would fail the same way.
+    breaker = circuit_breaker.CircuitBreaker()
+
+    def collect(row, response):
+        """Records the outcome of the next row.
+
+        Returns:
+            True if the checkpoint journal should be saved.
+
+        Raises:
+            CircuitOpenError: If the row failed to authenticate after too
+                many others did. The row is left for the resumed run.
+        """
+        nonlocal retry_due
+        result = response['result']
+        if isinstance(result, Exception):
+            breaker.record(result)
+            breaker.check()
+        elif result in RESULTS.values():
+            breaker.record(None)
+        status = result if result in RESULTS.values() else 'failed'
+        response['error_class'] = ''
+        if isinstance(result, str) and result.startswith(
+                (validation.REJECTED, validation.DUPLICATE)):
+            status = result.split(':')[0]
+        elif isinstance(result, Exception):
+            record, retry = errors.failure_record(row, result)
+            response['error_class'] = record[errors.ERROR_CLASS_KEY]
+            if retry:
+                status = 'retried'
+                retries.write(record)
+                retry_due = max(
+                    retry_due or 0, record[errors.RETRY_AFTER_KEY])
+            else:
+                dead_letters.write(record)
+        results.write(response)
+        job.record(status)
+        metrics.count(f'rows.{status}')
+        return job.offset % CHECKPOINT_INTERVAL == 0
+
+    def flush():
+        nonlocal part_offset, retry_due
+        results.flush()
+        if retry_due is not None:
+            retries.flush(part_offset, datetime.datetime.fromtimestamp(
+                retry_due, datetime.timezone.utc))
+            retry_due = None
+        dead_letters.flush(part_offset)
+        part_offset = job.offset
+
+    def save():
+        # The results are written first so that the journal never counts
+        # rows whose results could still be lost.
+        flush()
+        store.save(job)
+
+    try:
+        if ASYNC_ENGINE:
+            timed_out = asyncio.run(
+                run_async(records, indexes, collect, save, start_time))
         else:
-            current_row = index + 1
-            remaining = df.iloc[current_row:,:]
-            remaining_csv = pandas.DataFrame(remaining).to_csv()
-            remaining_blob = storage_client.get_bucket(bucket).blob(f'remaining-{time.time()}.csv')
-            remaining_blob.upload_from_string(remaining_csv, content_type='text/csv')
-            break;
-    csv_str = pandas.DataFrame(responses).to_csv()
-    output_bucket_blob = storage_client.get_bucket(OUTPUT_BUCKET).blob(f'results-{time.time()}.csv')
-    output_bucket_blob.upload_from_string(csv_str, content_type='text/csv')
+            timed_out = run_threads(
+                records, indexes, collect, save, start_time)
+    except Exception as e:
+        if not circuit_breaker.is_auth_failure(e):
+            raise
+        # The file is not continued, so that a revoked token does not fail
+        # every remaining row, and resumes from the same row once the
+        # credentials have been fixed.
+        flush()
+        name = store.halt(job, str(e))
+        print(
+            f'Halted {job.name} at row {job.offset}: {e}. Copy '
+            f'gs://{CHECKPOINT_BUCKET}/{name} to gs://{job.bucket}/ to '
+            'resume it.')
+        return
+    flush()
+    if timed_out:
+        store.request_continuation(job)
+    else:
+        job.done = True
+        store.save(job)
+
+
+def due_time(event_data):
+    """Returns when the object of a storage event is due, if it has a time.
+
+    Args:
+        event_data: The data of the Cloud Storage event.
+
+    Returns:
+        The custom time of the object in seconds since the epoch, or None if
+        it has none.
+    """
+    custom_time = event_data.get('customTime')
+    if not custom_time:
+        return None
+    return datetime.datetime.fromisoformat(
+        custom_time.replace('Z', '+00:00')).timestamp()
+
+
+def check_input(store, job):
+    """Checks every row of the input file before the first row is processed.
+
+    The rows that will not be processed are written to a rejects file next to
+    the results, so that they can be fixed and uploaded again.
+
+    Args:
+        store: The checkpoint store of the job.
+        job: The checkpoint of the input file.
+
+    Returns:
+        True if the file should be processed, or False if it has more
+        rejected rows than MAX_REJECTED_ROWS.
+    """
+    bucket = storage_client.bucket(OUTPUT_BUCKET)
+    rejects_name = (
+        f'{checkpoint.REJECTS_PREFIX}{job.name}/{job.generation}.csv')
+    report = validation.check_file(
+        store.open_source(job),
+        SCHEMAS,
+        lambda: bucket.blob(rejects_name).open('w'),
+        'request_type')
+    if report.rejected or report.duplicates:
+        print(
+            f'{report.rejected} of {report.rows} rows rejected and '
+            f'{report.duplicates} coalesced, see gs://{OUTPUT_BUCKET}/'
+            f'{rejects_name}: {report.reasons}')
+    job.validated = True
+    if (MAX_REJECTED_ROWS is not None
+            and report.rejected > int(MAX_REJECTED_ROWS)):
+        print(f'Not processing {job.name}, too many rejected rows')
+        job.done = True
+    store.save(job)
+    return not job.done
+
+
+def run_threads(records, indexes, collect, save, start_time):
+    """Processes the rows on a pool of worker threads.
+
+    Args:
+        records: The rows of the input file that are left to process.
+        indexes: The link indexes for the job, keyed by request type.
+        collect: Called with each row and its outcome in input order.
+        save: Saves the checkpoint journal.
+        start_time: The time the function was invoked.
+
+    Returns:
+        True if the function ran out of time before every row was processed.
+    """
+    ga_client = get_ga_client()
+    # Futures are collected in submission order so that the results file
+    # matches the order of the input file regardless of which worker
+    # finishes first. Only a bounded number of rows is in flight at once.
+    pending = collections.deque()
+    timed_out = False
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_WORKERS) as executor:
+        lanes = PropertyLanes(
+            executor, lambda row: create_link(ga_client, indexes, row))
+        for row in records:
+            if time.time() - start_time >= TIMEOUT:
+                timed_out = True
+                break
+            pending.append(
+                (row, lanes.submit(row.get('ga4_property_id'), row)))
+            if len(pending) >= MAX_WORKERS * LOOKAHEAD:
+                if collect_next(pending, collect):
+                    save()
+        while pending:
+            if collect_next(pending, collect):
+                save()
+    return timed_out
+
+
+def collect_next(pending, collect):
+    """Collects the oldest row submitted to the worker threads."""
+    row, future = pending.popleft()
+    return collect(row, future.result())
+
+
+async def run_async(records, indexes, collect, save, start_time):
+    """Processes the rows as tasks on the running event loop.
+
+    Up to MAX_IN_FLIGHT requests wait on the network at the same time
+    without a thread for each of them. Reading the input file and saving the
+    checkpoint journal block on Cloud Storage, so they run on a worker
+    thread while the requests already in flight carry on.
+
+    Args:
+        records: The rows of the input file that are left to process.
+        indexes: The link indexes for the job, keyed by request type.
+        collect: Called with each row and its outcome in input order.
+        save: Saves the checkpoint journal.
+        start_time: The time the function was invoked.
+
+    Returns:
+        True if the function ran out of time before every row was processed.
+    """
+    ga_client = get_ga_client(AnalyticsAdminServiceAsyncClient)
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    # The locks are acquired in the order the tasks were created, so the
+    # rows for each property are still processed one at a time and in order.
+    lanes = collections.defaultdict(asyncio.Lock)
+
+    def out_of_time():
+        return time.time() - start_time >= TIMEOUT
+
+    async def process(row):
+        async with lanes[row.get('ga4_property_id')]:
+            async with in_flight:
+                # Rows still waiting for their turn when the time is up are
+                # left for the next run instead of delaying the checkpoint.
+                if out_of_time():
+                    return None
+                return await create_link_async(ga_client, indexes, row)
+
+    pending = collections.deque()
+    timed_out = False
+
+    async def collect_next():
+        nonlocal timed_out
+        row, task = pending.popleft()
+        response = await task
+        # The journal only records a contiguous prefix of the input file, so
+        # once a row has been left for the next run the rows after it are
+        # too. The link index lets the next run skip any of them that were
+        # created in the meantime.
+        if response is None or timed_out:
+            timed_out = True
+            return
+        if collect(row, response):
+            await asyncio.to_thread(save)
+
+    try:
+        while not timed_out:
+            rows = await asyncio.to_thread(
+                list, itertools.islice(records, MAX_IN_FLIGHT))
+            if not rows:
+                break
+            for row in rows:
+                if out_of_time():
+                    timed_out = True
+                    break
+                pending.append((row, asyncio.create_task(process(row))))
+                if len(pending) >= MAX_IN_FLIGHT * LOOKAHEAD:
+                    await collect_next()
+        while pending:
+            await collect_next()
+    finally:
+        # The gRPC channel belongs to this event loop, which is closed when
+        # the run ends.
+        await ga_client.transport.close()
+    return timed_out
+
+
+class PropertyLanes:
+    """Runs rows for different properties in parallel and rows for the same
+    property one at a time, in the order they were submitted.
+
+    Concurrent writes to the same property can conflict with each other, and
+    keeping a property on a single worker lets its rows share the listing in
+    the link index.
+    """
+
+    def __init__(self, executor, func):
+        """Initializes the lanes.
+
+        Args:
+            executor: The executor that runs one task per busy property.
+            func: Called with each submitted row.
+        """
+        self._executor = executor
+        self._func = func
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, row):
+        """Queues a row behind the other rows for the same property.
+
+        Args:
+            key: The property the row belongs to.
+            row: The row passed to func.
+
+        Returns:
+            A future for the value returned by func.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append((row, future))
+                return future
+            lane = collections.deque([(row, future)])
+            self._lanes[key] = lane
+        # The worker records into the metrics of the invocation that
+        # submitted the row.
+        self._executor.submit(
+            contextvars.copy_context().run, self._drain, key, lane)
+        return future
+
+    def _drain(self, key, lane):
+        while True:
+            with self._lock:
+                if not lane:
+                    del self._lanes[key]
+                    return
+                row, future = lane.popleft()
+            try:
+                future.set_result(self._func(row))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def create_link(ga_client, indexes, row):
+    """Creates the link described by a single row of the input file.
+
+    Args:
+        ga_client: The Google Analytics Admin API client shared by all workers.
+        indexes: The link indexes for the job, keyed by link type.
+        row: A dictionary with the values from one row of the input file.
+
+    Returns:
+        A dictionary describing the outcome that is written to the results file.
+    """
+    start = time.perf_counter()
+    result = link_resources.drive(link_steps(indexes, row), ga_client, limiter)
+    metrics.observe('row_latency', time.perf_counter() - start)
+    return result
+
+
+async def create_link_async(ga_client, indexes, row):
+    """Creates the link described by a single row with the async client.
+
+    Args:
+        ga_client: The async Google Analytics Admin API client.
+        indexes: The link indexes for the job, keyed by link type.
+        row: A dictionary with the values from one row of the input file.
+
+    Returns:
+        A dictionary describing the outcome that is written to the results file.
+    """
+    start = time.perf_counter()
+    result = await link_resources.drive_async(
+        link_steps(indexes, row), ga_client, limiter)
+    metrics.observe('row_latency', time.perf_counter() - start)
+    return result
+
+
+def link_steps(indexes, row):
+    """Works out the Admin API requests needed for a single row.
+
+    The row's columns are renamed to the fields of its link type, and the
+    link is then created, updated or skipped by
+    link_resources.create_steps, whose requests this generator yields.
+
+    Args:
+        indexes: The link indexes for the job, keyed by link type.
+        row: A dictionary with the values from one row of the input file.
 
+    Returns:
+        A dictionary describing the outcome that is written to the results file.
+    """
+    request_type = row.get('request_type')
+    platform_id = 'n/a'
+    link_type = REQUEST_TYPES.get(request_type, request_type)
+    reason = row.get(validation.REJECTED_KEY)
+    if reason:
+        # Rejected rows are recorded without sending any request.
+        status = validation.status(reason)
+        return {
+            'ga_propety_id': row.get('ga4_property_id'),
+            'platform_id': platform_id,
+            'type': link_type,
+            'link_resource_name': 'n/a',
+            'result': (
+                status if status == validation.DUPLICATE
+                else f'{status}: {reason}')}
+    try:
+        resource = link_resources.get(request_type)
+    except ValueError:
+        return {
+            'ga_propety_id': row['ga4_property_id'],
+            'platform_id': platform_id,
+            'type': request_type,
+            'link_resource_name': 'n/a',
+            'result': f'Unknown request type: {request_type}'}
+    try:
+        # Link types without columns of their own are read from columns
+        # named after the link fields.
+        columns = COLUMNS.get(request_type, {})
+        values = {
+            field: row[columns.get(field, field)]
+            for field in (resource.id_field, *resource.settings)
+            if columns.get(field, field) in row}
+        platform_id = str(values[resource.id_field])
+        decision, response = yield from link_resources.create_steps(
+            request_type, indexes, row['ga4_property_id'], values)
+        result = {
+            'ga_propety_id': row['ga4_property_id'],
+            'platform_id': platform_id,
+            'type': link_type,
+            'link_resource_name': response.name,
+            'result': RESULTS[decision.resolution]}
+    except Exception as e:
+        result = {
+            'ga_propety_id': row['ga4_property_id'],
+            'platform_id': platform_id,
+            'type': link_type,
+            'link_resource_name': 'n/a',
+            'result': e}
+    return result
 
 
-def get_ga_client():
+def get_ga_client(client_class=AnalyticsAdminServiceClient):
     credentials = google.oauth2.credentials.Credentials(
         ACCESS_TOKEN,
         refresh_token=REFRESH_TOKEN,
         token_uri=TOKEN_URI,
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET)
-    return AnalyticsAdminServiceClient(credentials=credentials)
+    # Refreshing up front keeps the token request out of the first row's
+    # latency and shows up as its own stage in the metrics.
+    if not credentials.valid:
+        with metrics.span('token_refresh'):
+            credentials.refresh(google.auth.transport.requests.Request())
+    return client_class(credentials=credentials)
@@ -0,0 +1,347 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the linker cloud function."""
+
+import asyncio
+import io
+import json
+import threading
+import time
+from unittest import mock
+
+from absl.testing import absltest
+from google.api_core import exceptions
+from google.analytics.admin_v1alpha.types import DisplayVideo360AdvertiserLink
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+
+from shared import testing
+
+with mock.patch('google.cloud.storage.Client'):
+  import main
+
+
+class FakeAsyncPager:
+
+  def __init__(self, links):
+    self._links = list(links)
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if not self._links:
+      raise StopAsyncIteration
+    return self._links.pop(0)
+
+
+class FakeAsyncClient:
+  """Records the order of the calls and creates every requested link."""
+
+  def __init__(self, existing=()):
+    self.calls = []
+    self.transport = mock.Mock(close=mock.AsyncMock())
+    self._existing = existing
+
+  async def list_google_ads_links(self, parent):
+    self.calls.append(('list', parent))
+    await asyncio.sleep(0)
+    return FakeAsyncPager(
+        link for link in self._existing if link.name.startswith(parent))
+
+  async def create_google_ads_link(self, parent, google_ads_link):
+    self.calls.append(('create', parent, google_ads_link.customer_id))
+    await asyncio.sleep(0)
+    return GoogleAdsLink(
+        name=f'{parent}/googleAdsLinks/{google_ads_link.customer_id}',
+        customer_id=google_ads_link.customer_id)
+
+
+def ads_row(property_id, customer_id):
+  return {
+      'request_type': 'ads',
+      'ga4_property_id': property_id,
+      'ads_customer_id': customer_id,
+      'ads_personalization_enabled': True,
+  }
+
+
+class LinkerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(LinkerTest, self).setUp()
+    self.indexes = main.link_resources.new_indexes()
+    self.enter_context(mock.patch.object(
+        main, 'limiter', main.rate_limiter.AdaptiveRateLimiter(rate=1000)))
+
+  def test_create_link_creates_missing_link(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.return_value = []
+    ga_client.create_google_ads_link.return_value = GoogleAdsLink(
+        name='properties/1/googleAdsLinks/a', customer_id='111')
+    response = main.create_link(ga_client, self.indexes, ads_row(1, 111))
+    self.assertEqual('created', response['result'])
+    self.assertEqual(
+        'properties/1/googleAdsLinks/a', response['link_resource_name'])
+
+  def test_create_link_skips_existing_link(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.return_value = [GoogleAdsLink(
+        name='properties/1/googleAdsLinks/a',
+        customer_id='111',
+        ads_personalization_enabled=True)]
+    response = main.create_link(ga_client, self.indexes, ads_row(1, 111))
+    self.assertEqual('exists', response['result'])
+    ga_client.create_google_ads_link.assert_not_called()
+
+  def test_create_link_reports_errors(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.side_effect = exceptions.PermissionDenied(
+        'denied')
+    response = main.create_link(ga_client, self.indexes, ads_row(1, 111))
+    self.assertIsInstance(response['result'], exceptions.PermissionDenied)
+
+  def test_create_link_maps_dv360_columns_to_link_fields(self):
+    ga_client = mock.Mock()
+    ga_client.list_display_video360_advertiser_links.return_value = []
+    ga_client.create_display_video360_advertiser_link.return_value = (
+        DisplayVideo360AdvertiserLink(
+            name='properties/1/displayVideo360AdvertiserLinks/a'))
+    row = {
+        'request_type': 'dv360',
+        'ga4_property_id': 1,
+        'dv360_advertiser_id': 222,
+        'ads_personalization_enabled': True,
+        'dv360_campaign_data_sharing_enabled': False,
+        'dv360_cost_data_sharing_enabled': True,
+    }
+    response = main.create_link(ga_client, self.indexes, row)
+    self.assertEqual('created', response['result'])
+    self.assertEqual('dv360', response['type'])
+    ga_client.create_display_video360_advertiser_link.assert_called_once_with(
+        parent='properties/1',
+        display_video_360_advertiser_link=DisplayVideo360AdvertiserLink(
+            advertiser_id='222',
+            ads_personalization_enabled=True,
+            campaign_data_sharing_enabled=False,
+            cost_data_sharing_enabled=True))
+
+  def test_create_link_records_rejected_row_without_requests(self):
+    ga_client = mock.Mock()
+    row = ads_row('1', 'abc')
+    row[main.validation.REJECTED_KEY] = 'invalid ads_customer_id'
+    response = main.create_link(ga_client, self.indexes, row)
+    self.assertEqual(
+        'rejected: invalid ads_customer_id', response['result'])
+    ga_client.list_google_ads_links.assert_not_called()
+    ga_client.create_google_ads_link.assert_not_called()
+
+  def test_check_input_stops_file_with_too_many_rejected_rows(self):
+    store = mock.Mock()
+    store.open_source.return_value = io.BytesIO(
+        b'ga4_property_id,request_type,ads_customer_id\n'
+        b'1,ads,123\n'
+        b'1,ads,abc\n')
+    job = main.checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    self.enter_context(mock.patch.object(main, 'MAX_REJECTED_ROWS', '0'))
+    storage_client = self.enter_context(
+        mock.patch.object(main, 'storage_client'))
+    storage_client.bucket().blob().open.return_value = io.StringIO()
+    self.assertFalse(main.check_input(store, job))
+    self.assertTrue(job.validated)
+    self.assertTrue(job.done)
+    store.save.assert_called_once_with(job)
+    storage_client.bucket().blob.assert_called_with(
+        'rejects/links.csv/7.csv')
+
+  def test_main_halts_job_once_rows_keep_failing_to_authenticate(self):
+    store = mock.Mock()
+    job = main.checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7, validated=True)
+    store.resolve.return_value = job
+    store.open_source.return_value = io.BytesIO(
+        b'ga4_property_id,request_type,ads_customer_id\n'
+        b'1,ads,111\n2,ads,222\n3,ads,333\n4,ads,444\n')
+    store.halt.return_value = 'checkpoints/input/links.csv/7.halted.json'
+    self.enter_context(mock.patch.object(
+        main.checkpoint, 'CheckpointStore', return_value=store))
+    self.enter_context(mock.patch.object(main, 'storage_client'))
+    self.enter_context(
+        mock.patch.object(main.circuit_breaker, 'THRESHOLD', 2))
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.side_effect = (
+        exceptions.Unauthenticated('token revoked'))
+    self.enter_context(
+        mock.patch.object(main, 'get_ga_client', return_value=ga_client))
+    main.main(mock.Mock(data={'bucket': 'input', 'name': 'links.csv'}))
+    store.halt.assert_called_once()
+    self.assertIs(job, store.halt.call_args.args[0])
+    # The row that opened the breaker is left for the resumed run.
+    self.assertEqual(1, job.offset)
+    self.assertFalse(job.done)
+    store.request_continuation.assert_not_called()
+
+  def test_main_finishes_job_when_one_property_is_not_accessible(self):
+    store = mock.Mock()
+    job = main.checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7, validated=True)
+    store.resolve.return_value = job
+    store.open_source.return_value = io.BytesIO(
+        b'ga4_property_id,request_type,ads_customer_id\n'
+        b'1,ads,111\n1,ads,222\n1,ads,333\n1,ads,444\n2,ads,555\n')
+    self.enter_context(mock.patch.object(
+        main.checkpoint, 'CheckpointStore', return_value=store))
+    self.enter_context(mock.patch.object(main, 'storage_client'))
+    self.enter_context(
+        mock.patch.object(main.circuit_breaker, 'THRESHOLD', 2))
+    ga_client = mock.Mock()
+
+    def list_google_ads_links(parent):
+      if parent == 'properties/1':
+        raise exceptions.PermissionDenied('no access to property 1')
+      return []
+
+    ga_client.list_google_ads_links.side_effect = list_google_ads_links
+    ga_client.create_google_ads_link.return_value = GoogleAdsLink(
+        name='properties/2/googleAdsLinks/a')
+    self.enter_context(
+        mock.patch.object(main, 'get_ga_client', return_value=ga_client))
+    main.main(mock.Mock(data={'bucket': 'input', 'name': 'links.csv'}))
+    store.halt.assert_not_called()
+    self.assertTrue(job.done)
+    self.assertEqual({'failed': 4, 'created': 1}, job.status_counts())
+
+  def test_main_writes_results_in_input_order_with_many_workers(self):
+    store = mock.Mock()
+    job = main.checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7, validated=True)
+    store.resolve.return_value = job
+    store.open_source.return_value = io.BytesIO(
+        b'ga4_property_id,request_type,ads_customer_id,dv360_advertiser_id\n'
+        b'1,ads,111,\n2,ads,222,\n3,dv360,,333\n')
+    self.enter_context(mock.patch.object(
+        main.checkpoint, 'CheckpointStore', return_value=store))
+    storage_client = testing.FakeStorageClient()
+    self.enter_context(
+        mock.patch.object(main, 'storage_client', storage_client))
+    self.enter_context(mock.patch.object(main, 'OUTPUT_BUCKET', 'output'))
+    self.enter_context(mock.patch.object(main, 'RESULTS_FORMAT', 'ndjson'))
+    self.enter_context(mock.patch.object(main, 'MAX_WORKERS', 3))
+    # The first row only finishes once the last one has failed, so the
+    # rows complete in reverse order.
+    last_row_done = threading.Event()
+
+    def list_google_ads_links(parent):
+      if parent == 'properties/1':
+        self.assertTrue(last_row_done.wait(timeout=5))
+      return []
+
+    def create_dv360_link(**kwargs):
+      last_row_done.set()
+      raise exceptions.InvalidArgument('unknown advertiser')
+
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.side_effect = list_google_ads_links
+    ga_client.create_google_ads_link.side_effect = (
+        lambda parent, google_ads_link: GoogleAdsLink(
+            name=f'{parent}/googleAdsLinks/{google_ads_link.customer_id}'))
+    ga_client.list_display_video360_advertiser_links.return_value = []
+    ga_client.create_display_video360_advertiser_link.side_effect = (
+        create_dv360_link)
+    self.enter_context(
+        mock.patch.object(main, 'get_ga_client', return_value=ga_client))
+    main.main(mock.Mock(data={'bucket': 'input', 'name': 'links.csv'}))
+    results = [
+        json.loads(line)
+        for line in storage_client.bucket('output').text(
+            'results/links.csv/7/part-000000000.ndjson').splitlines()]
+    self.assertEqual(
+        [('1', '111'), ('2', '222'), ('3', '333')],
+        [(str(r['ga_propety_id']), r['platform_id']) for r in results])
+    self.assertEqual(
+        ['created', 'created'], [r['result'] for r in results[:2]])
+    self.assertIn('unknown advertiser', results[2]['result'])
+    self.assertTrue(job.done)
+
+  def test_main_writes_retries_that_only_run_once_due(self):
+    store = mock.Mock()
+    job = main.checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7, validated=True)
+    store.resolve.return_value = job
+    store.open_source.return_value = io.BytesIO(
+        b'ga4_property_id,request_type,ads_customer_id\n1,ads,111\n')
+    self.enter_context(mock.patch.object(
+        main.checkpoint, 'CheckpointStore', return_value=store))
+    storage_client = testing.FakeStorageClient()
+    self.enter_context(
+        mock.patch.object(main, 'storage_client', storage_client))
+    self.enter_context(mock.patch.object(main, 'OUTPUT_BUCKET', 'output'))
+    self.enter_context(mock.patch.object(main.rate_limiter, 'MAX_ATTEMPTS', 1))
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.side_effect = (
+        exceptions.ServiceUnavailable('try again'))
+    self.enter_context(
+        mock.patch.object(main, 'get_ga_client', return_value=ga_client))
+    main.main(mock.Mock(data={'bucket': 'input', 'name': 'links.csv'}))
+    part = 'retries/links.csv/7/part-000000000.csv'
+    input_bucket = storage_client.bucket('input')
+    self.assertIn('1,ads,111,2,', input_bucket.text(part))
+    due = input_bucket.custom_times[part]
+    self.assertAlmostEqual(
+        time.time() + main.errors.BASE_DELAY, due.timestamp(), delta=5)
+    # The retry part fails without being read until it is due, so that its
+    # storage event is delivered again later.
+    store.resolve.reset_mock()
+    with self.assertRaises(main.errors.RetryNotDueError):
+      main.main(mock.Mock(data={
+          'bucket': 'input', 'name': part,
+          'customTime': due.isoformat().replace('+00:00', 'Z')}))
+    store.resolve.assert_not_called()
+
+  def test_run_async_keeps_input_order_and_lists_once_per_property(self):
+    ga_client = FakeAsyncClient()
+    self.enter_context(
+        mock.patch.object(main, 'get_ga_client', return_value=ga_client))
+    rows = [ads_row(1, 111), ads_row(2, 222), ads_row(1, 333)]
+    responses = []
+    timed_out = asyncio.run(main.run_async(
+        iter(rows), self.indexes, lambda row, r: responses.append(r) or False,
+        mock.Mock(), time.time()))
+    self.assertFalse(timed_out)
+    self.assertEqual(
+        [('1', '111'), ('2', '222'), ('1', '333')],
+        [(str(r['ga_propety_id']), r['platform_id']) for r in responses])
+    self.assertEqual(['created'] * 3, [r['result'] for r in responses])
+    self.assertEqual(2, [call[0] for call in ga_client.calls].count('list'))
+    property_1_calls = [c for c in ga_client.calls if c[1] == 'properties/1']
+    self.assertEqual(
+        [('list', 'properties/1'), ('create', 'properties/1', '111'),
+         ('create', 'properties/1', '333')],
+        property_1_calls)
+
+  def test_run_async_leaves_rows_for_next_run_when_out_of_time(self):
+    self.enter_context(mock.patch.object(
+        main, 'get_ga_client', return_value=FakeAsyncClient()))
+    responses = []
+    timed_out = asyncio.run(main.run_async(
+        iter([ads_row(1, 111)]), self.indexes,
+        lambda row, r: responses.append(r),
+        mock.Mock(), time.time() - main.TIMEOUT))
+    self.assertTrue(timed_out)
+    self.assertEmpty(responses)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,48 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Creates, updates, deletes, or lists links of every type.
+
+A single function for every link type in shared.link_resources, such as
+Google Ads, DV360, Firebase, BigQuery, Search Ads 360 and AdSense links, so
+that one pool of warm instances serves all link messages. Each message names
+its type with a "link_type" key, or the LINK_TYPE runtime variable sets the
+type of messages without one.
+"""
+
+import os
+from typing import Any
+
+from cloudevents.http import CloudEvent
+import functions_framework
+from shared import link_handler
+from shared import metrics
+
+LINK_TYPE = os.environ.get('LINK_TYPE')
+
+
+@functions_framework.cloud_event
+@metrics.instrumented('links')
+def main(cloud_event: CloudEvent) -> Any:
+  """Cloud Function that creates, updates, deletes, or lists links.
+
+  Args:
+      cloud_event: The cloud event with the pub/sub message.
+
+  Returns:
+      The response or error object, a list with the outcome of each
+      operation for messages that contain a list of operations, or a summary
+      of the export for bulk list messages.
+  """
+  return link_handler.handle(cloud_event, LINK_TYPE)
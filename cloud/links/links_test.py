@@ -0,0 +1,83 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the links cloud function."""
+
+import base64
+import json
+import unittest
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from cloudevents.http import CloudEvent
+import links
+from shared import link_handler
+
+
+class LinksTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.data = {
+        'client_id': '123',
+        'client_secret': 'ABC',
+        'refresh_token': '123ABC',
+        'token_uri': 'google.com',
+        'scopes': ['https://www.googleapis.com/auth/analytics.edit'],
+        'action': 'delete',
+    }
+    link_handler.ga_clients.clear()
+
+  def event(self, data):
+    encoded_data = base64.b64encode(json.dumps(data).encode('utf-8'))
+    return CloudEvent(
+        {'source': 'test', 'type': 'test'},
+        {'message': {'data': encoded_data}})
+
+  @parameterized.parameters(
+      ('ads_link', 'delete_google_ads_link'),
+      ('dv360_link', 'delete_display_video360_advertiser_link'),
+      ('dv360_link_proposal',
+       'delete_display_video360_advertiser_link_proposal'),
+      ('firebase_link', 'delete_firebase_link'),
+      ('bigquery_link', 'delete_big_query_link'),
+      ('search_ads_360_link', 'delete_search_ads360_link'),
+      ('adsense_link', 'delete_ad_sense_link'),
+  )
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_handles_every_link_type(
+      self, link_type, method, mock_ga_client):
+    name = 'properties/1/links/a'
+    getattr(mock_ga_client(), method).return_value = 'deleted'
+    self.assertEqual(
+        'deleted',
+        links.main(self.event(
+            self.data | {'link_type': link_type, 'name': name})))
+    getattr(mock_ga_client(), method).assert_called_once_with(name=name)
+
+  @unittest.mock.patch.object(links, 'LINK_TYPE', 'ads_link')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_uses_link_type_variable(self, mock_ga_client):
+    mock_ga_client().delete_google_ads_link.return_value = 'deleted'
+    self.assertEqual(
+        'deleted',
+        links.main(self.event(self.data | {'name': 'properties/1/links/a'})))
+
+  def test_main_without_link_type_returns_error(self):
+    self.assertEqual(
+        'Missing keys: link_type,name', links.main(self.event(self.data)))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -22,74 +22,514 @@ eventually create Google Analytics resources.
 import os
 import json
 import time
-import pandas
+import itertools
+import threading
 import functions_framework
+from concurrent import futures
 from enum import Enum
-from typing import Dict
+from typing import Any, Dict, List, Union
 from google.cloud import storage
 from google.cloud import pubsub_v1
 from cloudevents.http import CloudEvent
+from shared import checkpoint
+from shared import circuit_breaker
+from shared import credential_profiles
+from shared import metrics
+from shared import rate_limiter
+from shared import sharding
+from shared import validation
 
 class ResourceType(Enum):
+    """The link types that files are published for, named as in the link
+    registry of the link functions. A file is published for every type whose
+    name is part of the file name.
+    """
     ADS_LINK = 'ads_link'
     DV360_LINK = 'dv360_link'
-    DV360_LINK_PROPOSAL = 'dv360_link_proposal' 
+    DV360_LINK_PROPOSAL = 'dv360_link_proposal'
+    FIREBASE_LINK = 'firebase_link'
+    BIGQUERY_LINK = 'bigquery_link'
+    SEARCH_ADS_360_LINK = 'search_ads_360_link'
+    ADSENSE_LINK = 'adsense_link'
 
-# Set to slightly less than 1 hour so that the function can upload
-# a new CSV to the input bucket if it is close to timing out.
+# Set to slightly less than 1 hour so that the function can trigger
+# another run of itself if it is close to timing out.
 TIMEOUT = 3500
 
+# Number of rows published between saves of the checkpoint journal.
+CHECKPOINT_INTERVAL = int(os.environ.get('CHECKPOINT_INTERVAL', 500))
+
+# Number of rows packed into each message. Messages with more than one row
+# list them under BATCH_KEY and are split again by the link functions.
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 1))
+# Batches are published early if they would grow beyond this many bytes.
+MAX_MESSAGE_BYTES = int(os.environ.get('MAX_MESSAGE_BYTES', 1000000))
+BATCH_KEY = 'operations'
+# Batches for at most this many properties are kept open at the same time.
+MAX_OPEN_BATCHES = int(os.environ.get('MAX_OPEN_BATCHES', 100))
+# Whether messages are published with the property ID as the ordering key.
+ORDERING_KEYS = os.environ.get('ORDERING_KEYS', '').strip().lower() == 'true'
+# If set, messages for every link type are published to this topic, such as
+# the topic of the links function, instead of one ga_<type> topic per type.
+LINKS_TOPIC = os.environ.get('LINKS_TOPIC')
+# A file with more rejected rows than this is not published at all. Rejected
+# rows are only skipped if it is not set.
+MAX_REJECTED_ROWS = os.environ.get('MAX_REJECTED_ROWS')
+# Files are split into up to this many shards that are published by separate
+# instances at the same time. Each shard has at least MIN_SHARD_BYTES.
+SHARDS = int(os.environ.get('SHARDS', 1))
+MIN_SHARD_BYTES = int(os.environ.get('MIN_SHARD_BYTES', 10000000))
+# A message that fails to publish is published again with jittered
+# exponential backoff, up to this many times in all, before its rows are
+# recorded as failed.
+PUBLISH_ATTEMPTS = int(os.environ.get('PUBLISH_ATTEMPTS', 5))
+
+storage_client = storage.Client()
+# Resolves the CREDENTIAL_PROFILE for the credentials check before a file is
+# published.
+profiles = credential_profiles.CredentialProfiles.from_env()
+
+# A single client is reused for every message so that messages are batched
+# over one gRPC channel. Flow control blocks publishing once too many
+# messages are waiting to be sent instead of buffering the whole file.
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=int(os.environ.get('PUBLISH_MAX_MESSAGES', 100)),
+        max_bytes=int(os.environ.get('PUBLISH_MAX_BYTES', 1000000)),
+        max_latency=float(os.environ.get('PUBLISH_MAX_LATENCY', .05))),
+    publisher_options=pubsub_v1.types.PublisherOptions(
+        enable_message_ordering=ORDERING_KEYS,
+        flow_control=pubsub_v1.types.PublishFlowControl(
+            message_limit=int(
+                os.environ.get('PUBLISH_MAX_OUTSTANDING_MESSAGES', 1000)),
+            byte_limit=int(
+                os.environ.get('PUBLISH_MAX_OUTSTANDING_BYTES', 10000000)),
+            limit_exceeded_behavior=(
+                pubsub_v1.types.LimitExceededBehavior.BLOCK))))
+
+
+class MessageBatcher:
+    """Packs the rows published to one topic into batch messages.
+
+    Rows are grouped by property so that each message only holds operations
+    for a single property. When ordering keys are enabled, the property ID is
+    used as the ordering key so that the link functions receive the messages
+    for a property one at a time and in file order, while messages for
+    different properties are delivered in parallel.
+
+    When the batch size is 1, each row is published on its own in the
+    original message format.
+    """
+
+    def __init__(
+            self,
+            topic: str,
+            event_data: Dict[str, Any],
+            batch_size: int = BATCH_SIZE,
+            max_bytes: int = MAX_MESSAGE_BYTES,
+            ordering: bool = ORDERING_KEYS):
+        """Initializes the batcher.
+
+        Args:
+            topic: The pub/sub topic the messages are published to.
+            event_data: The values shared by every row, such as the
+            credentials.
+            batch_size: The maximum number of rows in each message.
+            max_bytes: The maximum size of each message.
+            ordering: Whether to publish with the property ID as the ordering
+            key.
+        """
+        self.topic = topic
+        self._event_data = event_data
+        self._batch_size = batch_size
+        self._max_bytes = max_bytes
+        self._ordering = ordering
+        self._empty_size = len(json.dumps(event_data | {BATCH_KEY: []}))
+        # Open batches keyed by property ID, in the order they were opened.
+        self._batches = {}
+
+    def add(self, row: Dict[str, Any], row_futures: List[futures.Future]):
+        """Adds a row to the open batch for its property.
+
+        Args:
+            row: The values from one row of the CSV file.
+            row_futures: The future of the message that contains the row is
+            appended to this list once the message is published.
+        """
+        key = property_key(row)
+        if self._batch_size <= 1:
+            encoded_data = json.dumps(self._event_data | row).encode('utf-8')
+            row_futures.append(self._publish(key, encoded_data))
+            return
+        size = len(json.dumps(row)) + 2
+        batch = self._batches.get(key)
+        if batch and batch['size'] + size > self._max_bytes:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            if len(self._batches) >= MAX_OPEN_BATCHES:
+                self._flush(next(iter(self._batches)))
+            batch = {'rows': [], 'row_futures': [], 'size': self._empty_size}
+            self._batches[key] = batch
+        batch['rows'].append(row)
+        batch['row_futures'].append(row_futures)
+        batch['size'] += size
+        if len(batch['rows']) >= self._batch_size:
+            self._flush(key)
+
+    def flush(self):
+        """Publishes every open batch."""
+        for key in list(self._batches):
+            self._flush(key)
+
+    def _flush(self, key: str):
+        batch = self._batches.pop(key)
+        encoded_data = json.dumps(
+            self._event_data | {BATCH_KEY: batch['rows']}).encode('utf-8')
+        future = self._publish(key, encoded_data)
+        for row_futures in batch['row_futures']:
+            row_futures.append(future)
+
+    def _publish(self, key: str, encoded_data: bytes) -> futures.Future:
+        """Publishes a message, publishing it again if it fails.
+
+        Returns:
+            A future of the message ID that only fails once PUBLISH_ATTEMPTS
+            publishes of the message have failed.
+        """
+        result = futures.Future()
+        self._attempt(key, encoded_data, result, 1)
+        return result
+
+    def _attempt(
+            self,
+            key: str,
+            encoded_data: bytes,
+            result: futures.Future,
+            attempt: int):
+        if self._ordering:
+            future = publisher.publish(
+                self.topic, encoded_data, ordering_key=key)
+        else:
+            future = publisher.publish(self.topic, encoded_data)
+        future.add_done_callback(
+            lambda f: self._published(f, key, encoded_data, result, attempt))
+
+    def _published(
+            self,
+            future: futures.Future,
+            key: str,
+            encoded_data: bytes,
+            result: futures.Future,
+            attempt: int):
+        error = future.exception()
+        if error is None:
+            result.set_result(future.result())
+            return
+        if self._ordering:
+            # Pub/sub pauses an ordering key after a failed publish. Later
+            # rows are still sent, so a republished message may arrive after
+            # them.
+            publisher.resume_publish(self.topic, key)
+        if attempt >= PUBLISH_ATTEMPTS:
+            result.set_exception(error)
+            return
+        metrics.count('publish.retries')
+        # Waits on a timer so that the callback thread of the client is not
+        # blocked during the backoff.
+        timer = threading.Timer(
+            rate_limiter.backoff_delay(attempt),
+            self._attempt,
+            (key, encoded_data, result, attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+
+def property_key(row: Dict[str, Any]) -> str:
+    """Returns the property ID that a row of the CSV file belongs to."""
+    return str(row.get('property_id', row.get('ga4_property_id', '')))
+
+
 @functions_framework.cloud_event
+@metrics.instrumented('message_publisher')
 def main(cloud_event: CloudEvent) -> str:
     """Gets the CSV file uploaded to the specified Cloud Storage bucket and
     loops through the contents. Each row in the file should cause a pub/sub
     message to be published containing data to create a Google Analytics
     resource.
 
+    Progress is saved to a checkpoint journal so that a run that is close to
+    timing out can trigger another run that continues from the same row.
+
+    The credentials the messages carry are checked first. If they are not
+    accepted, the file is halted instead of publishing messages that would
+    all fail, and resumes from the same row once its continuation is copied
+    to the input bucket.
+
+    A file larger than MIN_SHARD_BYTES is first split into shards when SHARDS
+    is more than 1. Each shard triggers its own run, and the last shard to
+    finish saves a completion marker for the whole file.
+
     Args:
         cloud_event: The event containing meta information about the file
         uploaded to the Cloud Storage bucket.
 
     Returns:
         An string indicating whether or not the function has invoked another
-        instance of itself by uploading the remaining CSV file values.
+        instance of itself to continue with the remaining rows.
     """
     start_time = time.time()
-    bucket = cloud_event.data['bucket']
-    name = cloud_event.data['name']
-    file_name = 'gs://' + bucket + '/' + name
-    df = pandas.read_csv(file_name, on_bad_lines='skip')
-    records = df.to_dict('records')
+    checkpoint_bucket = (
+        os.environ.get('CHECKPOINT_BUCKET') or cloud_event.data['bucket'])
+    store = checkpoint.CheckpointStore(storage_client, checkpoint_bucket)
+    job = store.resolve(cloud_event.data)
+    if job is None:
+        return 'skipped'
     enable_logging = str_to_bool(os.environ.get('ENABLE_LOGGING'))
-    event_data = {
+    event_data = get_event_data(enable_logging)
+    try:
+        check_credentials(event_data)
+    except Exception as e:
+        if not circuit_breaker.is_auth_failure(e):
+            raise
+        name = store.halt(job, str(e))
+        print(
+            f'Halted {job.name}, the credentials were not accepted: {e}. '
+            f'Copy gs://{checkpoint_bucket}/{name} to gs://{job.bucket}/ to '
+            'resume it.')
+        return 'halted'
+    if job.shard is None and job.offset == 0 and not job.validated:
+        size = int(cloud_event.data.get('size') or 0)
+        shards = sharding.shard_count(size, SHARDS, MIN_SHARD_BYTES)
+        if shards > 1:
+            split(store, job, size, shards)
+            if (enable_logging):
+                print(f'split into {job.shards} shards')
+            return 'sharded'
+    if not job.validated and not check_input(store, job, checkpoint_bucket):
+        return 'rejected'
+    # Rows before the checkpoint offset were published by an earlier run.
+    records = itertools.islice(
+        validation.validated_records(
+            store.open_source(job), {None: validation.MESSAGE_SCHEMA}),
+        job.offset,
+        None)
+    # Messages carry their link type so that a single function can handle
+    # the messages of every type.
+    batchers = [
+        MessageBatcher(
+            get_topic(resource),
+            event_data | {'link_type': resource.value})
+        for resource in resource_types(job.name)]
+    pending_rows = []
+    for row in records:
+        if time.time() - start_time >= TIMEOUT:
+            confirm_published(job, batchers, pending_rows)
+            store.request_continuation(job)
+            if (enable_logging):
+                print('continuing')
+            return 'continuing'
+        reason = row.pop(validation.REJECTED_KEY, None)
+        if reason:
+            # Rejected rows are recorded without publishing a message.
+            pending_rows.append(validation.status(reason))
+            continue
+        row_futures = []
+        with metrics.span('publish'):
+            for batcher in batchers:
+                batcher.add(row, row_futures)
+        pending_rows.append(row_futures)
+        if len(pending_rows) >= CHECKPOINT_INTERVAL:
+            confirm_published(job, batchers, pending_rows)
+            store.save(job)
+            pending_rows = []
+    confirm_published(job, batchers, pending_rows)
+    job.done = True
+    store.save(job)
+    marker = store.complete(job)
+    if (enable_logging):
+        print('done')
+        if marker:
+            print(f'{job.name} complete: {marker["statuses"]}')
+    return 'done'
+
+
+def split(
+        store: checkpoint.CheckpointStore,
+        job: checkpoint.Checkpoint,
+        size: int,
+        shards: int) -> List[checkpoint.Checkpoint]:
+    """Splits a file into shards that are each published by their own run.
+
+    Args:
+        store: The checkpoint store of the file.
+        job: The checkpoint of the file, which has not been started.
+        size: The size of the file in bytes.
+        shards: The number of shards to split the file into.
+
+    Returns:
+        The checkpoints of the shards.
+    """
+    blob = storage_client.bucket(job.bucket).blob(
+        job.name, generation=job.generation)
+    header, ranges = sharding.line_ranges(blob, size, shards)
+    return store.start_shards(job, ranges, header)
+
+
+def check_input(
+        store: checkpoint.CheckpointStore,
+        job: checkpoint.Checkpoint,
+        bucket_name: str) -> bool:
+    """Checks every row of the CSV file before the first row is published.
+
+    The rows that will not be published are written to a rejects file in the
+    checkpoint bucket, so that they can be fixed and uploaded again.
+
+    Args:
+        store: The checkpoint store of the file.
+        job: The checkpoint of the file.
+        bucket_name: The bucket the rejects file is written to.
+
+    Returns:
+        True if the file should be published, or False if it has more
+        rejected rows than MAX_REJECTED_ROWS.
+    """
+    rejects_name = f'{checkpoint.REJECTS_PREFIX}{job.path}.csv'
+    report = validation.check_file(
+        store.open_source(job),
+        {None: validation.MESSAGE_SCHEMA},
+        lambda: storage_client.bucket(bucket_name).blob(
+            rejects_name).open('w'))
+    if report.rejected or report.duplicates:
+        print(
+            f'{report.rejected} of {report.rows} rows rejected and '
+            f'{report.duplicates} coalesced, see gs://{bucket_name}/'
+            f'{rejects_name}: {report.reasons}')
+    job.validated = True
+    if (MAX_REJECTED_ROWS is not None
+            and report.rejected > int(MAX_REJECTED_ROWS)):
+        print(f'Not publishing {job.name}, too many rejected rows')
+        job.done = True
+    store.save(job)
+    return not job.done
+
+
+def confirm_published(
+        job: checkpoint.Checkpoint,
+        batchers: List[MessageBatcher],
+        pending_rows: List[Union[List[futures.Future], str]]) -> int:
+    """Publishes any partial batches, waits until the messages for each row
+    have been accepted or rejected by pub/sub and records the outcome of each
+    row in the checkpoint.
+
+    Args:
+        job: The checkpoint of the file being published.
+        batchers: The batchers that may still hold unpublished rows.
+        pending_rows: The futures returned when publishing the messages for
+        each row, in file order, or the status of rows that were not
+        published.
+
+    Returns:
+        The number of rows with messages that failed to publish after
+        PUBLISH_ATTEMPTS attempts. Each failure is printed.
+    """
+    with metrics.span('publish_confirm'):
+        for batcher in batchers:
+            batcher.flush()
+        failures = 0
+        skipped = 0
+        for row_futures in pending_rows:
+            if isinstance(row_futures, str):
+                job.record(row_futures)
+                metrics.count(f'rows.{row_futures}')
+                skipped += 1
+                continue
+            errors = [f.exception() for f in row_futures if f.exception()]
+            for error in errors:
+                print(
+                    f'Failed to publish message for row {job.offset}: '
+                    f'{error}')
+            failures += bool(errors)
+            job.record('failed' if errors else 'published')
+    metrics.count('rows.published', len(pending_rows) - skipped - failures)
+    metrics.count('rows.failed', failures)
+    if failures:
+        print(f'{failures} of {len(pending_rows)} rows failed to publish')
+    return failures
+
+
+def resource_types(file_name: str) -> List[ResourceType]:
+    """Gets the link types whose names are part of a file name.
+
+    A type is left out if its name is only part of the name of another
+    matching type, so that a dv360_link_proposal file is not also published
+    as DV360 links.
+    """
+    matches = [
+        resource for resource in ResourceType if resource.value in file_name]
+    return [
+        resource for resource in matches
+        if not any(
+            resource.value in other.value and resource is not other
+            for other in matches)]
+
+
+def get_topic(resource: ResourceType) -> str:
+    """Gets the topic that the messages for a link type are published to."""
+    project_id = os.environ.get('PROJECT_ID')
+    if LINKS_TOPIC:
+        return f'projects/{project_id}/topics/{LINKS_TOPIC}'
+    return f'projects/{project_id}/topics/ga_{resource.value}'
+
+
+def get_event_data(enable_logging: bool) -> Dict[str, Any]:
+    """Gets the values that are included in every message.
+
+    If the CREDENTIAL_PROFILE environment variable is set, messages only carry
+    the profile ID and the link functions look up the credentials in Secret
+    Manager. Otherwise the credentials are copied into every message.
+
+    Args:
+        enable_logging: Whether the link functions should log their responses.
+
+    Returns:
+        A dictionary with the credentials or the credential profile ID.
+    """
+    profile = os.environ.get('CREDENTIAL_PROFILE')
+    if profile:
+        return {
+            'credential_profile': profile,
+            'enable_logging': enable_logging}
+    return {
         'client_id': os.environ.get('CLIENT_ID'),
         'client_secret': os.environ.get('CLIENT_SECRET'),
         'refresh_token': os.environ.get('REFRESH_TOKEN'),
         'token_uri': os.environ.get('TOKEN_URI'),
         'scopes': ['https://www.googleapis.com/auth/analytics.edit'],
         'enable_logging': enable_logging}
-    for index, row in enumerate(records):
-        if time.time() - start_time < TIMEOUT:
-            for resource in ResourceType:
-                if resource.value in name:
-                    topic = f'projects/{os.environ.get("PROJECT_ID")}/topics/ga_{resource.value}'
-                    encoded_data = json.dumps(event_data | row).encode('utf-8')
-                    pubsub_v1.PublisherClient().publish(topic, encoded_data)
-                    time.sleep(.2)
-        else:
-            current_row = index + 1
-            remaining = df.iloc[current_row:,:]
-            remaining_csv = pandas.DataFrame(remaining).to_csv()
-            remaining_blob = storage.Client().get_bucket(bucket).blob(
-                f'remaining-{time.time()}.csv')
-            remaining_blob.upload_from_string(
-                remaining_csv, content_type='text/csv')
-            if (enable_logging):
-                print('continuing')
-            return 'continuing'
-        if (enable_logging):
-            print('done')
-        return 'done'
+
+
+def check_credentials(event_data: Dict[str, Any]) -> None:
+    """Refreshes an access token with the credentials the messages carry.
+
+    Args:
+        event_data: The values included in every message, with the
+        credentials or the credential profile ID.
+
+    Raises:
+        google.auth.exceptions.RefreshError: If the credentials are not
+        accepted.
+    """
+    with metrics.span('credentials_check'):
+        try:
+            circuit_breaker.check_credentials(profiles.resolve(event_data))
+        except Exception as e:
+            # A rotated secret is fetched again when the file is resumed.
+            if (credential_profiles.PROFILE_KEY in event_data
+                    and circuit_breaker.is_auth_failure(e)):
+                profiles.invalidate(
+                    event_data[credential_profiles.PROFILE_KEY])
+            raise
 
 
 def str_to_bool(value: str|None):
@@ -102,7 +542,7 @@ def str_to_bool(value: str|None):
     Returns:
         Either True or False as boolean types.
     """
-    if value.strip().lower() == 'true':
+    if value and value.strip().lower() == 'true':
         return True
     else:
         return False
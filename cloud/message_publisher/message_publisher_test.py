@@ -0,0 +1,240 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the message publisher cloud function."""
+
+from concurrent import futures
+import io
+import json
+import threading
+import unittest
+
+from absl.testing import absltest
+from google.auth.exceptions import RefreshError
+
+with unittest.mock.patch('google.cloud.storage.Client'), \
+    unittest.mock.patch('google.cloud.pubsub_v1.PublisherClient'):
+  import message_publisher
+
+
+class MessageBatcherTest(absltest.TestCase):
+
+  def setUp(self):
+    super(MessageBatcherTest, self).setUp()
+    self.published = []
+    publisher = self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'publisher'))
+    publisher.publish.side_effect = self.publish
+
+  def publish(self, topic, data, ordering_key=None):
+    self.published.append((ordering_key, json.loads(data)))
+    return unittest.mock.Mock()
+
+  def test_add_publishes_single_rows_in_original_format(self):
+    batcher = message_publisher.MessageBatcher(
+        'topic', {'client_id': '123'}, batch_size=1)
+    row_futures = []
+    batcher.add({'property_id': 1, 'action': 'create'}, row_futures)
+    self.assertEqual(
+        [(None, {'client_id': '123', 'property_id': 1, 'action': 'create'})],
+        self.published)
+    self.assertLen(row_futures, 1)
+
+  def test_add_groups_rows_by_property_with_ordering_keys(self):
+    batcher = message_publisher.MessageBatcher(
+        'topic', {'client_id': '123'}, batch_size=2, ordering=True)
+    rows_futures = [[] for _ in range(5)]
+    for index, property_id in enumerate([1, 2, 1, 2, 3]):
+      batcher.add({'property_id': property_id, 'index': index},
+                  rows_futures[index])
+    batcher.flush()
+    self.assertEqual(
+        [('1', [0, 2]), ('2', [1, 3]), ('3', [4])],
+        [(key, [row['index'] for row in data['operations']])
+         for key, data in self.published])
+    self.assertIs(rows_futures[0][0], rows_futures[2][0])
+
+  def test_add_publishes_batch_before_it_exceeds_max_bytes(self):
+    batcher = message_publisher.MessageBatcher(
+        'topic', {'client_id': '123'}, batch_size=10, max_bytes=150)
+    for _ in range(3):
+      batcher.add({'property_id': 1, 'name': 'x' * 20}, [])
+    batcher.flush()
+    self.assertEqual(
+        [2, 1], [len(data['operations']) for _, data in self.published])
+
+  def test_failed_message_is_published_again_until_attempts_run_out(self):
+    self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'PUBLISH_ATTEMPTS', 3))
+    self.enter_context(unittest.mock.patch.object(
+        message_publisher.rate_limiter, 'backoff_delay', return_value=0))
+    publisher = message_publisher.publisher
+    calls = []
+
+    def publish(topic, data, ordering_key=None):
+      calls.append((topic, data, ordering_key))
+      future = futures.Future()
+      future.set_exception(RuntimeError('unavailable'))
+      return future
+
+    publisher.publish.side_effect = publish
+    batcher = message_publisher.MessageBatcher(
+        'topic', {'client_id': '123'}, batch_size=1, ordering=True)
+    row_futures = []
+    batcher.add({'property_id': 1}, row_futures)
+    self.assertEqual(
+        'unavailable', str(row_futures[0].exception(timeout=5)))
+    self.assertLen(calls, 3)
+    self.assertLen(set(calls), 1)
+    publisher.resume_publish.assert_called_with('topic', '1')
+    self.assertEqual(3, publisher.resume_publish.call_count)
+
+
+class ConfirmPublishedTest(absltest.TestCase):
+
+  def test_confirm_published_records_rows_that_were_not_published(self):
+    job = message_publisher.checkpoint.Checkpoint(
+        bucket='input', name='ads_link.csv')
+    published = unittest.mock.Mock()
+    published.exception.return_value = None
+    failures = message_publisher.confirm_published(
+        job, [], [[published], 'rejected', 'duplicate', [published]])
+    self.assertEqual(0, failures)
+    self.assertEqual(
+        [['published', 1], ['rejected', 1], ['duplicate', 1],
+         ['published', 1]],
+        job.statuses)
+
+  def test_confirm_published_flushes_batches_and_records_failed_futures(self):
+    job = message_publisher.checkpoint.Checkpoint(
+        bucket='input', name='ads_link.csv')
+    batcher = unittest.mock.Mock()
+    published = futures.Future()
+    published.set_result('message-1')
+    failed = futures.Future()
+    failed.set_exception(RuntimeError('topic not found'))
+    failures = message_publisher.confirm_published(
+        job, [batcher], [[published], [published, failed], [published]])
+    batcher.flush.assert_called_once()
+    self.assertEqual(1, failures)
+    self.assertEqual(
+        [['published', 1], ['failed', 1], ['published', 1]], job.statuses)
+
+
+class MainTest(absltest.TestCase):
+
+  def test_main_waits_for_every_message_before_finishing(self):
+    store = unittest.mock.Mock()
+    job = message_publisher.checkpoint.Checkpoint(
+        bucket='input', name='ads_link.csv', generation=7, validated=True)
+    store.resolve.return_value = job
+    store.open_source.return_value = io.BytesIO(
+        b'action,property_id,customer_id\n'
+        b'create,1,111\ncreate,2,222\ncreate,3,333\n')
+    self.enter_context(unittest.mock.patch.object(
+        message_publisher.checkpoint, 'CheckpointStore', return_value=store))
+    self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'check_credentials'))
+    self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'BATCH_SIZE', 1))
+    publisher = self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'publisher'))
+    published = []
+
+    def publish(topic, data):
+      # Messages are only accepted after publish has returned, like the
+      # batched client, and the second one is rejected.
+      future = futures.Future()
+      error = RuntimeError('rejected') if len(published) == 1 else None
+      threading.Timer(
+          0.01,
+          lambda: future.set_exception(error) if error
+          else future.set_result('id')).start()
+      published.append(json.loads(data))
+      return future
+
+    publisher.publish.side_effect = publish
+    self.enter_context(unittest.mock.patch.object(
+        message_publisher.rate_limiter, 'backoff_delay', return_value=0))
+    self.assertEqual('done', message_publisher.main(unittest.mock.Mock(
+        data={'bucket': 'input', 'name': 'ads_link.csv'})))
+    # The rejected message is published again before the file is done.
+    self.assertEqual(
+        ['1', '2', '3', '2'], [m['property_id'] for m in published])
+    self.assertEqual([['published', 3]], job.statuses)
+    self.assertTrue(job.done)
+    store.save.assert_called_with(job)
+    store.request_continuation.assert_not_called()
+
+
+class CheckCredentialsTest(absltest.TestCase):
+
+  def test_main_halts_file_without_publishing_if_credentials_rejected(self):
+    store = unittest.mock.Mock()
+    job = message_publisher.checkpoint.Checkpoint(
+        bucket='input', name='ads_link.csv', generation=7)
+    store.resolve.return_value = job
+    store.halt.return_value = 'checkpoints/input/ads_link.csv/7.halted.json'
+    self.enter_context(unittest.mock.patch.object(
+        message_publisher.checkpoint, 'CheckpointStore', return_value=store))
+    self.enter_context(unittest.mock.patch.object(
+        message_publisher, 'check_credentials',
+        side_effect=RefreshError('invalid_grant: Token has been revoked.')))
+    publisher = self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'publisher'))
+    self.assertEqual('halted', message_publisher.main(unittest.mock.Mock(
+        data={'bucket': 'input', 'name': 'ads_link.csv'})))
+    store.halt.assert_called_once_with(
+        job, 'invalid_grant: Token has been revoked.')
+    store.open_source.assert_not_called()
+    publisher.publish.assert_not_called()
+
+  def test_check_credentials_forgets_rejected_profile(self):
+    profiles = unittest.mock.Mock()
+    self.enter_context(
+        unittest.mock.patch.object(message_publisher, 'profiles', profiles))
+    self.enter_context(unittest.mock.patch.object(
+        message_publisher.circuit_breaker, 'check_credentials',
+        side_effect=RefreshError('invalid_grant: Token has been revoked.')))
+    with self.assertRaises(RefreshError):
+      message_publisher.check_credentials({'credential_profile': 'agency'})
+    profiles.invalidate.assert_called_once_with('agency')
+
+
+class ResourceTypesTest(absltest.TestCase):
+
+  def test_resource_types_prefers_longest_matching_type(self):
+    ResourceType = message_publisher.ResourceType
+    self.assertEqual(
+        [ResourceType.DV360_LINK_PROPOSAL],
+        message_publisher.resource_types('dv360_link_proposal.csv'))
+    self.assertEqual(
+        [ResourceType.ADS_LINK, ResourceType.DV360_LINK],
+        message_publisher.resource_types('ads_link_dv360_link.csv'))
+
+  def test_get_topic_uses_links_topic_if_set(self):
+    resource = message_publisher.ResourceType.BIGQUERY_LINK
+    with unittest.mock.patch.dict('os.environ', {'PROJECT_ID': 'project'}):
+      self.assertEqual(
+          'projects/project/topics/ga_bigquery_link',
+          message_publisher.get_topic(resource))
+      with unittest.mock.patch.object(
+          message_publisher, 'LINKS_TOPIC', 'ga_links'):
+        self.assertEqual(
+            'projects/project/topics/ga_links',
+            message_publisher.get_topic(resource))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,205 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lists the links of many properties into a single export.
+
+A bulk list message names a set of properties, or an account whose properties
+are all listed. The links of several properties are listed at the same time,
+every page request is paced by the rate limiter, and each link is written to
+the export as soon as its property has been listed, so memory only holds the
+links of the properties in flight.
+"""
+
+from collections.abc import Callable, Iterable, Iterator, Mapping
+import concurrent.futures
+import contextvars
+import os
+from typing import Any
+
+from shared import rate_limiter
+from shared import results_writer
+
+# The keys of a list message that select the bulk mode.
+PROPERTY_IDS_KEY = 'property_ids'
+ACCOUNT_ID_KEY = 'account_id'
+EXPORT_URI_KEY = 'export_uri'
+EXPORT_FORMAT_KEY = 'export_format'
+
+PAGE_SIZE = 200
+# Number of properties listed at the same time.
+MAX_WORKERS = int(os.environ.get('BULK_LIST_WORKERS', 8))
+
+
+def is_bulk_list(data: Mapping[str, Any]) -> bool:
+  """Returns whether a list message asks for the bulk mode."""
+  return PROPERTY_IDS_KEY in data or ACCOUNT_ID_KEY in data
+
+
+def list_pages(
+    limiter: rate_limiter.AdaptiveRateLimiter,
+    method: Callable[..., Any],
+    request: Mapping[str, Any],
+    items_field: str,
+    page_size: int = PAGE_SIZE,
+) -> Iterator[Any]:
+  """Yields every item of a list method, requesting one page at a time.
+
+  Unlike iterating the pager, every page request goes through the limiter and
+  is retried when throttled.
+
+  Args:
+      limiter: The limiter shared by every caller of the same API.
+      method: The list method of the Admin API client.
+      request: The fields of the list request, other than the page fields.
+      items_field: The field of the response that holds the items, such as
+        google_ads_links.
+      page_size: The number of items requested per page.
+
+  Yields:
+      The items of every page.
+  """
+  page_token = ''
+  while True:
+    pager = rate_limiter.call_with_retry(
+        limiter,
+        method,
+        request=dict(request, page_size=page_size, page_token=page_token))
+    # The first page has already been fetched, so this sends no request.
+    page = next(iter(pager.pages))
+    yield from getattr(page, items_field)
+    page_token = page.next_page_token
+    if not page_token:
+      return
+
+
+def account_property_ids(
+    limiter: rate_limiter.AdaptiveRateLimiter,
+    ga_client: Any,
+    account_id: str,
+) -> Iterator[str]:
+  """Yields the IDs of the properties of an account."""
+  for ga_property in list_pages(
+      limiter,
+      ga_client.list_properties,
+      {'filter': f'parent:accounts/{account_id}'},
+      'properties'):
+    yield ga_property.name.split('/')[1]
+
+
+def export_links(
+    list_links: Callable[[str], Iterable[Any]],
+    property_ids: Iterable[str],
+    writer: results_writer.ExportWriter,
+    max_workers: int = MAX_WORKERS,
+) -> dict[str, Any]:
+  """Lists the links of every property and writes one record per link.
+
+  Args:
+      list_links: Lists every link of a property given its ID.
+      property_ids: The properties to list. May be a lazy iterator, such as
+        the properties of an account as they are listed.
+      writer: The export the links are written to.
+      max_workers: The number of properties listed at the same time.
+
+  Returns:
+      A summary with the number of properties and links, and the error for
+      each property that could not be listed.
+  """
+  summary = {'properties': 0, 'links': 0, 'failed_properties': {}}
+
+  def list_property(property_id):
+    return [
+        {'property_id': property_id, **type(link).to_dict(link)}
+        for link in list_links(property_id)]
+
+  def write_done(futures):
+    for future in futures:
+      property_id = pending.pop(future)
+      summary['properties'] += 1
+      try:
+        records = future.result()
+      except Exception as e:
+        summary['failed_properties'][property_id] = str(e)
+        continue
+      for record in records:
+        writer.write(record)
+      summary['links'] += len(records)
+
+  pending = {}
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers) as executor:
+    for property_id in property_ids:
+      property_id = str(property_id)
+      future = executor.submit(
+          contextvars.copy_context().run, list_property, property_id)
+      pending[future] = property_id
+      # Only a bounded number of listed properties waits to be written.
+      if len(pending) >= max_workers * 2:
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        write_done(done)
+    write_done(list(pending))
+  return summary
+
+
+def run_bulk_list(
+    data: Mapping[str, Any],
+    ga_client: Any,
+    limiter: rate_limiter.AdaptiveRateLimiter,
+    method_name: str,
+    items_field: str,
+    open_export: Callable[[str], Any],
+) -> dict[str, Any]:
+  """Runs a bulk list message.
+
+  Args:
+      data: The decoded message. It holds either a list of property IDs or an
+        account ID, and the gs:// URI of the export.
+      ga_client: The Admin API client.
+      limiter: The limiter shared by every caller of the same API.
+      method_name: The name of the client method that lists the links.
+      items_field: The field of the list response that holds the links.
+      open_export: Opens the export URI for binary writing.
+
+  Returns:
+      The summary returned by export_links, with the export URI.
+
+  Raises:
+      ValueError: If the message has no export URI.
+  """
+  export_uri = data.get(EXPORT_URI_KEY)
+  if not export_uri:
+    raise ValueError(f'Bulk list messages need an {EXPORT_URI_KEY}')
+  if PROPERTY_IDS_KEY in data:
+    property_ids = data[PROPERTY_IDS_KEY]
+  else:
+    property_ids = account_property_ids(
+        limiter, ga_client, data[ACCOUNT_ID_KEY])
+  method = getattr(ga_client, method_name)
+  with results_writer.ExportWriter(
+      open_export(export_uri),
+      data.get(EXPORT_FORMAT_KEY, 'ndjson')) as writer:
+    summary = export_links(
+        lambda property_id: list_pages(
+            limiter, method, {'parent': f'properties/{property_id}'},
+            items_field),
+        property_ids,
+        writer)
+  return summary | {'export_uri': export_uri}
+
+
+def open_gcs_export(storage_client: Any, uri: str) -> Any:
+  """Opens a gs://bucket/name URI for streaming binary writes."""
+  bucket, _, name = uri.removeprefix('gs://').partition('/')
+  return storage_client.bucket(bucket).blob(name).open('wb')
@@ -0,0 +1,151 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the bulk list mode."""
+
+import io
+import json
+from unittest import mock
+
+from absl.testing import absltest
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+from google.analytics.admin_v1alpha.types import Property
+
+from shared import bulk_list
+from shared import rate_limiter
+
+
+class FakePager:
+  """The first page of a list response."""
+
+  def __init__(self, items, next_page_token):
+    self.pages = iter([mock.Mock(
+        google_ads_links=items,
+        properties=items,
+        next_page_token=next_page_token)])
+
+
+class KeptBytesIO(io.BytesIO):
+  """Keeps the written bytes after it has been closed."""
+
+  def close(self):
+    if not self.closed:
+      self.contents = self.getvalue()
+    super().close()
+
+
+def paged(items, page_size):
+  """Returns a fake list method that pages through the items."""
+  def list_items(request):
+    start = int(request['page_token'] or 0)
+    end = start + page_size
+    return FakePager(
+        items[start:end], str(end) if end < len(items) else '')
+  return mock.Mock(side_effect=list_items, __name__='list_google_ads_links')
+
+
+class BulkListTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.limiter = rate_limiter.AdaptiveRateLimiter(rate=1000, max_rate=1000)
+
+  def test_list_pages_requests_each_page(self):
+    links = [GoogleAdsLink(customer_id=str(index)) for index in range(5)]
+    method = paged(links, page_size=2)
+    self.assertEqual(
+        links,
+        list(bulk_list.list_pages(
+            self.limiter, method, {'parent': 'properties/1'},
+            'google_ads_links', page_size=2)))
+    self.assertEqual(
+        ['', '2', '4'],
+        [call.kwargs['request']['page_token']
+         for call in method.call_args_list])
+    self.assertEqual(
+        {'parent': 'properties/1', 'page_size': 2, 'page_token': ''},
+        method.call_args_list[0].kwargs['request'])
+
+  def test_account_property_ids_filters_by_account(self):
+    ga_client = mock.Mock()
+    ga_client.list_properties = paged(
+        [Property(name='properties/1'), Property(name='properties/2')], 1)
+    self.assertEqual(
+        ['1', '2'],
+        list(bulk_list.account_property_ids(self.limiter, ga_client, '99')))
+    self.assertEqual(
+        'parent:accounts/99',
+        ga_client.list_properties.call_args.kwargs['request']['filter'])
+
+  def test_export_links_writes_every_link_and_records_failures(self):
+    links = {
+        '1': [GoogleAdsLink(name='properties/1/googleAdsLinks/a')],
+        '2': [GoogleAdsLink(name='properties/2/googleAdsLinks/b'),
+              GoogleAdsLink(name='properties/2/googleAdsLinks/c')],
+    }
+
+    def list_links(property_id):
+      if property_id == '3':
+        raise ValueError('permission denied')
+      return links[property_id]
+
+    writer = mock.Mock()
+    summary = bulk_list.export_links(
+        list_links, ['1', 2, '3'], writer, max_workers=1)
+    self.assertEqual(
+        {'properties': 3,
+         'links': 3,
+         'failed_properties': {'3': 'permission denied'}},
+        summary)
+    written = [call.args[0] for call in writer.write.call_args_list]
+    self.assertEqual(
+        ['properties/1/googleAdsLinks/a',
+         'properties/2/googleAdsLinks/b',
+         'properties/2/googleAdsLinks/c'],
+        sorted(record['name'] for record in written))
+    self.assertEqual(
+        {'1', '2'}, {record['property_id'] for record in written})
+
+  def test_run_bulk_list_streams_to_export(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links = paged(
+        [GoogleAdsLink(name='properties/1/googleAdsLinks/a')], 10)
+    export = KeptBytesIO()
+    open_export = mock.Mock(return_value=export)
+    summary = bulk_list.run_bulk_list(
+        {'property_ids': ['1'], 'export_uri': 'gs://bucket/links.ndjson'},
+        ga_client, self.limiter, 'list_google_ads_links',
+        'google_ads_links', open_export)
+    open_export.assert_called_once_with('gs://bucket/links.ndjson')
+    self.assertEqual('gs://bucket/links.ndjson', summary['export_uri'])
+    (record,) = [json.loads(line) for line in export.contents.splitlines()]
+    self.assertEqual('1', record['property_id'])
+    self.assertEqual('properties/1/googleAdsLinks/a', record['name'])
+
+  def test_run_bulk_list_without_export_uri_raises_error(self):
+    with self.assertRaisesRegex(ValueError, 'export_uri'):
+      bulk_list.run_bulk_list(
+          {'property_ids': ['1']}, mock.Mock(), self.limiter,
+          'list_google_ads_links', 'google_ads_links', mock.Mock())
+
+  def test_open_gcs_export_opens_blob_for_binary_writes(self):
+    storage_client = mock.Mock()
+    bulk_list.open_gcs_export(storage_client, 'gs://bucket/exports/a.ndjson')
+    storage_client.bucket.assert_called_once_with('bucket')
+    storage_client.bucket().blob.assert_called_once_with('exports/a.ndjson')
+    storage_client.bucket().blob().open.assert_called_once_with('wb')
+
+
+if __name__ == '__main__':
+  absltest.main()
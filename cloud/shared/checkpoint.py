@@ -0,0 +1,449 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps track of how far a function has worked through an input file.
+
+A checkpoint records the source object and generation, the number of rows that
+have been processed and the run-length encoded status of each of those rows.
+Checkpoints are saved as small JSON journals in Cloud Storage, so a function
+that runs out of time only has to write a continuation object that points at
+its journal, and a run that crashed can be resumed from the last saved offset
+when the storage event is retried.
+
+A run that cannot make progress, such as when the credentials have been
+revoked, halts instead. Its journal is saved with the reason, and a
+continuation object is left in the checkpoint bucket. Copying that object to
+the input bucket resumes the file from the same row.
+
+A large file can also be split into shards, byte ranges of the file that
+start at a line boundary. Each shard has its own checkpoint, and is started
+by a descriptor object written to the input bucket like a continuation.
+"""
+
+from collections.abc import Mapping
+import dataclasses
+import io
+import json
+from typing import Any, BinaryIO
+
+from google.api_core import exceptions
+from google.cloud import storage
+
+from shared import errors
+from shared import metrics
+
+# Journals are saved under this prefix. Functions ignore storage events for
+# these objects in case the journals are kept in the input bucket.
+CHECKPOINT_PREFIX = 'checkpoints/'
+# The rows of an input file that were rejected before it was processed are
+# written under this prefix, and storage events for them are ignored too.
+REJECTS_PREFIX = 'rejects/'
+# The rows that failed with an error worth retrying are written to the input
+# bucket under this prefix, so that they are processed again like any other
+# input file.
+RETRIES_PREFIX = 'retries/'
+# Objects with this suffix are written to the input bucket to trigger the
+# function again and continue where the previous run stopped.
+CONTINUATION_SUFFIX = '.continue.json'
+# Objects with this suffix are written to the input bucket to start each
+# shard of a file that has been split.
+SHARD_SUFFIX = '.shard.json'
+# A continuation with this suffix is saved next to the journal of a halted
+# run. It ends like any other continuation so that it can be copied to the
+# input bucket as it is.
+HALTED_SUFFIX = '.halted' + CONTINUATION_SUFFIX
+# Saved next to the journals of a file once every row, in every shard, has
+# been processed.
+COMPLETE_SUFFIX = '.complete.json'
+# The custom metadata key of continuation objects that holds what they point
+# at, so that a redelivered event can still be resolved once the object has
+# been deleted.
+POINTER_KEY = 'checkpoint'
+
+
+@dataclasses.dataclass
+class Checkpoint:
+  """The progress of a function through one generation of an input file."""
+  bucket: str
+  name: str
+  generation: int | None = None
+  offset: int = 0
+  statuses: list[list[Any]] = dataclasses.field(default_factory=list)
+  done: bool = False
+  # Whether every row of the file has been checked before the first row was
+  # processed.
+  validated: bool = False
+  # For a file that has been split, the number of shards. The checkpoint of
+  # each shard also has its index, the byte range of the file it covers and
+  # the header line of the file, which is read before the range.
+  shards: int | None = None
+  shard: int | None = None
+  start: int = 0
+  end: int | None = None
+  header: str = ''
+  # Why the last run stopped before the end of the file without asking to be
+  # continued.
+  halted: str = ''
+  # The continuation object in the input bucket that the file was last
+  # handed to. Only the run it starts works on the file, and the object is
+  # deleted once that run has handed the file on or stopped.
+  continuation: str = ''
+
+  @property
+  def path(self) -> str:
+    """The path that objects about this file or shard are saved under."""
+    path = f'{self.bucket}/{self.name}/{self.generation}'
+    return path if self.shard is None else f'{path}.shard-{self.shard}'
+
+  def record(self, status: str) -> None:
+    """Records the status of the next row and advances the offset.
+
+    Args:
+        status: A short description of the outcome, such as "created".
+    """
+    if self.statuses and self.statuses[-1][0] == status:
+      self.statuses[-1][1] += 1
+    else:
+      self.statuses.append([status, 1])
+    self.offset += 1
+
+  def status_counts(self) -> dict[str, int]:
+    """Returns the number of processed rows for each status."""
+    counts = {}
+    for status, count in self.statuses:
+      counts[status] = counts.get(status, 0) + count
+    return counts
+
+  def row_status(self, row: int) -> str | None:
+    """Returns the status of a processed row, or None if it is not processed.
+
+    Args:
+        row: The zero-based index of the row in the input file.
+    """
+    for status, count in self.statuses:
+      if row < count:
+        return status
+      row -= count
+    return None
+
+
+class CheckpointStore:
+  """Saves and loads checkpoint journals in a Cloud Storage bucket."""
+
+  def __init__(
+      self, storage_client: storage.Client, bucket_name: str) -> None:
+    """Initializes the store.
+
+    Args:
+        storage_client: The Cloud Storage client.
+        bucket_name: The bucket the journals are saved in.
+    """
+    self._storage_client = storage_client
+    self._bucket_name = bucket_name
+
+  def resolve(self, event_data: Mapping[str, Any]) -> Checkpoint | None:
+    """Finds the checkpoint for the object that triggered the function.
+
+    Args:
+        event_data: The data of the Cloud Storage event.
+
+    Returns:
+        The checkpoint to continue from, or None if there is nothing to do
+        because the event is for a journal, the file is already done, it
+        has been handed to another continuation or its last run halted and
+        it is not being resumed.
+    """
+    bucket, name = event_data['bucket'], event_data['name']
+    if name.startswith(
+        (CHECKPOINT_PREFIX, REJECTS_PREFIX, errors.DEAD_LETTER_PREFIX)):
+      return None
+    generation = event_data.get('generation')
+    pointer = {}
+    continuation = ''
+    deleted = False
+    if name.endswith((CONTINUATION_SUFFIX, SHARD_SUFFIX)):
+      blob = self._storage_client.bucket(bucket).blob(name)
+      try:
+        pointer = json.loads(blob.download_as_text())
+      except exceptions.NotFound:
+        # The event was delivered again after the run it started deleted
+        # the object, which its metadata still points at.
+        metadata = event_data.get('metadata') or {}
+        if POINTER_KEY not in metadata:
+          return None
+        pointer = json.loads(metadata[POINTER_KEY])
+        deleted = True
+      continuation = name
+      bucket = pointer['bucket']
+      name = pointer['name']
+      generation = pointer['generation']
+    generation = int(generation) if generation is not None else None
+    shard = pointer.get('shard')
+    checkpoint = self.load(bucket, name, generation, shard)
+    if checkpoint is None:
+      # A shard descriptor holds the whole checkpoint the shard starts from.
+      checkpoint = Checkpoint(
+          **pointer | {'bucket': bucket, 'name': name,
+                       'generation': generation})
+    if checkpoint.done:
+      return None
+    if checkpoint.halted:
+      # Only a continuation that is copied to the input bucket resumes a
+      # halted file.
+      if not continuation or deleted:
+        return None
+      checkpoint.halted = ''
+    elif checkpoint.continuation != continuation:
+      # A later run has taken over the file, so a redelivered event for an
+      # earlier one does not process the same rows again.
+      return None
+    checkpoint.continuation = continuation
+    return checkpoint
+
+  def load(
+      self,
+      bucket: str,
+      name: str,
+      generation: int | None,
+      shard: int | None = None,
+  ) -> Checkpoint | None:
+    """Loads a saved checkpoint.
+
+    Args:
+        bucket: The bucket of the input file.
+        name: The name of the input file.
+        generation: The generation of the input file.
+        shard: The index of the shard, for a file that has been split.
+
+    Returns:
+        The saved checkpoint or None if the file has not been started.
+    """
+    blob = self._journal(Checkpoint(
+        bucket=bucket, name=name, generation=generation, shard=shard))
+    with metrics.span('checkpoint_load'):
+      try:
+        return Checkpoint(**json.loads(blob.download_as_text()))
+      except exceptions.NotFound:
+        return None
+
+  def save(self, checkpoint: Checkpoint) -> None:
+    """Saves the checkpoint, replacing the previous journal for the file.
+
+    The continuation that started the run is deleted once the checkpoint is
+    done or halted, since the run will not hand the file on.
+    """
+    blob = self._journal(checkpoint)
+    with metrics.span('checkpoint_save'):
+      blob.upload_from_string(
+          json.dumps(dataclasses.asdict(checkpoint)),
+          content_type='application/json')
+    if checkpoint.done or checkpoint.halted:
+      self._delete_continuation(checkpoint, checkpoint.continuation)
+
+  def request_continuation(self, checkpoint: Checkpoint) -> None:
+    """Saves the checkpoint and triggers the function again to continue it.
+
+    The continuation that started the run is only deleted once the next one
+    has been written, so that a run that crashes before then is resumed
+    when its event is delivered again.
+
+    Args:
+        checkpoint: The checkpoint of the run that is stopping.
+    """
+    previous = checkpoint.continuation
+    name = f'{checkpoint.name}.{checkpoint.offset}{CONTINUATION_SUFFIX}'
+    if checkpoint.shard is not None:
+      name = (
+          f'{checkpoint.name}.shard-{checkpoint.shard}.{checkpoint.offset}'
+          f'{CONTINUATION_SUFFIX}')
+    checkpoint.continuation = name
+    self.save(checkpoint)
+    self._write_pointer(
+        self._storage_client.bucket(checkpoint.bucket).blob(name),
+        checkpoint)
+    if previous != name:
+      self._delete_continuation(checkpoint, previous)
+
+  def halt(self, checkpoint: Checkpoint, reason: str) -> str:
+    """Saves the checkpoint of a run that stops without being continued.
+
+    Args:
+        checkpoint: The checkpoint of the run that is stopping.
+        reason: Why the run stopped.
+
+    Returns:
+        The name of the continuation object in the checkpoint bucket that
+        resumes the file once it is copied to the input bucket.
+    """
+    checkpoint.halted = reason
+    self.save(checkpoint)
+    name = f'{CHECKPOINT_PREFIX}{checkpoint.path}{HALTED_SUFFIX}'
+    self._write_pointer(
+        self._storage_client.bucket(self._bucket_name).blob(name), checkpoint)
+    return name
+
+  def start_shards(
+      self, checkpoint: Checkpoint, ranges: list[tuple[int, int]],
+      header: str) -> list[Checkpoint]:
+    """Splits a file into shards and triggers the function for each of them.
+
+    The checkpoint of the file is saved as done once the descriptors have
+    been written, so that a retried event does not split the file again.
+    Each descriptor is the continuation of its shard, and is kept until the
+    shard has been handed on or stopped, like any other continuation.
+
+    Args:
+        checkpoint: The checkpoint of the file, which has not been started.
+        ranges: The start and end byte offset of each shard. Each range must
+          start at the beginning of a line.
+        header: The header line of the file, including its line break.
+
+    Returns:
+        The checkpoints of the shards.
+    """
+    shards = [
+        dataclasses.replace(
+            checkpoint, shards=len(ranges), shard=index, start=start,
+            end=end, header=header,
+            continuation=(
+                f'{checkpoint.name}.shard-{index}-of-{len(ranges)}'
+                f'{SHARD_SUFFIX}'))
+        for index, (start, end) in enumerate(ranges)]
+    for shard in shards:
+      blob = self._storage_client.bucket(checkpoint.bucket).blob(
+          shard.continuation)
+      blob.metadata = {POINTER_KEY: json.dumps(_pointer(shard))}
+      blob.upload_from_string(
+          json.dumps(dataclasses.asdict(shard)),
+          content_type='application/json')
+    checkpoint.shards = len(ranges)
+    checkpoint.done = True
+    self.save(checkpoint)
+    return shards
+
+  def complete(self, checkpoint: Checkpoint) -> dict[str, Any] | None:
+    """Saves the completion marker of a file if every shard of it is done.
+
+    Every shard checks once it is done, so the last one to finish saves the
+    marker. Two shards that finish at the same time may both save it.
+
+    Args:
+        checkpoint: The checkpoint of the file or of one of its shards,
+          which is done.
+
+    Returns:
+        The contents of the marker, with the number of rows of each status
+        summed over the shards, or None if some shards are not done yet.
+    """
+    shards = [checkpoint]
+    if checkpoint.shard is not None:
+      shards = [
+          checkpoint if shard == checkpoint.shard else self.load(
+              checkpoint.bucket, checkpoint.name, checkpoint.generation,
+              shard)
+          for shard in range(checkpoint.shards)]
+    if not all(shard is not None and shard.done for shard in shards):
+      return None
+    counts = {}
+    for shard in shards:
+      for status, count in shard.status_counts().items():
+        counts[status] = counts.get(status, 0) + count
+    marker = {
+        'bucket': checkpoint.bucket,
+        'name': checkpoint.name,
+        'generation': checkpoint.generation,
+        'shards': checkpoint.shards or 1,
+        'statuses': counts,
+    }
+    self._storage_client.bucket(self._bucket_name).blob(
+        f'{CHECKPOINT_PREFIX}{checkpoint.bucket}/{checkpoint.name}/'
+        f'{checkpoint.generation}{COMPLETE_SUFFIX}'
+    ).upload_from_string(json.dumps(marker), content_type='application/json')
+    return marker
+
+  def open_source(self, checkpoint: Checkpoint) -> BinaryIO:
+    """Opens the exact generation of the input file the checkpoint refers to.
+
+    For a shard, the file starts with the header line and continues with the
+    byte range of the shard.
+    """
+    source = self._storage_client.bucket(checkpoint.bucket).blob(
+        checkpoint.name, generation=checkpoint.generation).open('rb')
+    if checkpoint.shard is None:
+      return source
+    source.seek(checkpoint.start)
+    return _RangeReader(
+        checkpoint.header.encode('utf-8'), source,
+        checkpoint.end - checkpoint.start)
+
+  def _journal(self, checkpoint: Checkpoint) -> storage.Blob:
+    return self._storage_client.bucket(self._bucket_name).blob(
+        f'{CHECKPOINT_PREFIX}{checkpoint.path}.json')
+
+  def _write_pointer(self, blob: storage.Blob, checkpoint: Checkpoint) -> None:
+    """Writes a continuation object that points at the checkpoint."""
+    pointer = json.dumps(_pointer(checkpoint))
+    blob.metadata = {POINTER_KEY: pointer}
+    blob.upload_from_string(pointer, content_type='application/json')
+
+  def _delete_continuation(self, checkpoint: Checkpoint, name: str) -> None:
+    """Deletes a continuation object of the file, if there is one."""
+    if not name:
+      return
+    try:
+      self._storage_client.bucket(checkpoint.bucket).blob(name).delete()
+    except exceptions.NotFound:
+      pass
+
+
+def _pointer(checkpoint: Checkpoint) -> dict[str, Any]:
+  """Returns the contents of a continuation object for a checkpoint."""
+  pointer = {
+      'bucket': checkpoint.bucket,
+      'name': checkpoint.name,
+      'generation': checkpoint.generation,
+  }
+  if checkpoint.shard is not None:
+    pointer['shard'] = checkpoint.shard
+  return pointer
+
+
+class _RangeReader(io.RawIOBase):
+  """Reads a header followed by a limited number of bytes from a file."""
+
+  def __init__(self, header: bytes, file: BinaryIO, length: int) -> None:
+    super().__init__()
+    self._header = header
+    self._file = file
+    self._remaining = length
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, buffer: Any) -> int:
+    if self._header:
+      size = min(len(buffer), len(self._header))
+      buffer[:size] = self._header[:size]
+      self._header = self._header[size:]
+      return size
+    if self._remaining <= 0:
+      return 0
+    data = self._file.read(min(len(buffer), self._remaining))
+    self._remaining -= len(data)
+    buffer[:len(data)] = data
+    return len(data)
+
+  def close(self) -> None:
+    self._file.close()
+    super().close()
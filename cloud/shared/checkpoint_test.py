@@ -0,0 +1,228 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for checkpoint journals."""
+
+import json
+
+from absl.testing import absltest
+
+from shared import checkpoint
+from shared import testing
+
+
+class CheckpointTest(absltest.TestCase):
+
+  def test_record_run_length_encodes_statuses(self):
+    job = checkpoint.Checkpoint(bucket='input', name='links.csv')
+    for status in ['created', 'created', 'failed', 'created']:
+      job.record(status)
+    self.assertEqual(4, job.offset)
+    self.assertEqual(
+        [['created', 2], ['failed', 1], ['created', 1]], job.statuses)
+    self.assertEqual({'created': 3, 'failed': 1}, job.status_counts())
+    self.assertEqual('failed', job.row_status(2))
+    self.assertIsNone(job.row_status(4))
+
+
+class CheckpointStoreTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.storage_client = testing.FakeStorageClient()
+    self.store = checkpoint.CheckpointStore(self.storage_client, 'journals')
+    self.input = self.storage_client.bucket('input')
+    self.journals = self.storage_client.bucket('journals')
+
+  def test_resolve_starts_new_file_at_zero(self):
+    job = self.store.resolve(
+        {'bucket': 'input', 'name': 'links.csv', 'generation': '7'})
+    self.assertEqual(
+        checkpoint.Checkpoint(bucket='input', name='links.csv', generation=7),
+        job)
+
+  def test_resolve_resumes_saved_checkpoint(self):
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    job.record('created')
+    self.store.save(job)
+    self.assertEqual(job, self.store.resolve(
+        {'bucket': 'input', 'name': 'links.csv', 'generation': '7'}))
+
+  def test_resolve_skips_journals_and_finished_files(self):
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': 'checkpoints/input/links.csv/7.json'}))
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': 'rejects/input/links.csv/7.csv'}))
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': 'dead_letter/links.csv/7/part-0.csv'}))
+    self.store.save(checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7, done=True))
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': 'links.csv', 'generation': '7'}))
+
+  def test_request_continuation_is_resolved_to_saved_checkpoint(self):
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    job.record('created')
+    self.store.request_continuation(job)
+    continuation = f'links.csv.1{checkpoint.CONTINUATION_SUFFIX}'
+    self.assertIn(continuation, self.input.objects)
+    resumed = self.store.resolve(
+        {'bucket': 'input', 'name': continuation, 'generation': '1'})
+    self.assertEqual((1, continuation), (resumed.offset, resumed.continuation))
+    # The continuation is kept until the run it started is done.
+    self.assertIn(continuation, self.input.objects)
+    resumed.done = True
+    self.store.save(resumed)
+    self.assertNotIn(continuation, self.input.objects)
+
+  def test_crashed_continued_run_resumes_when_event_is_redelivered(self):
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    job.record('created')
+    self.store.request_continuation(job)
+    first = f'links.csv.1{checkpoint.CONTINUATION_SUFFIX}'
+    event = {
+        'bucket': 'input', 'name': first, 'generation': '1',
+        'metadata': self.input.metadata[first]}
+    resumed = self.store.resolve(event)
+    resumed.record('created')
+    self.store.save(resumed)
+    # The run crashes, and the same event resumes from its last save.
+    resumed = self.store.resolve(event)
+    self.assertEqual(2, resumed.offset)
+    resumed.record('created')
+    self.store.request_continuation(resumed)
+    second = f'links.csv.3{checkpoint.CONTINUATION_SUFFIX}'
+    self.assertNotIn(first, self.input.objects)
+    # Once the file has been handed on, the first event does nothing.
+    self.assertIsNone(self.store.resolve(event))
+    resumed = self.store.resolve({
+        'bucket': 'input', 'name': second, 'generation': '1',
+        'metadata': self.input.metadata[second]})
+    self.assertEqual(3, resumed.offset)
+    resumed.done = True
+    self.store.save(resumed)
+    self.assertEmpty(self.input.objects)
+    self.assertIsNone(self.store.resolve(event))
+
+  def test_redelivered_event_of_deleted_continuation_loads_journal(self):
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    job.record('created')
+    self.store.request_continuation(job)
+    name = f'links.csv.1{checkpoint.CONTINUATION_SUFFIX}'
+    metadata = self.input.metadata[name]
+    del self.input.objects[name]
+    resumed = self.store.resolve({
+        'bucket': 'input', 'name': name, 'generation': '1',
+        'metadata': metadata})
+    self.assertEqual(1, resumed.offset)
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': name, 'generation': '1'}))
+
+  def test_halted_file_only_resumes_from_copied_continuation(self):
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    job.record('created')
+    name = self.store.halt(job, 'credentials rejected')
+    self.assertEqual(
+        f'checkpoints/input/links.csv/7{checkpoint.HALTED_SUFFIX}', name)
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': 'links.csv', 'generation': '7'}))
+    # Copying the continuation to the input bucket resumes the file.
+    copied = 'links.csv.halted.continue.json'
+    self.input.objects[copied] = self.journals.objects[name]
+    resumed = self.store.resolve(
+        {'bucket': 'input', 'name': copied, 'generation': '1'})
+    self.assertEqual(1, resumed.offset)
+    self.assertEqual('', resumed.halted)
+
+  def test_shards_start_from_descriptors_and_read_their_range(self):
+    self.input.objects['links.csv'] = b'id\n1\n2\n3\n'
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    self.store.start_shards(job, [(3, 7), (7, 9)], 'id\n')
+    self.assertTrue(job.done)
+    self.assertEqual(2, job.shards)
+    self.assertIsNone(self.store.resolve(
+        {'bucket': 'input', 'name': 'links.csv', 'generation': '7'}))
+    descriptor = f'links.csv.shard-1-of-2{checkpoint.SHARD_SUFFIX}'
+    shard = self.store.resolve({'bucket': 'input', 'name': descriptor})
+    self.assertIn(descriptor, self.input.objects)
+    self.assertEqual((1, 2, 7, 9), (
+        shard.shard, shard.shards, shard.start, shard.end))
+    self.assertEqual(b'id\n3\n', self.store.open_source(shard).read())
+
+  def test_crashed_shard_resumes_when_descriptor_event_is_replayed(self):
+    job = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7)
+    shards = self.store.start_shards(job, [(3, 7), (7, 9)], 'id\n')
+    descriptor = f'links.csv.shard-0-of-2{checkpoint.SHARD_SUFFIX}'
+    event = {
+        'bucket': 'input', 'name': descriptor,
+        'metadata': self.input.metadata[descriptor]}
+    # The shard crashes before its journal is first saved.
+    self.store.resolve(event).record('published')
+    shard = self.store.resolve(event)
+    self.assertEqual((0, 3, 7), (shard.offset, shard.start, shard.end))
+    # It crashes again after saving its journal.
+    shard.record('published')
+    self.store.save(shard)
+    shard = self.store.resolve(event)
+    self.assertEqual(1, shard.offset)
+    shard.record('published')
+    shard.done = True
+    self.store.save(shard)
+    self.assertNotIn(descriptor, self.input.objects)
+    self.assertIsNone(self.store.resolve(event))
+    shards[1].record('published')
+    shards[1].done = True
+    self.store.save(shards[1])
+    self.assertEqual(
+        {'published': 3}, self.store.complete(shards[1])['statuses'])
+
+  def test_shard_continuation_is_resolved_to_shard_checkpoint(self):
+    shard = checkpoint.Checkpoint(
+        bucket='input', name='links.csv', generation=7, shards=2, shard=1,
+        start=7, end=9, header='id\n')
+    shard.record('published')
+    self.store.request_continuation(shard)
+    continuation = f'links.csv.shard-1.1{checkpoint.CONTINUATION_SUFFIX}'
+    self.assertEqual(shard, self.store.resolve(
+        {'bucket': 'input', 'name': continuation}))
+
+  def test_complete_waits_for_every_shard(self):
+    shards = [
+        checkpoint.Checkpoint(
+            bucket='input', name='links.csv', generation=7, shards=2,
+            shard=index)
+        for index in range(2)]
+    for shard in shards:
+      shard.record('published')
+      shard.done = True
+    self.assertIsNone(self.store.complete(shards[0]))
+    self.store.save(shards[0])
+    marker = self.store.complete(shards[1])
+    self.assertEqual(
+        {'bucket': 'input', 'name': 'links.csv', 'generation': 7,
+         'shards': 2, 'statuses': {'published': 2}},
+        marker)
+    self.assertEqual(marker, json.loads(self.journals.text(
+        'checkpoints/input/links.csv/7.complete.json')))
+
+
+if __name__ == '__main__':
+  absltest.main()
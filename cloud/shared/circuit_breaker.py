@@ -0,0 +1,192 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stops sending requests with credentials that are no longer accepted.
+
+A revoked or expired refresh token fails every operation the same way, each
+after a token refresh and an API round-trip. The breaker opens once
+THRESHOLD operations in a row failed to authenticate, or as many as the
+CIRCUIT_BREAKER_THRESHOLD environment variable sets. While it is open,
+operations fail straight away with CircuitOpenError. After COOLDOWN seconds,
+or CIRCUIT_BREAKER_COOLDOWN, the next operations are sent again as probes:
+one success closes the breaker and another authentication failure opens it
+for another cooldown.
+"""
+
+from collections.abc import Callable, Iterator, Mapping
+import contextlib
+import os
+import threading
+import time
+from typing import Any
+
+from shared import metrics
+
+THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_THRESHOLD', 5))
+COOLDOWN = float(os.environ.get('CIRCUIT_BREAKER_COOLDOWN', 300))
+
+
+class CircuitOpenError(Exception):
+  """Raised instead of sending a request while the breaker is open."""
+
+
+def is_auth_failure(error: BaseException) -> bool:
+  """Returns whether an error means the credentials are not accepted.
+
+  This covers UNAUTHENTICATED errors, token refreshes rejected with
+  invalid_grant and an open breaker. PERMISSION_DENIED is left out: valid
+  credentials get it for any property they cannot access, which says nothing
+  about the operations for other properties.
+  """
+  if isinstance(error, CircuitOpenError):
+    return True
+  status = metrics.status_name(error)
+  if status == 'RefreshError':
+    return _refresh_error_code(error) == 'invalid_grant'
+  return status == 'UNAUTHENTICATED'
+
+
+def _refresh_error_code(error: BaseException) -> str:
+  """Returns the OAuth 2.0 error code of a failed token refresh."""
+  # The token endpoint response follows the message when there is one.
+  for arg in error.args[1:]:
+    if isinstance(arg, Mapping):
+      return str(arg.get('error', ''))
+  # Otherwise the message starts with the code, as in "invalid_grant: ...".
+  message = str(error.args[0]) if error.args else ''
+  return message.partition(':')[0].strip()
+
+
+class CircuitBreaker:
+  """Counts the authentication failures in a row for one set of credentials.
+
+  Safe to share between threads.
+  """
+
+  def __init__(
+      self,
+      threshold: int | None = None,
+      cooldown: float | None = None,
+      clock: Callable[[], float] = time.monotonic,
+  ) -> None:
+    """Initializes the breaker.
+
+    Args:
+        threshold: The number of authentication failures in a row that open
+          the breaker. Defaults to THRESHOLD.
+        cooldown: The number of seconds the breaker stays open. Defaults to
+          COOLDOWN.
+        clock: Returns the current time in seconds.
+    """
+    self._threshold = threshold or THRESHOLD
+    self._cooldown = COOLDOWN if cooldown is None else cooldown
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._failures = 0
+    self._opened_at = None
+    self.last_error = None
+
+  @property
+  def is_open(self) -> bool:
+    """Whether operations should fail without being sent."""
+    with self._lock:
+      return (
+          self._opened_at is not None
+          and self._clock() - self._opened_at < self._cooldown)
+
+  def record(self, error: BaseException | None) -> None:
+    """Records the outcome of an operation.
+
+    Args:
+        error: The error the operation failed with, or None if it succeeded.
+          Errors that are not authentication failures neither open nor
+          close the breaker.
+    """
+    with self._lock:
+      if error is None:
+        self._failures = 0
+        self._opened_at = None
+      elif is_auth_failure(error) and not isinstance(error, CircuitOpenError):
+        self._failures += 1
+        self.last_error = error
+        if self._failures >= self._threshold:
+          self._opened_at = self._clock()
+
+  def check(self) -> None:
+    """Raises CircuitOpenError if the breaker is open."""
+    if self.is_open:
+      raise CircuitOpenError(
+          f'{self._failures} operations in a row failed to authenticate, '
+          f'last with: {self.last_error}')
+
+  @contextlib.contextmanager
+  def guard(self) -> Iterator[None]:
+    """Checks the breaker before an operation and records its outcome."""
+    self.check()
+    try:
+      yield
+    except Exception as e:
+      self.record(e)
+      raise
+    self.record(None)
+
+
+class CircuitBreakers:
+  """Keeps a breaker for each set of credentials that an instance uses."""
+
+  def __init__(self, **kwargs: Any) -> None:
+    """Initializes the breakers.
+
+    Args:
+        **kwargs: Passed to each CircuitBreaker.
+    """
+    self._kwargs = kwargs
+    self._breakers = {}
+    self._lock = threading.Lock()
+
+  def get(self, key: Any) -> CircuitBreaker:
+    """Returns the breaker for a key, such as client_cache.cache_key()."""
+    with self._lock:
+      if key not in self._breakers:
+        self._breakers[key] = CircuitBreaker(**self._kwargs)
+      return self._breakers[key]
+
+  def clear(self) -> None:
+    """Forgets every breaker."""
+    with self._lock:
+      self._breakers.clear()
+
+
+def check_credentials(values: Mapping[str, Any]) -> None:
+  """Refreshes an access token once to check that the credentials work.
+
+  Args:
+      values: The OAuth 2.0 refresh token, token URI, client ID, client
+        secret and scopes.
+
+  Raises:
+      google.auth.exceptions.RefreshError: If the token cannot be refreshed,
+        such as with invalid_grant for a revoked refresh token.
+  """
+  # Imported here so that functions only load the transport when they check.
+  import google.auth.transport.requests  # pylint: disable=g-import-not-at-top
+  import google.oauth2.credentials  # pylint: disable=g-import-not-at-top
+  credentials = google.oauth2.credentials.Credentials(
+      token=None,
+      refresh_token=values['refresh_token'],
+      token_uri=values['token_uri'],
+      client_id=values['client_id'],
+      client_secret=values['client_secret'],
+      scopes=values['scopes'])
+  credentials.refresh(google.auth.transport.requests.Request())
@@ -0,0 +1,99 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the authentication circuit breaker."""
+
+from absl.testing import absltest
+from google.api_core import exceptions
+from google.auth.exceptions import RefreshError
+
+from shared import circuit_breaker
+from shared import testing
+
+
+class CircuitBreakerTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.clock = testing.FakeClock()
+    self.breaker = circuit_breaker.CircuitBreaker(
+        threshold=2, cooldown=60, clock=self.clock)
+
+  def test_opens_after_auth_failures_in_a_row(self):
+    self.breaker.record(exceptions.Unauthenticated('expired'))
+    self.assertFalse(self.breaker.is_open)
+    self.breaker.record(RefreshError('invalid_grant: Token has been revoked.'))
+    self.assertTrue(self.breaker.is_open)
+    with self.assertRaisesRegex(
+        circuit_breaker.CircuitOpenError, 'invalid_grant'):
+      self.breaker.check()
+
+  def test_success_and_other_errors_do_not_open_it(self):
+    self.breaker.record(exceptions.Unauthenticated('expired'))
+    self.breaker.record(None)
+    self.breaker.record(exceptions.Unauthenticated('expired'))
+    self.breaker.record(exceptions.ServiceUnavailable('unavailable'))
+    self.breaker.record(exceptions.InvalidArgument('bad'))
+    self.assertFalse(self.breaker.is_open)
+
+  def test_only_counts_unauthenticated_and_invalid_grant(self):
+    for error in [
+        # Valid credentials without access to one property.
+        exceptions.PermissionDenied('denied'),
+        RefreshError(
+            'temporarily_unavailable: retry invalid_grant later',
+            {'error': 'temporarily_unavailable'}),
+        ValueError('invalid_grant'),
+    ]:
+      self.assertFalse(circuit_breaker.is_auth_failure(error), error)
+    for error in [
+        exceptions.Unauthenticated('expired'),
+        RefreshError('invalid_grant: Token has been revoked.'),
+        RefreshError(
+            'invalid_grant: Bad Request', {'error': 'invalid_grant'}),
+    ]:
+      self.assertTrue(circuit_breaker.is_auth_failure(error), error)
+
+  def test_probes_after_cooldown(self):
+    for _ in range(2):
+      self.breaker.record(exceptions.Unauthenticated('expired'))
+    self.clock.now = 61
+    self.assertFalse(self.breaker.is_open)
+    self.breaker.record(exceptions.Unauthenticated('expired'))
+    self.assertTrue(self.breaker.is_open)
+    self.clock.now = 122
+    with self.breaker.guard():
+      pass
+    self.assertFalse(self.breaker.is_open)
+
+  def test_guard_fails_fast_while_open(self):
+    calls = []
+    for _ in range(3):
+      try:
+        with self.breaker.guard():
+          calls.append(1)
+          raise exceptions.Unauthenticated('expired')
+      except (exceptions.Unauthenticated, circuit_breaker.CircuitOpenError):
+        pass
+    self.assertLen(calls, 2)
+
+  def test_breakers_are_kept_per_key(self):
+    breakers = circuit_breaker.CircuitBreakers(threshold=1)
+    breakers.get('a').record(exceptions.Unauthenticated('expired'))
+    self.assertTrue(breakers.get('a').is_open)
+    self.assertFalse(breakers.get('b').is_open)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,169 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches OAuth credentials and API clients on warm function instances.
+
+Creating new credentials for every message means every message pays for an
+access token refresh and a new gRPC channel. The cache keeps one set of
+credentials and one client per OAuth identity, reuses the access token while
+it is valid and refreshes it shortly before it expires.
+"""
+
+import collections
+from collections.abc import Callable, Sequence
+import datetime
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Generic, TypeVar
+
+import google.auth.transport.requests
+import google.oauth2.credentials
+
+from shared import metrics
+
+_Client = TypeVar('_Client')
+
+DEFAULT_MAX_SIZE = 16
+DEFAULT_TTL = 3600
+# Access tokens expiring within this many seconds are refreshed before use.
+REFRESH_MARGIN = 300
+
+
+def cache_key(
+    client_id: str, refresh_token: str, scopes: Sequence[str]) -> str:
+  """Returns a hash identifying an OAuth identity without storing secrets."""
+  digest = hashlib.sha256()
+  for part in (client_id, refresh_token, *sorted(scopes)):
+    digest.update(str(part).encode('utf-8'))
+    digest.update(b'\0')
+  return digest.hexdigest()
+
+
+class _Entry(Generic[_Client]):
+
+  def __init__(
+      self,
+      credentials: google.oauth2.credentials.Credentials,
+      client: _Client,
+      created: float) -> None:
+    self.credentials = credentials
+    self.client = client
+    self.created = created
+    self.lock = threading.Lock()
+
+
+class ClientCache(Generic[_Client]):
+  """A size and age bounded cache of credentials and API clients."""
+
+  def __init__(
+      self,
+      max_size: int = DEFAULT_MAX_SIZE,
+      ttl: float = DEFAULT_TTL,
+      clock: Callable[[], float] = time.monotonic,
+  ) -> None:
+    """Initializes the cache.
+
+    Args:
+        max_size: The least recently used entry is evicted when the cache
+          holds more entries than this.
+        ttl: Entries older than this many seconds are recreated.
+        clock: Returns the current time in seconds.
+    """
+    self._max_size = max_size
+    self._ttl = ttl
+    self._clock = clock
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_env(cls) -> 'ClientCache':
+    """Creates a cache configured by the CLIENT_CACHE_SIZE and
+    CLIENT_CACHE_TTL environment variables.
+    """
+    return cls(
+        max_size=int(os.environ.get('CLIENT_CACHE_SIZE', DEFAULT_MAX_SIZE)),
+        ttl=float(os.environ.get('CLIENT_CACHE_TTL', DEFAULT_TTL)))
+
+  def get(
+      self,
+      refresh_token: str,
+      token_uri: str,
+      client_id: str,
+      client_secret: str,
+      scopes: Sequence[str],
+      create_client: Callable[[google.oauth2.credentials.Credentials],
+                              _Client],
+  ) -> _Client:
+    """Returns the cached client for the OAuth identity, creating it if needed.
+
+    Args:
+        refresh_token: The OAuth 2.0 refresh token.
+        token_uri: The OAuth 2.0 authorization server’s token endpoint URI.
+        client_id: The OAuth 2.0 client ID.
+        client_secret: The OAuth 2.0 client secret.
+        scopes: The OAuth 2.0 permission scopes.
+        create_client: Creates an API client from the credentials.
+
+    Returns:
+        The API client.
+    """
+    key = cache_key(client_id, refresh_token, scopes)
+    now = self._clock()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and now - entry.created >= self._ttl:
+        del self._entries[key]
+        entry = None
+      if entry is None:
+        metrics.count('client_cache.miss')
+        credentials = google.oauth2.credentials.Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            token_uri=token_uri,
+            client_id=client_id,
+            client_secret=client_secret,
+            scopes=scopes)
+        entry = _Entry(credentials, create_client(credentials), now)
+        self._entries[key] = entry
+        while len(self._entries) > self._max_size:
+          self._entries.popitem(last=False)
+      self._entries.move_to_end(key)
+    _refresh_if_expiring(entry)
+    return entry.client
+
+  def clear(self) -> None:
+    """Removes every entry from the cache."""
+    with self._lock:
+      self._entries.clear()
+
+
+def _refresh_if_expiring(entry: _Entry[Any]) -> None:
+  """Refreshes a previously issued access token that is about to expire.
+
+  Credentials that have no token yet are left alone and refreshed by the
+  client on its first request. The entry lock makes sure that concurrent
+  callers wait for a single refresh instead of each refreshing the token.
+  """
+  credentials = entry.credentials
+  if not credentials.token or credentials.expiry is None:
+    return
+  with entry.lock:
+    # google-auth stores expiry as a naive UTC datetime.
+    remaining = credentials.expiry - datetime.datetime.now(
+        datetime.timezone.utc).replace(tzinfo=None)
+    if remaining.total_seconds() < REFRESH_MARGIN:
+      with metrics.span('token_refresh'):
+        credentials.refresh(google.auth.transport.requests.Request())
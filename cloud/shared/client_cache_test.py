@@ -0,0 +1,87 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the credentials and client cache."""
+
+import datetime
+from unittest import mock
+
+from absl.testing import absltest
+
+from shared import client_cache
+
+
+class ClientCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.now = 0.0
+    self.cache = client_cache.ClientCache(
+        max_size=2, ttl=100, clock=lambda: self.now)
+    self.create_client = mock.Mock(side_effect=lambda c: mock.Mock())
+
+  def get(self, refresh_token='token'):
+    return self.cache.get(
+        refresh_token, 'https://oauth2.googleapis.com/token', 'id', 'secret',
+        ['https://www.googleapis.com/auth/analytics.edit'],
+        self.create_client)
+
+  def test_get_reuses_client_for_same_identity(self):
+    self.assertIs(self.get(), self.get())
+    self.create_client.assert_called_once()
+
+  def test_get_creates_client_per_identity(self):
+    self.assertIsNot(self.get('a'), self.get('b'))
+    self.assertEqual(2, self.create_client.call_count)
+
+  def test_get_recreates_client_after_ttl(self):
+    client = self.get()
+    self.now = 100
+    self.assertIsNot(client, self.get())
+
+  def test_get_evicts_least_recently_used_client(self):
+    client = self.get('a')
+    self.get('b')
+    self.get('a')
+    self.get('c')
+    self.assertIs(client, self.get('a'))
+    self.assertEqual(3, self.create_client.call_count)
+    self.get('b')
+    self.assertEqual(4, self.create_client.call_count)
+
+  def test_get_refreshes_token_close_to_expiry(self):
+    self.get()
+    credentials = self.create_client.call_args.args[0]
+    credentials.token = 'access'
+    credentials.expiry = datetime.datetime.now(
+        datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(
+            seconds=60)
+    with mock.patch.object(credentials, 'refresh') as refresh:
+      self.get()
+      refresh.assert_called_once()
+
+  def test_get_does_not_refresh_valid_token(self):
+    self.get()
+    credentials = self.create_client.call_args.args[0]
+    credentials.token = 'access'
+    credentials.expiry = datetime.datetime.now(
+        datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(
+            hours=1)
+    with mock.patch.object(credentials, 'refresh') as refresh:
+      self.get()
+      refresh.assert_not_called()
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,152 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resolves credential profile IDs to OAuth credentials.
+
+Instead of copying the OAuth client secret and refresh token into every
+pub/sub message, the publisher can send a short profile ID. The credentials
+for the profile are stored as a JSON secret in Secret Manager. They are
+fetched again once they are older than the TTL, and straight away after the
+API rejects them, so that a rotated secret is picked up.
+"""
+
+from collections.abc import Callable, Mapping
+import json
+import os
+import threading
+import time
+from typing import Any
+
+# The message key that holds the profile ID.
+PROFILE_KEY = 'credential_profile'
+# The keys the secret for a profile must contain.
+CREDENTIAL_KEYS = (
+    'client_id',
+    'client_secret',
+    'refresh_token',
+    'token_uri',
+    'scopes',
+)
+DEFAULT_TTL = 3600
+
+
+class CredentialProfiles:
+  """Looks up and caches the credentials for each profile ID."""
+
+  def __init__(
+      self,
+      project_id: str | None = None,
+      fetch_secret: Callable[[str], str] | None = None,
+      ttl: float = DEFAULT_TTL,
+      clock: Callable[[], float] = time.monotonic,
+  ) -> None:
+    """Initializes the registry.
+
+    Args:
+        project_id: The Cloud project that holds the secrets. Defaults to the
+          PROJECT_ID environment variable.
+        fetch_secret: Returns the payload of a secret version given its
+          resource name. Defaults to reading it from Secret Manager.
+        ttl: Credentials older than this many seconds are fetched again.
+        clock: Returns the current time in seconds.
+    """
+    self._project_id = project_id or os.environ.get('PROJECT_ID')
+    self._fetch_secret = fetch_secret or _access_secret_version
+    self._ttl = ttl
+    self._clock = clock
+    self._profiles = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_env(cls) -> 'CredentialProfiles':
+    """Creates a registry configured by the CREDENTIAL_PROFILE_TTL environment
+    variable.
+    """
+    return cls(ttl=float(os.environ.get('CREDENTIAL_PROFILE_TTL', DEFAULT_TTL)))
+
+  def resolve(self, data: Mapping[str, Any]) -> dict[str, Any]:
+    """Adds the credentials for the message's profile to the message values.
+
+    Messages without a profile ID are returned unchanged, so messages that
+    still carry the credentials themselves keep working.
+
+    Args:
+        data: The decoded message.
+
+    Returns:
+        The message values with the credential keys filled in.
+    """
+    if PROFILE_KEY not in data:
+      return dict(data)
+    return dict(data) | self.get(data[PROFILE_KEY])
+
+  def get(self, profile_id: str) -> dict[str, Any]:
+    """Returns the credentials for a profile, fetching them if needed.
+
+    The credentials are fetched the first time the profile is seen, once the
+    fetched credentials are older than the TTL and after invalidate.
+
+    Args:
+        profile_id: The name of the secret that holds the credentials, or the
+          full resource name of a secret version.
+
+    Returns:
+        A dictionary with the CREDENTIAL_KEYS.
+
+    Raises:
+        ValueError: If the secret does not contain all of the CREDENTIAL_KEYS.
+    """
+    now = self._clock()
+    with self._lock:
+      cached = self._profiles.get(profile_id)
+      if cached is None or now - cached[0] >= self._ttl:
+        if profile_id.startswith('projects/'):
+          name = profile_id
+        else:
+          name = (
+              f'projects/{self._project_id}/secrets/{profile_id}'
+              '/versions/latest')
+        credentials = json.loads(self._fetch_secret(name))
+        missing_keys = [k for k in CREDENTIAL_KEYS if k not in credentials]
+        if missing_keys:
+          raise ValueError(
+              f'Credential profile {profile_id} is missing keys: '
+              f"{','.join(missing_keys)}")
+        cached = (now, {key: credentials[key] for key in CREDENTIAL_KEYS})
+        self._profiles[profile_id] = cached
+      return cached[1]
+
+  def invalidate(self, profile_id: str) -> None:
+    """Forgets the credentials of a profile, so the next get fetches them.
+
+    Called when the API rejects the credentials, which happens once the
+    secret has been rotated and the old refresh token revoked.
+    """
+    with self._lock:
+      self._profiles.pop(profile_id, None)
+
+  def clear(self) -> None:
+    """Forgets every fetched profile."""
+    with self._lock:
+      self._profiles.clear()
+
+
+def _access_secret_version(name: str) -> str:
+  """Reads the payload of a secret version from Secret Manager."""
+  # Imported here so that functions that never receive a profile ID do not
+  # need the Secret Manager client.
+  from google.cloud import secretmanager  # pylint: disable=g-import-not-at-top
+  client = secretmanager.SecretManagerServiceClient()
+  response = client.access_secret_version(name=name)
+  return response.payload.data.decode('utf-8')
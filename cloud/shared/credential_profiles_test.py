@@ -0,0 +1,88 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for credential profiles."""
+
+import json
+from unittest import mock
+
+from absl.testing import absltest
+
+from shared import credential_profiles
+from shared import testing
+
+
+class CredentialProfilesTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.credentials = {
+        'client_id': '123',
+        'client_secret': 'ABC',
+        'refresh_token': '123ABC',
+        'token_uri': 'google.com',
+        'scopes': ['https://www.googleapis.com/auth/analytics.edit'],
+    }
+    self.fetch_secret = mock.Mock(return_value=json.dumps(self.credentials))
+    self.profiles = credential_profiles.CredentialProfiles(
+        project_id='project', fetch_secret=self.fetch_secret)
+
+  def test_resolve_adds_profile_credentials(self):
+    data = {'credential_profile': 'agency', 'action': 'create'}
+    self.assertEqual(
+        data | self.credentials, self.profiles.resolve(data))
+    self.fetch_secret.assert_called_once_with(
+        'projects/project/secrets/agency/versions/latest')
+
+  def test_resolve_fetches_each_profile_once(self):
+    for _ in range(3):
+      self.profiles.resolve({'credential_profile': 'agency'})
+    self.fetch_secret.assert_called_once()
+
+  def test_get_fetches_profile_again_after_ttl(self):
+    clock = testing.FakeClock()
+    profiles = credential_profiles.CredentialProfiles(
+        project_id='project', fetch_secret=self.fetch_secret, ttl=60,
+        clock=clock)
+    profiles.get('agency')
+    clock.now = 59
+    profiles.get('agency')
+    self.fetch_secret.assert_called_once()
+    clock.now = 60
+    profiles.get('agency')
+    self.assertEqual(2, self.fetch_secret.call_count)
+
+  def test_invalidate_fetches_profile_again(self):
+    self.profiles.get('agency')
+    self.credentials['refresh_token'] = 'rotated'
+    self.fetch_secret.return_value = json.dumps(self.credentials)
+    self.profiles.invalidate('agency')
+    self.assertEqual('rotated', self.profiles.get('agency')['refresh_token'])
+    self.assertEqual(2, self.fetch_secret.call_count)
+    self.profiles.invalidate('unknown')
+
+  def test_resolve_leaves_messages_without_profile_unchanged(self):
+    data = {'action': 'create'}
+    self.assertEqual(data, self.profiles.resolve(data))
+    self.fetch_secret.assert_not_called()
+
+  def test_get_raises_error_for_incomplete_secret(self):
+    del self.credentials['refresh_token']
+    self.fetch_secret.return_value = json.dumps(self.credentials)
+    with self.assertRaisesRegex(ValueError, 'missing keys: refresh_token'):
+      self.profiles.get('agency')
+
+
+if __name__ == '__main__':
+  absltest.main()
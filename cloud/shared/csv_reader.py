@@ -0,0 +1,119 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streams the rows of input CSV files.
+
+Files are read in chunks so that memory stays bounded regardless of the file
+size and the first rows can be processed before the whole file has been
+downloaded.
+"""
+
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+import csv
+import io
+import os
+from typing import Any, BinaryIO, TextIO, TYPE_CHECKING
+
+from shared import metrics
+
+if TYPE_CHECKING:
+  import pandas  # pylint: disable=g-import-not-at-top
+
+CHUNK_SIZE = 1000
+
+
+def read_frames(
+    file_name: str | BinaryIO,
+    chunk_size: int | None = None,
+    on_bad_line: Callable[[list[str]], None] | None = None,
+) -> Iterator['pandas.DataFrame']:
+  """Lazily yields the rows of a CSV file as data frames of strings.
+
+  Every value is kept as it is written in the file, so that IDs are not turned
+  into floats by blank cells and leading zeros are kept. Blank cells are empty
+  strings.
+
+  Args:
+      file_name: A local path of the CSV file, or a file opened for reading.
+      chunk_size: The number of rows in each frame. Defaults to the
+        CSV_CHUNK_SIZE environment variable or CHUNK_SIZE.
+      on_bad_line: Called with the fields of each line that has more fields
+        than the header. Such lines are skipped either way, but are only
+        reported with the slower Python parser.
+
+  Yields:
+      A data frame for each chunk of rows.
+  """
+  import pandas  # pylint: disable=g-import-not-at-top
+  chunk_size = chunk_size or int(os.environ.get('CSV_CHUNK_SIZE', CHUNK_SIZE))
+  if not isinstance(file_name, str):
+    file_name = io.BufferedReader(_TimedReader(file_name))
+  options = {'on_bad_lines': 'skip'}
+  if on_bad_line is not None:
+    options = {'engine': 'python', 'on_bad_lines': on_bad_line}
+  with pandas.read_csv(
+      file_name, chunksize=chunk_size, dtype=str, keep_default_na=False,
+      **options) as reader:
+    while True:
+      with metrics.span('csv_read'):
+        chunk = next(reader, None)
+      if chunk is None:
+        return
+      yield chunk
+
+
+def write_records(
+    records: Iterable[Mapping[str, Any]],
+    file: TextIO,
+    columns: Sequence[str] | None = None,
+) -> int:
+  """Writes rows to a CSV file one at a time.
+
+  Args:
+      records: The rows to write.
+      file: A text file opened for writing, such as a Cloud Storage blob
+        opened with blob.open('w').
+      columns: The columns to write, where rows without a column leave it
+        blank. Defaults to the columns of the first row.
+
+  Returns:
+      The number of rows written.
+  """
+  writer = None
+  count = 0
+  for record in records:
+    if writer is None:
+      writer = csv.DictWriter(
+          file, fieldnames=list(columns or record), restval='')
+      writer.writeheader()
+    writer.writerow(record)
+    count += 1
+  return count
+
+
+class _TimedReader(io.RawIOBase):
+  """Records the time spent reading from a file as the csv_download stage."""
+
+  def __init__(self, file: BinaryIO) -> None:
+    super().__init__()
+    self._file = file
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, buffer: Any) -> int:
+    with metrics.span('csv_download'):
+      data = self._file.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
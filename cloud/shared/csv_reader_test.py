@@ -0,0 +1,51 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for streaming CSV reads and writes."""
+
+import io
+
+from absl.testing import absltest
+
+from shared import csv_reader
+
+
+class CsvReaderTest(absltest.TestCase):
+
+  def test_read_frames_keeps_values_as_written(self):
+    bad_lines = []
+    frames = list(csv_reader.read_frames(
+        io.BytesIO(b'ga4_property_id,customer_id\n01,\n2,3,4\n5,6\n'),
+        chunk_size=10,
+        on_bad_line=bad_lines.append))
+    self.assertEqual(
+        [{'ga4_property_id': '01', 'customer_id': ''},
+         {'ga4_property_id': '5', 'customer_id': '6'}],
+        frames[0].to_dict('records'))
+    self.assertEqual([['2', '3', '4']], bad_lines)
+
+  def test_write_records_writes_header_and_rows(self):
+    file = io.StringIO()
+    count = csv_reader.write_records(
+        ({'ga4_property_id': index, 'request_type': request_type}
+         for index, request_type in enumerate(['ads', 'dv360', 'ads'], 1)),
+        file)
+    self.assertEqual(3, count)
+    self.assertEqual(
+        'ga4_property_id,request_type\r\n1,ads\r\n2,dv360\r\n3,ads\r\n',
+        file.getvalue())
+
+
+if __name__ == '__main__':
+  absltest.main()
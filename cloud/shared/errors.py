@@ -0,0 +1,163 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Classifies failed operations and schedules the ones worth retrying.
+
+Errors are grouped by their gRPC status. Transient and quota errors are
+likely to succeed later, so the operation is retried with exponential
+backoff until it has been attempted RETRY_MAX_ATTEMPTS times. Every other
+error is permanent, and the operation goes to a dead-letter report instead.
+
+Operations that are retried carry their attempt number and the time they
+may be retried at, so that the retry survives being written to a file or a
+message and read back by another instance. A retry that is delivered before
+it is due fails with RetryNotDueError, so that the retry policy of its
+message or storage event delivers it again later instead of an instance
+waiting for it.
+"""
+
+from collections.abc import Callable, Mapping
+import enum
+import os
+import time
+from typing import Any
+
+from shared import metrics
+
+# The number of attempts, including the first one, after which a failed
+# operation is dead-lettered.
+MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 4))
+# The delay before the first retry, which doubles for each later attempt.
+BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 30))
+# The longest delay.
+MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 300))
+
+# Operations that failed for good are written under this prefix. Functions
+# ignore storage events for these objects.
+DEAD_LETTER_PREFIX = 'dead_letter/'
+
+# The keys that retry and dead-letter records add to the operation.
+ATTEMPT_KEY = 'attempt'
+RETRY_AFTER_KEY = 'retry_after'
+ERROR_CLASS_KEY = 'error_class'
+ERROR_KEY = 'error'
+
+
+class ErrorClass(enum.Enum):
+  """Why an operation failed."""
+  TRANSIENT = 'transient'
+  QUOTA = 'quota'
+  PERMISSION = 'permission'
+  INVALID_ARGUMENT = 'invalid_argument'
+  ALREADY_EXISTS = 'already_exists'
+  NOT_FOUND = 'not_found'
+  UNKNOWN = 'unknown'
+
+
+# The class of each gRPC status name, or of the type name of errors without
+# a status.
+_CLASSES = {
+    'UNAVAILABLE': ErrorClass.TRANSIENT,
+    'DEADLINE_EXCEEDED': ErrorClass.TRANSIENT,
+    'INTERNAL': ErrorClass.TRANSIENT,
+    'ABORTED': ErrorClass.TRANSIENT,
+    'RESOURCE_EXHAUSTED': ErrorClass.QUOTA,
+    'PERMISSION_DENIED': ErrorClass.PERMISSION,
+    'UNAUTHENTICATED': ErrorClass.PERMISSION,
+    'RefreshError': ErrorClass.PERMISSION,
+    'CircuitOpenError': ErrorClass.PERMISSION,
+    'INVALID_ARGUMENT': ErrorClass.INVALID_ARGUMENT,
+    'FAILED_PRECONDITION': ErrorClass.INVALID_ARGUMENT,
+    'OUT_OF_RANGE': ErrorClass.INVALID_ARGUMENT,
+    'ValueError': ErrorClass.INVALID_ARGUMENT,
+    'ALREADY_EXISTS': ErrorClass.ALREADY_EXISTS,
+    'NOT_FOUND': ErrorClass.NOT_FOUND,
+}
+RETRYABLE = frozenset({ErrorClass.TRANSIENT, ErrorClass.QUOTA})
+
+
+class RetryNotDueError(Exception):
+  """Raised when a retried operation is delivered before it is due."""
+
+
+def classify(error: BaseException) -> ErrorClass:
+  """Returns the class of an error from its gRPC status."""
+  return _CLASSES.get(metrics.status_name(error), ErrorClass.UNKNOWN)
+
+
+def attempt_of(values: Mapping[str, Any]) -> int:
+  """Returns the attempt number of an operation, starting at 1."""
+  attempt = values.get(ATTEMPT_KEY)
+  return int(float(attempt)) if attempt not in (None, '') else 1
+
+
+def backoff(attempt: int) -> float:
+  """Returns the delay before the retry that follows a failed attempt."""
+  return min(BASE_DELAY * 2 ** (attempt - 1), MAX_DELAY)
+
+
+def failure_record(
+    values: Mapping[str, Any],
+    error: BaseException,
+    can_retry: bool = True,
+    clock: Callable[[], float] = time.time,
+) -> tuple[dict[str, Any], bool]:
+  """Describes a failed operation for a retry or a dead-letter report.
+
+  Args:
+      values: The values of the operation, such as a row of an input file.
+      error: The error the operation failed with.
+      can_retry: False records every failure as permanent, such as when
+        there is nowhere to send retries to.
+      clock: Returns the current time in seconds since the epoch.
+
+  Returns:
+      The values with the attempt number, the retry time, the error class and
+      the error, and whether the operation should be retried. Retried
+      operations have the number of their next attempt.
+  """
+  error_class = classify(error)
+  attempt = attempt_of(values)
+  retry = (
+      can_retry and error_class in RETRYABLE and attempt < MAX_ATTEMPTS)
+  metrics.count(f"failures.{error_class.value}.{'retry' if retry else 'dead'}")
+  record = dict(values) | {
+      ATTEMPT_KEY: attempt + 1 if retry else attempt,
+      RETRY_AFTER_KEY: (
+          round(clock() + backoff(attempt), 3) if retry else ''),
+      ERROR_CLASS_KEY: error_class.value,
+      ERROR_KEY: str(error),
+  }
+  return record, retry
+
+
+def check_due(
+    retry_after: float | str | None,
+    clock: Callable[[], float] = time.time,
+) -> None:
+  """Checks that a retried operation is due.
+
+  Args:
+      retry_after: The time the retry is due, in seconds since the epoch,
+        or None or an empty string if it is not a retry.
+      clock: Returns the current time.
+
+  Raises:
+      RetryNotDueError: If the retry was delivered before it is due.
+  """
+  if retry_after in (None, ''):
+    return
+  remaining = float(retry_after) - clock()
+  if remaining > 0:
+    raise RetryNotDueError(f'Retry is due in {remaining:.0f} seconds')
@@ -0,0 +1,80 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the classification of failed operations."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from google.api_core import exceptions
+
+from shared import errors
+
+
+class ErrorsTest(parameterized.TestCase):
+
+  @parameterized.parameters(
+      (exceptions.ServiceUnavailable('x'), errors.ErrorClass.TRANSIENT),
+      (exceptions.DeadlineExceeded('x'), errors.ErrorClass.TRANSIENT),
+      (exceptions.ResourceExhausted('x'), errors.ErrorClass.QUOTA),
+      (exceptions.PermissionDenied('x'), errors.ErrorClass.PERMISSION),
+      (exceptions.Unauthenticated('x'), errors.ErrorClass.PERMISSION),
+      (exceptions.InvalidArgument('x'), errors.ErrorClass.INVALID_ARGUMENT),
+      (exceptions.AlreadyExists('x'), errors.ErrorClass.ALREADY_EXISTS),
+      (exceptions.NotFound('x'), errors.ErrorClass.NOT_FOUND),
+      (ValueError('x'), errors.ErrorClass.INVALID_ARGUMENT),
+      (RuntimeError('x'), errors.ErrorClass.UNKNOWN),
+  )
+  def test_classify_uses_grpc_status(self, error, error_class):
+    self.assertEqual(error_class, errors.classify(error))
+
+  def test_failure_record_schedules_retry_with_backoff(self):
+    record, retry = errors.failure_record(
+        {'ga4_property_id': '1', 'attempt': '2'},
+        exceptions.ResourceExhausted('quota'),
+        clock=lambda: 1000.0)
+    self.assertTrue(retry)
+    self.assertEqual(
+        {'ga4_property_id': '1',
+         'attempt': 3,
+         'retry_after': 1000.0 + 2 * errors.BASE_DELAY,
+         'error_class': 'quota',
+         'error': '429 quota'},
+        record)
+
+  def test_failure_record_dead_letters_permanent_errors(self):
+    record, retry = errors.failure_record(
+        {'ga4_property_id': '1'}, exceptions.InvalidArgument('bad'))
+    self.assertFalse(retry)
+    self.assertEqual(1, record['attempt'])
+    self.assertEqual('', record['retry_after'])
+
+  def test_failure_record_dead_letters_after_last_attempt(self):
+    _, retry = errors.failure_record(
+        {'attempt': errors.MAX_ATTEMPTS}, exceptions.ServiceUnavailable('x'))
+    self.assertFalse(retry)
+    _, retry = errors.failure_record(
+        {}, exceptions.ServiceUnavailable('x'), can_retry=False)
+    self.assertFalse(retry)
+
+  def test_check_due_raises_until_retry_is_due(self):
+    errors.check_due(None)
+    errors.check_due('')
+    errors.check_due(5, lambda: 10)
+    errors.check_due('10', lambda: 10)
+    with self.assertRaisesRegex(errors.RetryNotDueError, 'due in 7 seconds'):
+      errors.check_due('17', lambda: 10)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,478 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Handles pub/sub messages that create, update, delete or list links.
+
+The link type of a message is read from its "link_type" key, or defaults to
+the type of the function that received it, and every type in
+link_resources.LINK_TYPES is handled the same way. The values of a link are
+given under the names of its fields, such as "customer_id" and
+"ads_personalization_enabled" for Google Ads links.
+
+The limiter, the clients and the link indexes are kept at module scope, so
+that they are shared by every message handled by an instance whatever the
+link type.
+
+Operations that fail are classified by shared.errors. Those worth retrying
+are republished to the RETRY_TOPIC as a batch of just the failed operations.
+Until their backoff has passed, the batch raises RetryNotDueError and is
+redelivered by the retry policy of the subscription that delivers it. The
+others are written to the DEAD_LETTER_BUCKET, or logged if it is not set.
+"""
+
+import base64
+import enum
+import functools
+import json
+import os
+from typing import Any
+
+from cloudevents.http import CloudEvent
+from google.analytics.admin import AnalyticsAdminServiceClient
+
+from shared import bulk_list
+from shared import circuit_breaker
+from shared import client_cache
+from shared import credential_profiles
+from shared import errors
+from shared import link_index
+from shared import link_resources
+from shared import metrics
+from shared import rate_limiter
+from shared import results_writer
+
+
+class Action(enum.Enum):
+  CREATE = 'create'
+  DELETE = 'delete'
+  UPDATE = 'update'
+  LIST = 'list'
+
+
+CREDENTIAL_KEYS = (
+    'refresh_token',
+    'token_uri',
+    'client_id',
+    'client_secret',
+    'scopes',
+)
+# Messages with this key carry a list of operations instead of one operation.
+BATCH_KEY = 'operations'
+LINK_TYPE_KEY = 'link_type'
+# The keys of a message that are shared by its operations, which a retry
+# message keeps. Every other key belongs to the operation.
+MESSAGE_KEYS = (
+    *CREDENTIAL_KEYS,
+    credential_profiles.PROFILE_KEY,
+    LINK_TYPE_KEY,
+    'enable_logging',
+)
+# The topic failed operations worth retrying are republished to, such as
+# "projects/my-project/topics/ga_links_retry". Without it a single operation
+# that failed with such an error raises it, so that the message can be
+# redelivered, and the failed operations of a batch are dead-lettered.
+RETRY_TOPIC = os.environ.get('RETRY_TOPIC')
+# The bucket operations that failed for good are written to.
+DEAD_LETTER_BUCKET = os.environ.get('DEAD_LETTER_BUCKET')
+
+# Shared by every message handled by this instance so that bursts of messages
+# are paced together and back off when the Admin API quota is exhausted.
+limiter = rate_limiter.AdaptiveRateLimiter.from_env()
+# Keeps credentials and clients between messages so that warm instances reuse
+# access tokens and gRPC channels.
+ga_clients = client_cache.ClientCache.from_env()
+# Resolves the credential profile IDs that messages may carry instead of the
+# credentials themselves.
+profiles = credential_profiles.CredentialProfiles.from_env()
+# Lists the links of each property once so that creating a link that already
+# exists is skipped, or turned into an update if its settings differ.
+indexes = link_resources.new_indexes(
+    ttl=float(os.environ.get('LINK_INDEX_TTL', 300)))
+# Fails the operations of credentials that keep failing to authenticate
+# without sending them, until the cooldown lets a probe through.
+breakers = circuit_breaker.CircuitBreakers()
+
+
+def handle(cloud_event: CloudEvent, link_type: str | None = None) -> Any:
+  """Handles a pub/sub message that describes link operations.
+
+  The message either describes a single operation or contains an "operations"
+  list. Each item in the list describes one operation and is combined with the
+  other keys in the message, such as the credentials. Instead of the
+  credentials, the message may contain a "credential_profile" ID that names a
+  Secret Manager secret with the credentials.
+
+  A list message with "property_ids" or an "account_id" instead of a
+  "property_id" writes the links of every property to the "export_uri" as
+  newline delimited JSON, or in the "export_format" it names.
+
+  Args:
+      cloud_event: The cloud event with the pub/sub message.
+      link_type: The link type of messages without a "link_type" key.
+
+  Returns:
+      The response or error message, a list with the outcome of each
+      operation for messages that contain a list of operations, or a summary
+      of the export for bulk list messages.
+
+  Raises:
+      RetryNotDueError: If the message is a retry whose backoff has not
+        passed yet.
+  """
+  try:
+    data = json.loads(base64.b64decode(
+        cloud_event.data['message']['data']).decode())
+  except KeyError as e:
+    print(e)
+    return 'Invalid message. Missing "data" key.'
+  # Retry messages are republished straight away. Until their backoff has
+  # passed they fail here, and the subscription redelivers them later.
+  errors.check_due(data.get(errors.RETRY_AFTER_KEY))
+  try:
+    data = profiles.resolve(data)
+  except Exception as e:
+    error_message = f'Invalid credential profile: {e}'
+    print(error_message)
+    return error_message
+  data.setdefault(LINK_TYPE_KEY, link_type)
+  message_id = cloud_event['id']
+  if BATCH_KEY in data:
+    return run_batch(data, message_id)
+  if (str(data.get('action')).lower() == Action.LIST.value
+      and bulk_list.is_bulk_list(data)):
+    return run_bulk_list(data)
+  missing_keys = find_missing_keys(data)
+  if missing_keys:
+    error_message = f"Missing keys: {','.join(missing_keys)}"
+    print(error_message)
+    return error_message
+  try:
+    response = run_action(data)
+  except Exception as e:
+    if RETRY_TOPIC is None and errors.classify(e) in errors.RETRYABLE:
+      raise
+    (record,) = recover(data, [(data, e)], message_id)
+    error_message = (
+        f'{record[errors.ERROR_CLASS_KEY]} error: {record[errors.ERROR_KEY]}')
+    print(error_message)
+    return error_message
+  if data.get('enable_logging'):
+    print(response or f"{data['name']} deleted")
+  return response
+
+
+def run_batch(
+    data: dict[str, Any], message_id: str | None = None
+) -> list[dict[str, Any]]:
+  """Runs each operation in a batch message.
+
+  A failed operation does not stop the rest of the batch, and only the
+  operations that failed are retried or dead-lettered.
+
+  Args:
+      data: The decoded message with the list of operations.
+      message_id: The ID of the message, which names its dead letters.
+
+  Returns:
+      A list with a dictionary describing the outcome of each operation.
+  """
+  operations = data.pop(BATCH_KEY)
+  outcomes = []
+  failures = []
+  for index, operation in enumerate(operations):
+    item = data | operation
+    outcome = {'index': index, 'action': item.get('action')}
+    missing_keys = find_missing_keys(item)
+    if missing_keys:
+      outcome['error'] = f"Missing keys: {','.join(missing_keys)}"
+    else:
+      try:
+        outcome['response'] = run_action(item)
+      except Exception as e:
+        outcome['error'] = str(e)
+        failures.append((outcome, item, e))
+    outcomes.append(outcome)
+  records = recover(
+      data, [(item, e) for _, item, e in failures], message_id)
+  for (outcome, _, _), record in zip(failures, records):
+    outcome['error_class'] = record[errors.ERROR_CLASS_KEY]
+    outcome['retry_after'] = record[errors.RETRY_AFTER_KEY]
+  if data.get('enable_logging'):
+    print(outcomes)
+  return outcomes
+
+
+def run_bulk_list(data: dict[str, Any]) -> dict[str, Any] | str:
+  """Lists the links of many properties into a single export.
+
+  Args:
+      data: The decoded message with the credentials, the properties or
+        account to list and the export URI.
+
+  Returns:
+      A summary of the export, or an error message if keys are missing.
+  """
+  missing_keys = [
+      key for key in (*CREDENTIAL_KEYS, LINK_TYPE_KEY, bulk_list.EXPORT_URI_KEY)
+      if data.get(key) is None]
+  if missing_keys:
+    error_message = f"Missing keys: {','.join(missing_keys)}"
+    print(error_message)
+    return error_message
+  resource = link_resources.get(data[LINK_TYPE_KEY])
+  summary = bulk_list.run_bulk_list(
+      data,
+      get_ga_client(data),
+      limiter,
+      resource.list_method,
+      resource.list_field,
+      lambda uri: bulk_list.open_gcs_export(get_storage_client(), uri))
+  if data.get('enable_logging'):
+    print(summary)
+  return summary
+
+
+def run_action(data: dict[str, Any]) -> Any:
+  """Performs the link method for a single operation.
+
+  Args:
+      data: The values for the operation, including the credentials.
+
+  Returns:
+      The response from the Google Analytics Admin API.
+
+  Raises:
+      ValueError: If the link type is unknown, or an update has no settings
+        that can be updated.
+      CircuitOpenError: If too many operations with the same credentials
+        failed to authenticate in a row.
+  """
+  try:
+    return _run_action(data)
+  except Exception as e:
+    forget_rejected_profile(data, e)
+    raise
+
+
+def _run_action(data: dict[str, Any]) -> Any:
+  """Performs the link method for a single operation, see run_action."""
+  breaker = breakers.get(client_cache.cache_key(
+      data['client_id'], data['refresh_token'], data['scopes']))
+  with breaker.guard():
+    link_type = link_resources.ALIASES.get(
+        data[LINK_TYPE_KEY], data[LINK_TYPE_KEY])
+    resource = link_resources.get(link_type)
+    ga_client = get_ga_client(data)
+    action = data['action'].lower()
+    metrics.count(f'actions.{action}')
+    response = {}
+    if action == Action.CREATE.value:
+      _, response = link_resources.drive(
+          link_resources.create_steps(
+              link_type, indexes, data['property_id'], data),
+          ga_client,
+          limiter)
+    elif action == Action.UPDATE.value:
+      # Only the settings in the message that differ from the indexed link
+      # are updated, and a link that already matches is not written at all.
+      decision, response = link_resources.drive(
+          link_resources.update_steps(link_type, indexes, data['name'], data),
+          ga_client,
+          limiter)
+      metrics.count(f'updates.{decision.resolution.value}')
+    elif action == Action.DELETE.value:
+      response = rate_limiter.call_with_retry(
+          limiter, getattr(ga_client, resource.delete_method),
+          name=data['name'])
+      indexes[link_type].invalidate(
+          link_index.property_id_from_name(data['name']))
+    elif action == Action.LIST.value:
+      parent = f"properties/{data['property_id']}"
+      response = rate_limiter.call_with_retry(
+          limiter, getattr(ga_client, resource.list_method), parent=parent)
+  return response
+
+
+def forget_rejected_profile(
+    data: dict[str, Any], error: BaseException) -> None:
+  """Drops the cached credentials of a profile the API did not accept.
+
+  The profile's secret may have been rotated, so the next message with the
+  profile fetches it again. An open breaker says nothing new about the
+  credentials and keeps the cached ones.
+
+  Args:
+      data: The values of the operation, with the credential profile ID if
+        the message had one.
+      error: The error the operation failed with.
+  """
+  if (credential_profiles.PROFILE_KEY in data
+      and circuit_breaker.is_auth_failure(error)
+      and not isinstance(error, circuit_breaker.CircuitOpenError)):
+    profiles.invalidate(data[credential_profiles.PROFILE_KEY])
+
+
+def recover(
+    data: dict[str, Any],
+    failures: list[tuple[dict[str, Any], Exception]],
+    message_id: str | None = None,
+) -> list[dict[str, Any]]:
+  """Retries or dead-letters failed operations.
+
+  Args:
+      data: The decoded message the operations came from.
+      failures: Each failed operation, with the message keys it shares, and
+        the error it failed with.
+      message_id: The ID of the message, which names its dead letters.
+
+  Returns:
+      The failure record of each operation, as errors.failure_record
+      describes it, without the message keys.
+  """
+  records, retries, dead_letters = [], [], []
+  for operation, error in failures:
+    record, retry = errors.failure_record(
+        {key: value for key, value in operation.items()
+         if key not in MESSAGE_KEYS},
+        error,
+        can_retry=RETRY_TOPIC is not None)
+    records.append(record)
+    (retries if retry else dead_letters).append(record)
+  if retries:
+    publish_retry(data, retries)
+  if dead_letters:
+    write_dead_letters(data, dead_letters, message_id)
+  return records
+
+
+def publish_retry(
+    data: dict[str, Any], operations: list[dict[str, Any]]) -> None:
+  """Republishes failed operations to the RETRY_TOPIC as one batch message.
+
+  Credentials that were read from a credential profile are left out, so
+  that the retry message only carries the profile ID like the original.
+
+  Args:
+      data: The decoded message the operations came from.
+      operations: The failure records of the operations.
+  """
+  message = {key: data[key] for key in MESSAGE_KEYS if key in data}
+  if credential_profiles.PROFILE_KEY in message:
+    for key in CREDENTIAL_KEYS:
+      message.pop(key, None)
+  message[BATCH_KEY] = operations
+  message[errors.RETRY_AFTER_KEY] = max(
+      operation[errors.RETRY_AFTER_KEY] for operation in operations)
+  get_publisher().publish(
+      RETRY_TOPIC, json.dumps(message).encode('utf-8')).result()
+
+
+def write_dead_letters(
+    data: dict[str, Any],
+    records: list[dict[str, Any]],
+    message_id: str | None = None,
+) -> None:
+  """Writes operations that failed for good to the DEAD_LETTER_BUCKET.
+
+  The records of each message are written as newline delimited JSON to
+  "dead_letter/<link type>/<message ID>/". They are only logged if the
+  bucket is not set.
+
+  Args:
+      data: The decoded message the operations came from.
+      records: The failure records of the operations.
+      message_id: The ID of the message.
+  """
+  if DEAD_LETTER_BUCKET is None or message_id is None:
+    print(f'Failed operations: {records}')
+    return
+  with results_writer.ResultsWriter(
+      get_storage_client().bucket(DEAD_LETTER_BUCKET),
+      f'{errors.DEAD_LETTER_PREFIX}{data[LINK_TYPE_KEY]}/{message_id}/',
+      'ndjson') as writer:
+    for record in records:
+      writer.write(record)
+
+
+def find_missing_keys(data: dict[str, Any]) -> list[str]:
+  """Checks if the keys required by the operation are missing.
+
+  Every operation needs the credentials, an action and a link type. Creating
+  a link also needs the property ID and the ID of the linked account,
+  updating or deleting a link needs its name and listing links needs the
+  property ID.
+
+  Args:
+      data: The values for the operation.
+
+  Returns:
+      A list that is either empty or contains the missing keys.
+  """
+  required_keys = [*CREDENTIAL_KEYS, 'action', LINK_TYPE_KEY]
+  action = str(data.get('action')).lower()
+  if action in (Action.CREATE.value, Action.LIST.value):
+    required_keys.append('property_id')
+  if action in (Action.UPDATE.value, Action.DELETE.value):
+    required_keys.append('name')
+  if action == Action.CREATE.value and data.get(LINK_TYPE_KEY):
+    try:
+      required_keys.append(link_resources.get(data[LINK_TYPE_KEY]).id_field)
+    except ValueError:
+      # Reported when the operation is run.
+      pass
+  return [key for key in required_keys if data.get(key) is None]
+
+
+def get_ga_client(data: dict[str, Any]) -> AnalyticsAdminServiceClient:
+  """Gets the Google Analytics Admin API client for a message.
+
+  The client is created the first time the credentials are seen and reused for
+  later messages handled by the same instance.
+
+  Args:
+      data: The message with the OAuth 2.0 refresh token, token URI, client
+        ID, client secret and scopes.
+
+  Returns:
+      The Google Analytics Admin API client.
+  """
+  return ga_clients.get(
+      data['refresh_token'],
+      data['token_uri'],
+      data['client_id'],
+      data['client_secret'],
+      data['scopes'],
+      lambda credentials: AnalyticsAdminServiceClient(credentials=credentials))
+
+
+@functools.cache
+def get_storage_client() -> Any:
+  """Gets the Cloud Storage client for exports and dead letters.
+
+  The library is imported on first use because only bulk list messages and
+  failed operations need it, which keeps it out of the cold start of every
+  other message.
+  """
+  from google.cloud import storage  # pylint: disable=g-import-not-at-top
+  return storage.Client()
+
+
+@functools.cache
+def get_publisher() -> Any:
+  """Gets the Pub/Sub publisher that retries are published with.
+
+  Imported on first use like the Cloud Storage client.
+  """
+  from google.cloud import pubsub_v1  # pylint: disable=g-import-not-at-top
+  return pubsub_v1.PublisherClient()
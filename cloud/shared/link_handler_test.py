@@ -0,0 +1,446 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the link handler.
+
+Most tests use Google Ads links, the other link types are handled the same
+way through the link registry.
+"""
+
+import base64
+import io
+import json
+import time
+import unittest
+from absl.testing import absltest
+from absl.testing import parameterized
+from cloudevents.http import CloudEvent
+from google.api_core import exceptions
+from google.analytics.admin_v1alpha.types import BigQueryLink
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+from shared import credential_profiles
+from shared import link_handler
+from shared import rate_limiter
+
+
+class LinkHandlerTest(parameterized.TestCase):
+
+  def setUp(self):
+    super(LinkHandlerTest, self).setUp()
+    self.attributes = {
+        'source': 'test',
+        'type': 'test',
+    }
+    self.data = {
+        'client_id': '123',
+        'client_secret': 'ABC',
+        'refresh_token': '123ABC',
+        'token_uri': 'google.com',
+        'scopes': ['https://www.googleapis.com/auth/analytics.edit'],
+        'enable_logging': True,
+        'link_type': 'ads_link',
+        'customer_id': '123',
+        'action': 'create',
+        'ads_personalization_enabled': True,
+        'property_id': '1234567',
+        'name': 'properties/1234567/adsLinks/abcdefg',
+    }
+    link_handler.ga_clients.clear()
+    link_handler.breakers.clear()
+    for index in link_handler.indexes.values():
+      index.clear()
+    self.enter_context(unittest.mock.patch.object(
+        link_handler, 'limiter',
+        rate_limiter.AdaptiveRateLimiter(rate=1000, max_rate=1000)))
+
+  def test_main_missing_data_raises_error(self):
+    missing_data = CloudEvent(self.attributes, {'message': {}})
+    error_message = 'Invalid message. Missing "data" key.'
+    self.assertEqual(error_message, link_handler.handle(missing_data))
+
+  def test_main_missing_required_key_raises_errors(self):
+    del self.data['client_id']
+    del self.data['action']
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    missing_keys = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    error_message = 'Missing keys: client_id,action'
+    self.assertEqual(error_message, link_handler.handle(missing_keys))
+
+  @unittest.mock.patch('shared.link_handler.AnalyticsAdminServiceClient')
+  def test_get_ga_client_creates_admin_client(self, mock_analytics_client):
+    link_handler.get_ga_client(self.data)
+    mock_analytics_client.assert_called()
+
+  @unittest.mock.patch('shared.link_handler.AnalyticsAdminServiceClient')
+  def test_get_ga_client_reuses_admin_client(self, mock_analytics_client):
+    self.assertIs(
+        link_handler.get_ga_client(self.data),
+        link_handler.get_ga_client(dict(self.data)))
+    mock_analytics_client.assert_called_once()
+
+  @parameterized.named_parameters(
+      dict(testcase_name='test_main_calls_create_google_ads_link',
+           action='create',
+           result='created'),
+      dict(testcase_name='test_main_calls_update_google_ads_link',
+           action='update',
+           result='updated'),
+      dict(testcase_name='test_main_calls_delete_google_ads_link',
+           action='delete',
+           result='deleted'),
+      dict(testcase_name='test_main_calls_list_google_ads_links',
+           action='list',
+           result='listed'))
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_calling_google_ads_link_methods(
+      self, mock_ga_client, action, result):
+    self.data['action'] = action
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    if action == 'create':
+      mock_ga_client().create_google_ads_link.return_value = result
+    elif action == 'update':
+      mock_ga_client().update_google_ads_link.return_value = result
+    elif action == 'delete':
+      mock_ga_client().delete_google_ads_link.return_value = result
+    elif action == 'list':
+      mock_ga_client().list_google_ads_links.return_value = result
+    self.assertEqual(result, link_handler.handle(cloud_event))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_skips_creating_existing_link(self, mock_ga_client):
+    existing_link = GoogleAdsLink(
+        name='properties/1234567/googleAdsLinks/abcdefg',
+        customer_id='123',
+        ads_personalization_enabled=True)
+    mock_ga_client().list_google_ads_links.return_value = [existing_link]
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual(existing_link, link_handler.handle(cloud_event))
+    self.assertEqual(existing_link, link_handler.handle(cloud_event))
+    mock_ga_client().create_google_ads_link.assert_not_called()
+    mock_ga_client().list_google_ads_links.assert_called_once()
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_updates_existing_link_with_changed_settings(
+      self, mock_ga_client):
+    mock_ga_client().list_google_ads_links.return_value = [GoogleAdsLink(
+        name='properties/1234567/googleAdsLinks/abcdefg',
+        customer_id='123',
+        ads_personalization_enabled=False)]
+    mock_ga_client().update_google_ads_link.return_value = 'updated'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual('updated', link_handler.handle(cloud_event))
+    mock_ga_client().update_google_ads_link.assert_called_once_with(
+        google_ads_link=GoogleAdsLink(
+            name='properties/1234567/googleAdsLinks/abcdefg',
+            ads_personalization_enabled=True),
+        update_mask='ads_personalization_enabled')
+    mock_ga_client().create_google_ads_link.assert_not_called()
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_skips_update_of_unchanged_link(self, mock_ga_client):
+    existing_link = GoogleAdsLink(
+        name='properties/1234567/adsLinks/abcdefg',
+        customer_id='123',
+        ads_personalization_enabled=True)
+    mock_ga_client().list_google_ads_links.return_value = [existing_link]
+    self.data['action'] = 'update'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual(existing_link, link_handler.handle(cloud_event))
+    mock_ga_client().update_google_ads_link.assert_not_called()
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_runs_each_operation_in_batch(self, mock_ga_client):
+    operations = [
+        {'action': 'create', 'customer_id': '1'},
+        {'action': 'delete', 'name': 'properties/1234567/googleAdsLinks/1'},
+        {'action': 'create', 'customer_id': '2'},
+    ]
+    del self.data['action']
+    self.data['operations'] = operations
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().create_google_ads_link.side_effect = [
+        'created', Exception('already exists')]
+    mock_ga_client().delete_google_ads_link.return_value = 'deleted'
+    self.assertEqual(
+        [{'index': 0, 'action': 'create', 'response': 'created'},
+         {'index': 1, 'action': 'delete', 'response': 'deleted'},
+         {'index': 2, 'action': 'create', 'error': 'already exists',
+          'error_class': 'unknown', 'retry_after': ''}],
+        link_handler.handle(cloud_event))
+
+  @unittest.mock.patch('shared.link_handler.get_storage_client')
+  @unittest.mock.patch('shared.link_handler.get_publisher')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_batch_retries_only_failed_operations_worth_retrying(
+      self, mock_ga_client, mock_publisher, mock_storage_client):
+    operations = [
+        {'action': 'create', 'customer_id': '1'},
+        {'action': 'create', 'customer_id': '2'},
+        {'action': 'create', 'customer_id': '3'},
+    ]
+    del self.data['action']
+    self.data['operations'] = operations
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes | {'id': 'message-1'},
+        {'message': {'data': encoded_data}})
+    errors = {
+        '2': exceptions.ServiceUnavailable('unavailable'),
+        '3': exceptions.InvalidArgument('bad customer'),
+    }
+
+    def create_google_ads_link(parent, google_ads_link):
+      if google_ads_link.customer_id in errors:
+        raise errors[google_ads_link.customer_id]
+      return 'created'
+
+    mock_ga_client().create_google_ads_link.side_effect = (
+        create_google_ads_link)
+    self.enter_context(unittest.mock.patch.multiple(
+        link_handler, RETRY_TOPIC='projects/p/topics/retry',
+        DEAD_LETTER_BUCKET='dead'))
+    self.enter_context(
+        unittest.mock.patch.object(rate_limiter, 'MAX_ATTEMPTS', 1))
+    outcomes = link_handler.handle(cloud_event)
+    self.assertEqual(
+        [None, 'transient', 'invalid_argument'],
+        [outcome.get('error_class') for outcome in outcomes])
+    topic, payload = mock_publisher().publish.call_args.args
+    self.assertEqual('projects/p/topics/retry', topic)
+    retry = json.loads(payload)
+    self.assertEqual(
+        [('2', 2)],
+        [(op['customer_id'], op['attempt']) for op in retry['operations']])
+    self.assertEqual('123ABC', retry['refresh_token'])
+    self.assertEqual(outcomes[1]['retry_after'], retry['retry_after'])
+    bucket = mock_storage_client().bucket
+    bucket.assert_called_with('dead')
+    bucket().blob.assert_called_once_with(
+        'dead_letter/ads_link/message-1/part-000000000.ndjson')
+    dead_letter = json.loads(
+        bucket().blob().upload_from_string.call_args.args[0])
+    self.assertEqual('3', dead_letter['customer_id'])
+    self.assertEqual('bad customer', dead_letter['error'].split(' ', 1)[1])
+    self.assertNotIn('client_secret', dead_letter)
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_batch_fails_fast_once_credentials_keep_failing(
+      self, mock_ga_client):
+    del self.data['action']
+    self.data['operations'] = [
+        {'action': 'create', 'property_id': str(i), 'customer_id': '1'}
+        for i in range(4)]
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().list_google_ads_links.side_effect = (
+        exceptions.Unauthenticated('token revoked'))
+    self.enter_context(unittest.mock.patch.object(
+        link_handler.circuit_breaker, 'THRESHOLD', 2))
+    outcomes = link_handler.handle(cloud_event)
+    self.assertEqual(
+        ['permission'] * 4, [outcome['error_class'] for outcome in outcomes])
+    self.assertEqual(2, mock_ga_client().list_google_ads_links.call_count)
+    self.assertStartsWith(outcomes[3]['error'], '2 operations in a row')
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_raises_transient_error_without_retry_topic(
+      self, mock_ga_client):
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().list_google_ads_links.side_effect = (
+        exceptions.ResourceExhausted('quota'))
+    self.enter_context(
+        unittest.mock.patch.object(rate_limiter, 'MAX_ATTEMPTS', 1))
+    with self.assertRaises(exceptions.ResourceExhausted):
+      link_handler.handle(cloud_event)
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_fails_retry_until_it_is_due(self, mock_ga_client):
+    mock_ga_client().create_google_ads_link.return_value = 'created'
+
+    def retry_event(retry_after):
+      data = self.data | {'retry_after': retry_after}
+      encoded_data = base64.b64encode(json.dumps(data).encode('utf-8'))
+      return CloudEvent(self.attributes, {'message': {'data': encoded_data}})
+
+    with self.assertRaises(link_handler.errors.RetryNotDueError):
+      link_handler.handle(retry_event(time.time() + 20))
+    mock_ga_client().create_google_ads_link.assert_not_called()
+    # The subscription redelivers the message once its backoff has passed.
+    self.assertEqual(
+        'created', link_handler.handle(retry_event(time.time() - 1)))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_resolves_credential_profile(self, mock_ga_client):
+    credentials = {
+        key: self.data.pop(key)
+        for key in ('client_id', 'client_secret', 'refresh_token',
+                    'token_uri', 'scopes')}
+    self.data['credential_profile'] = 'agency'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().create_google_ads_link.return_value = 'created'
+    profiles = credential_profiles.CredentialProfiles(
+        project_id='project',
+        fetch_secret=lambda name: json.dumps(credentials))
+    with unittest.mock.patch.object(link_handler, 'profiles', profiles):
+      self.assertEqual('created', link_handler.handle(cloud_event))
+    self.assertEqual(
+        credentials,
+        {key: mock_ga_client.call_args.args[0][key] for key in credentials})
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_refetches_credential_profile_after_unauthenticated(
+      self, mock_ga_client):
+    for key in ('client_id', 'client_secret', 'refresh_token', 'token_uri',
+                'scopes'):
+      del self.data[key]
+    self.data['credential_profile'] = 'agency'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    secrets = iter(['revoked', 'rotated'])
+
+    def fetch_secret(name):
+      del name
+      return json.dumps({
+          'client_id': '123', 'client_secret': 'ABC',
+          'refresh_token': next(secrets), 'token_uri': 'google.com',
+          'scopes': ['https://www.googleapis.com/auth/analytics.edit']})
+
+    mock_ga_client().list_google_ads_links.side_effect = [
+        exceptions.Unauthenticated('token revoked'), []]
+    mock_ga_client().create_google_ads_link.return_value = 'created'
+    profiles = credential_profiles.CredentialProfiles(
+        project_id='project', fetch_secret=fetch_secret)
+    with unittest.mock.patch.object(link_handler, 'profiles', profiles):
+      self.assertStartsWith(
+          link_handler.handle(cloud_event), 'permission error')
+      self.assertEqual('created', link_handler.handle(cloud_event))
+    self.assertEqual(
+        'rotated', mock_ga_client.call_args.args[0]['refresh_token'])
+
+  @unittest.mock.patch('shared.link_handler.get_storage_client')
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_main_lists_many_properties_into_export(
+      self, mock_ga_client, mock_storage_client):
+    del self.data['property_id']
+    self.data['action'] = 'list'
+    self.data['property_ids'] = ['1', '2']
+    self.data['export_uri'] = 'gs://exports/links.ndjson'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    page = unittest.mock.Mock(next_page_token='')
+
+    def list_links(request):
+      page.google_ads_links = [GoogleAdsLink(
+          name=f"{request['parent']}/googleAdsLinks/a", customer_id='123')]
+      return unittest.mock.Mock(pages=iter([page]))
+
+    mock_ga_client().list_google_ads_links.side_effect = list_links
+    mock_ga_client().list_google_ads_links.__name__ = 'list_google_ads_links'
+    mock_storage_client().bucket().blob().open.return_value = io.BytesIO()
+    summary = link_handler.handle(cloud_event)
+    self.assertEqual(
+        {'properties': 2, 'links': 2, 'failed_properties': {},
+         'export_uri': 'gs://exports/links.ndjson'},
+        summary)
+    mock_storage_client().bucket.assert_called_with('exports')
+    mock_storage_client().bucket().blob.assert_called_with('links.ndjson')
+
+  def test_main_bulk_list_without_export_uri_returns_error(self):
+    self.data['action'] = 'list'
+    self.data['account_id'] = '99'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertEqual('Missing keys: export_uri', link_handler.handle(cloud_event))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_handle_uses_default_link_type(self, mock_ga_client):
+    del self.data['link_type']
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().list_google_ads_links.return_value = []
+    mock_ga_client().create_google_ads_link.return_value = 'created'
+    self.assertEqual(
+        'Missing keys: link_type', link_handler.handle(cloud_event))
+    self.assertEqual(
+        'created', link_handler.handle(cloud_event, 'ads_link'))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_handle_creates_link_of_registered_type(self, mock_ga_client):
+    self.data['link_type'] = 'bigquery_link'
+    self.data['project'] = 'projects/42'
+    self.data['daily_export_enabled'] = True
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().list_big_query_links.return_value = []
+    mock_ga_client().create_big_query_link.return_value = 'created'
+    self.assertEqual('created', link_handler.handle(cloud_event))
+    mock_ga_client().create_big_query_link.assert_called_once_with(
+        parent='properties/1234567',
+        bigquery_link=BigQueryLink(
+            project='projects/42', daily_export_enabled=True))
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_handle_updates_only_given_settings(self, mock_ga_client):
+    self.data['link_type'] = 'bigquery_link'
+    self.data['action'] = 'update'
+    self.data['name'] = 'properties/1234567/bigQueryLinks/a'
+    self.data['streaming_export_enabled'] = False
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    mock_ga_client().update_big_query_link.return_value = 'updated'
+    self.assertEqual('updated', link_handler.handle(cloud_event))
+    mock_ga_client().update_big_query_link.assert_called_once_with(
+        bigquery_link=BigQueryLink(
+            name='properties/1234567/bigQueryLinks/a',
+            streaming_export_enabled=False),
+        update_mask='streaming_export_enabled')
+
+  @unittest.mock.patch('shared.link_handler.get_ga_client')
+  def test_handle_rejects_update_of_link_without_settings(
+      self, mock_ga_client):
+    self.data['link_type'] = 'firebase_link'
+    self.data['action'] = 'update'
+    encoded_data = base64.b64encode(json.dumps(self.data).encode('utf-8'))
+    cloud_event = CloudEvent(
+        self.attributes, {'message': {'data': encoded_data}})
+    self.assertRegex(
+        link_handler.handle(cloud_event),
+        '^invalid_argument error: .*firebase_link')
+    mock_ga_client().update_firebase_link.assert_not_called()
+
+
+if __name__ == '__main__':
+  absltest.main()
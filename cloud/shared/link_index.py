@@ -0,0 +1,216 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Indexes the existing links of each property.
+
+Sending a create request for a link that already exists costs a quota unit
+and a round trip just to find out from the error. The index lists the links of
+each property once, keeps them for the duration of a job, and decides locally
+whether a requested link has to be created, updated or can be skipped.
+"""
+
+from collections.abc import Callable, Iterable, Mapping
+from concurrent import futures
+import enum
+import threading
+import time
+from typing import Any, NamedTuple
+
+
+class Resolution(enum.Enum):
+  """What has to be done to make a link match the request."""
+  CREATE = 'create'
+  UPDATE = 'update'
+  SKIP = 'skip'
+
+
+class Decision(NamedTuple):
+  """The resolution for a requested link.
+
+  Attributes:
+      resolution: Whether the link has to be created, updated or skipped.
+      link: The existing link, if there is one.
+      changed_fields: The fields of the existing link that differ from the
+        request.
+  """
+  resolution: Resolution
+  link: Any = None
+  changed_fields: tuple[str, ...] = ()
+
+
+def property_id_from_name(name: str) -> str:
+  """Returns the property ID from a resource name like properties/1/..."""
+  return name.split('/')[1]
+
+
+class LinkIndex:
+  """Caches the links of each property keyed by the linked platform ID."""
+
+  def __init__(
+      self,
+      key_field: str,
+      ttl: float | None = None,
+      clock: Callable[[], float] = time.monotonic,
+  ) -> None:
+    """Initializes the index.
+
+    Args:
+        key_field: The link field that holds the linked platform ID, such as
+          customer_id for Google Ads links.
+        ttl: Listed links are listed again after this many seconds. None
+          keeps them until the index is discarded.
+        clock: Returns the current time in seconds.
+    """
+    self._key_field = key_field
+    self._ttl = ttl
+    self._clock = clock
+    self._properties = {}
+    self._lock = threading.Lock()
+    self._property_locks = {}
+    # The list request in flight for each property, as a future of its links.
+    self._listings = {}
+
+  def links(
+      self,
+      property_id: str,
+      list_links: Callable[[], Iterable[Any]],
+  ) -> dict[str, Any]:
+    """Returns the links of a property, listing them the first time.
+
+    Args:
+        property_id: The Google Analytics property ID.
+        list_links: Lists every link of the property.
+
+    Returns:
+        A dictionary of the links keyed by platform ID.
+    """
+    property_id = str(property_id)
+    with self._lock:
+      property_lock = self._property_locks.setdefault(
+          property_id, threading.Lock())
+    # Rows for the same property that are processed concurrently wait for a
+    # single list request instead of each listing the links.
+    with property_lock:
+      if self.is_listed(property_id):
+        return self._properties[property_id][1]
+      return self._store(property_id, list_links())
+
+  def is_listed(self, property_id: str) -> bool:
+    """Returns whether the links of a property are cached and still fresh."""
+    cached = self._properties.get(str(property_id))
+    return cached is not None and (
+        self._ttl is None or self._clock() - cached[0] < self._ttl)
+
+  def start_listing(
+      self, property_id: str) -> tuple[futures.Future | None, bool]:
+    """Claims the list request of a property whose links are not cached.
+
+    Rows for the same property that run concurrently on an event loop cannot
+    wait for a lock, so the first row to find the property unlisted lists it
+    and the later rows wait for the future of its links instead of each
+    sending a list request of their own.
+
+    Args:
+        property_id: The Google Analytics property ID.
+
+    Returns:
+        None and False if the links are cached and still fresh. Otherwise the
+        future of the links, and whether the caller has to list them and
+        pass them to finish_listing.
+    """
+    property_id = str(property_id)
+    with self._lock:
+      if self.is_listed(property_id):
+        return None, False
+      listing = self._listings.get(property_id)
+      if listing is not None:
+        return listing, False
+      listing = self._listings[property_id] = futures.Future()
+      return listing, True
+
+  def finish_listing(
+      self,
+      property_id: str,
+      links: Iterable[Any] = (),
+      error: BaseException | None = None,
+  ) -> None:
+    """Caches the listed links of a property and passes them to the waiters.
+
+    Args:
+        property_id: The Google Analytics property ID.
+        links: Every link of the property.
+        error: The error the list request failed with. Nothing is cached and
+          the waiters fail with the error.
+    """
+    property_id = str(property_id)
+    with self._lock:
+      listing = self._listings.pop(property_id)
+      if error is None:
+        links = list(links)
+        self._store(property_id, links)
+    if error is None:
+      listing.set_result(links)
+    else:
+      listing.set_exception(error)
+
+  def resolve(
+      self,
+      property_id: str,
+      platform_id: str,
+      settings: Mapping[str, Any],
+      list_links: Callable[[], Iterable[Any]],
+  ) -> Decision:
+    """Decides what has to be done to make a link match the request.
+
+    Args:
+        property_id: The Google Analytics property ID.
+        platform_id: The ID of the linked platform account.
+        settings: The requested values of the link fields that can change.
+        list_links: Lists every link of the property.
+
+    Returns:
+        The decision for the requested link.
+    """
+    link = self.links(property_id, list_links).get(str(platform_id))
+    if link is None:
+      return Decision(Resolution.CREATE)
+    changed_fields = tuple(
+        field for field, value in settings.items()
+        if getattr(link, field) != value)
+    if changed_fields:
+      return Decision(Resolution.UPDATE, link, changed_fields)
+    return Decision(Resolution.SKIP, link)
+
+  def _store(
+      self, property_id: str, links: Iterable[Any]) -> dict[str, Any]:
+    """Caches the links of a property keyed by platform ID."""
+    keyed_links = {
+        str(getattr(link, self._key_field)): link for link in links}
+    self._properties[property_id] = (self._clock(), keyed_links)
+    return keyed_links
+
+  def add(self, property_id: str, link: Any) -> None:
+    """Adds a created or updated link to a property that has been listed."""
+    platform_id = getattr(link, self._key_field, None)
+    cached = self._properties.get(str(property_id))
+    if cached is not None and platform_id is not None:
+      cached[1][str(platform_id)] = link
+
+  def invalidate(self, property_id: str) -> None:
+    """Lists the links of the property again the next time they are needed."""
+    self._properties.pop(str(property_id), None)
+
+  def clear(self) -> None:
+    """Forgets the links of every property."""
+    self._properties.clear()
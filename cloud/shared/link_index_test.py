@@ -0,0 +1,106 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the link index."""
+
+from unittest import mock
+
+from absl.testing import absltest
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+
+from shared import link_index
+
+
+class LinkIndexTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.now = 0.0
+    self.index = link_index.LinkIndex(
+        'customer_id', ttl=60, clock=lambda: self.now)
+    self.link = GoogleAdsLink(
+        name='properties/1/googleAdsLinks/a',
+        customer_id='111',
+        ads_personalization_enabled=True)
+    self.list_links = mock.Mock(return_value=[self.link])
+
+  def test_resolve_creates_missing_link(self):
+    decision = self.index.resolve(
+        '1', '222', {'ads_personalization_enabled': True}, self.list_links)
+    self.assertEqual(link_index.Decision(link_index.Resolution.CREATE),
+                     decision)
+
+  def test_resolve_skips_matching_link(self):
+    decision = self.index.resolve(
+        '1', '111', {'ads_personalization_enabled': True}, self.list_links)
+    self.assertEqual(
+        link_index.Decision(link_index.Resolution.SKIP, self.link), decision)
+
+  def test_resolve_updates_changed_link(self):
+    decision = self.index.resolve(
+        '1', 111, {'ads_personalization_enabled': False}, self.list_links)
+    self.assertEqual(
+        link_index.Decision(
+            link_index.Resolution.UPDATE, self.link,
+            ('ads_personalization_enabled',)),
+        decision)
+
+  def test_links_lists_each_property_once_until_ttl(self):
+    self.index.links('1', self.list_links)
+    self.index.links('1', self.list_links)
+    self.list_links.assert_called_once()
+    self.now = 60
+    self.index.links('1', self.list_links)
+    self.assertEqual(2, self.list_links.call_count)
+
+  def test_is_listed_until_ttl(self):
+    self.assertFalse(self.index.is_listed('1'))
+    self.index.links('1', self.list_links)
+    self.assertTrue(self.index.is_listed(1))
+    self.now = 60
+    self.assertFalse(self.index.is_listed('1'))
+
+  def test_start_listing_claims_each_property_once(self):
+    listing, owner = self.index.start_listing('1')
+    self.assertTrue(owner)
+    self.assertEqual((listing, False), self.index.start_listing(1))
+    self.index.finish_listing('1', [self.link])
+    self.assertEqual([self.link], listing.result())
+    self.assertEqual((None, False), self.index.start_listing('1'))
+    self.assertIs(self.link, self.index.links('1', self.list_links)['111'])
+    self.list_links.assert_not_called()
+
+  def test_finish_listing_with_error_fails_waiters(self):
+    listing, _ = self.index.start_listing('1')
+    self.index.finish_listing('1', error=ValueError('denied'))
+    with self.assertRaisesRegex(ValueError, 'denied'):
+      listing.result()
+    self.assertFalse(self.index.is_listed('1'))
+    self.assertTrue(self.index.start_listing('1')[1])
+
+  def test_add_and_invalidate(self):
+    self.index.links('1', self.list_links)
+    created = GoogleAdsLink(customer_id='222')
+    self.index.add('1', created)
+    self.assertIs(created, self.index.links('1', self.list_links)['222'])
+    self.index.invalidate('1')
+    self.assertNotIn('222', self.index.links('1', self.list_links))
+
+  def test_property_id_from_name(self):
+    self.assertEqual(
+        '1', link_index.property_id_from_name('properties/1/googleAdsLinks/a'))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,424 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Describes each type of link that the Admin API can manage.
+
+Every link type follows the same pattern: the links of a property are listed,
+created, updated and deleted by client methods named after the resource, and
+each link is identified within its property by the ID of the linked account.
+LINK_TYPES holds what differs between them, so that one code path handles
+every type and a new type only needs a new entry.
+
+Creating a link is written as a generator of Admin API requests, so that the
+same logic can be driven by a thread with the synchronous client or by an
+event loop with the async client. It yields the name of each client method
+together with its keyword arguments, and is sent the response or thrown the
+error of the request in return. Rows for a property that is already being
+listed yield WAIT_FOR_LISTING instead, and are sent the links once the list
+request of the first row returns.
+"""
+
+import asyncio
+from collections.abc import Generator, Mapping
+import dataclasses
+from typing import Any
+
+from google.analytics.admin_v1alpha import types
+
+from shared import link_index
+from shared import rate_limiter
+
+# A request to send, as the client method name and its keyword arguments.
+Request = tuple[str, dict[str, Any]]
+# The pseudo method of a request that waits for the "listing" future of a
+# property that another row is listing, instead of calling the client.
+WAIT_FOR_LISTING = 'wait_for_listing'
+
+
+@dataclasses.dataclass(frozen=True)
+class LinkResource:
+  """How one type of link is managed through the Admin API.
+
+  Attributes:
+      message: The message class of the link, such as GoogleAdsLink.
+      method: The name of the link in client methods, such as google_ads_link
+        for create_google_ads_link.
+      field: The name of the link in requests and in list responses, which
+        holds the plural, such as google_ads_links.
+      id_field: The link field that holds the ID of the linked account.
+      settings: The link fields that may be set when the link is created.
+      mutable_settings: The settings that updates can change. Links without
+        any cannot be updated.
+      prerequisite: The link type whose existing link makes this link
+        unnecessary, such as a DV360 link for a DV360 link proposal.
+  """
+  message: type[Any]
+  method: str
+  field: str
+  id_field: str
+  settings: tuple[str, ...] = ()
+  mutable_settings: tuple[str, ...] = ()
+  prerequisite: str | None = None
+
+  @property
+  def list_method(self) -> str:
+    return f'list_{self.method}s'
+
+  @property
+  def create_method(self) -> str:
+    return f'create_{self.method}'
+
+  @property
+  def update_method(self) -> str:
+    return f'update_{self.method}'
+
+  @property
+  def delete_method(self) -> str:
+    return f'delete_{self.method}'
+
+  @property
+  def list_field(self) -> str:
+    return f'{self.field}s'
+
+  def new_link(self, values: Mapping[str, Any]) -> Any:
+    """Returns the link to create from the values of a request."""
+    settings = {
+        field: values[field] for field in self.settings if field in values}
+    return self.message(**{self.id_field: str(values[self.id_field])},
+                        **settings)
+
+  def changeable(self, values: Mapping[str, Any]) -> dict[str, Any]:
+    """Returns the values of the settings that updates can change."""
+    return {
+        field: values[field]
+        for field in self.mutable_settings if field in values}
+
+
+_DV360_SETTINGS = (
+    'ads_personalization_enabled',
+    'campaign_data_sharing_enabled',
+    'cost_data_sharing_enabled',
+)
+_BIGQUERY_SETTINGS = (
+    'daily_export_enabled',
+    'streaming_export_enabled',
+    'fresh_daily_export_enabled',
+    'include_advertising_id',
+    'export_streams',
+    'excluded_events',
+)
+
+# The link types keyed by the name that messages and input files use.
+LINK_TYPES = {
+    'ads_link': LinkResource(
+        message=types.GoogleAdsLink,
+        method='google_ads_link',
+        field='google_ads_link',
+        id_field='customer_id',
+        settings=('ads_personalization_enabled',),
+        mutable_settings=('ads_personalization_enabled',)),
+    # Only ads personalization can be changed after a DV360 link has been
+    # created, so the data sharing settings are not compared.
+    'dv360_link': LinkResource(
+        message=types.DisplayVideo360AdvertiserLink,
+        method='display_video360_advertiser_link',
+        field='display_video_360_advertiser_link',
+        id_field='advertiser_id',
+        settings=_DV360_SETTINGS,
+        mutable_settings=('ads_personalization_enabled',)),
+    # A proposal is not needed if the advertiser is already linked or a
+    # proposal for it is still pending.
+    'dv360_link_proposal': LinkResource(
+        message=types.DisplayVideo360AdvertiserLinkProposal,
+        method='display_video360_advertiser_link_proposal',
+        field='display_video_360_advertiser_link_proposal',
+        id_field='advertiser_id',
+        settings=(*_DV360_SETTINGS, 'validation_email'),
+        prerequisite='dv360_link'),
+    'firebase_link': LinkResource(
+        message=types.FirebaseLink,
+        method='firebase_link',
+        field='firebase_link',
+        id_field='project'),
+    'bigquery_link': LinkResource(
+        message=types.BigQueryLink,
+        method='big_query_link',
+        field='bigquery_link',
+        id_field='project',
+        settings=(*_BIGQUERY_SETTINGS, 'dataset_location'),
+        mutable_settings=_BIGQUERY_SETTINGS),
+    'search_ads_360_link': LinkResource(
+        message=types.SearchAds360Link,
+        method='search_ads360_link',
+        field='search_ads_360_link',
+        id_field='advertiser_id',
+        settings=(*_DV360_SETTINGS, 'site_stats_sharing_enabled'),
+        mutable_settings=(
+            'ads_personalization_enabled', 'site_stats_sharing_enabled')),
+    'adsense_link': LinkResource(
+        message=types.AdSenseLink,
+        method='ad_sense_link',
+        field='adsense_link',
+        id_field='ad_client_code'),
+}
+
+# Other names that the link types are known by, such as the request types
+# in the linker's input files.
+ALIASES = {
+    'ads': 'ads_link',
+    'dv360': 'dv360_link',
+}
+
+
+def get(link_type: str) -> LinkResource:
+  """Returns the link type with the given name or alias.
+
+  Raises:
+      ValueError: If there is no such link type.
+  """
+  link_type = ALIASES.get(link_type, link_type)
+  if link_type not in LINK_TYPES:
+    raise ValueError(f'Unknown link type: {link_type}')
+  return LINK_TYPES[link_type]
+
+
+def new_indexes(ttl: float | None = None) -> dict[str, link_index.LinkIndex]:
+  """Returns an empty link index for each link type, keyed by its name."""
+  return {
+      name: link_index.LinkIndex(resource.id_field, ttl=ttl)
+      for name, resource in LINK_TYPES.items()}
+
+
+def create_steps(
+    link_type: str,
+    indexes: Mapping[str, link_index.LinkIndex],
+    property_id: str,
+    values: Mapping[str, Any],
+) -> Generator[Request, Any, tuple[link_index.Decision, Any]]:
+  """Creates a link unless it already exists with the requested settings.
+
+  The existing links of the property are looked up in the index first, so a
+  link that already exists is skipped, or updated if its settings differ.
+
+  Args:
+      link_type: The name of the link type.
+      indexes: The link indexes keyed by link type, from new_indexes().
+      property_id: The Google Analytics property ID.
+      values: The ID of the linked account and the settings of the link,
+        keyed by link field.
+
+  Yields:
+      The requests to send.
+
+  Returns:
+      The decision made for the link, and the created, updated or existing
+      link.
+  """
+  link_type = ALIASES.get(link_type, link_type)
+  resource = get(link_type)
+  platform_id = str(values[resource.id_field])
+  if resource.prerequisite:
+    decision = yield from resolve_steps(
+        resource.prerequisite, indexes, property_id, platform_id, {})
+    if decision.resolution != link_index.Resolution.CREATE:
+      return decision, decision.link
+  settings = resource.changeable(values)
+  decision = yield from resolve_steps(
+      link_type, indexes, property_id, platform_id, settings)
+  if decision.resolution == link_index.Resolution.SKIP:
+    return decision, decision.link
+  if decision.resolution == link_index.Resolution.UPDATE:
+    response = yield resource.update_method, {
+        resource.field: resource.message(name=decision.link.name, **settings),
+        'update_mask': ','.join(decision.changed_fields)}
+  else:
+    response = yield resource.create_method, {
+        'parent': f'properties/{property_id}',
+        resource.field: resource.new_link(values)}
+  indexes[link_type].add(property_id, response)
+  return decision, response
+
+
+def update_steps(
+    link_type: str,
+    indexes: Mapping[str, link_index.LinkIndex],
+    name: str,
+    values: Mapping[str, Any],
+) -> Generator[Request, Any, tuple[link_index.Decision, Any]]:
+  """Updates the settings of a link that differ from the requested values.
+
+  The link is looked up by name among the indexed links of its property, and
+  only the settings whose values differ are sent and named in the update
+  mask. A link that already has the requested settings is not updated. A link
+  that is not in the index is updated with every requested setting, so that
+  the API reports whether it exists.
+
+  Args:
+      link_type: The name of the link type.
+      indexes: The link indexes keyed by link type, from new_indexes().
+      name: The resource name of the link.
+      values: The requested settings, keyed by link field.
+
+  Yields:
+      The requests to send.
+
+  Returns:
+      The decision made for the link, and the updated or existing link.
+
+  Raises:
+      ValueError: If the values contain no settings that can be updated.
+  """
+  link_type = ALIASES.get(link_type, link_type)
+  resource = get(link_type)
+  settings = resource.changeable(values)
+  if not settings:
+    raise ValueError(
+        f"No settings of {link_type} links that can be updated, expected "
+        f"one of {','.join(resource.mutable_settings) or 'none'}")
+  property_id = link_index.property_id_from_name(name)
+  index = indexes[link_type]
+  links = yield from list_steps(resource, index, property_id)
+  link = next(
+      (link for link in index.links(property_id, lambda: links).values()
+       if link.name == name),
+      None)
+  changed_fields = tuple(
+      field for field, value in settings.items()
+      if link is None or getattr(link, field) != value)
+  if not changed_fields:
+    return link_index.Decision(link_index.Resolution.SKIP, link), link
+  response = yield resource.update_method, {
+      resource.field: resource.message(
+          name=name, **{field: settings[field] for field in changed_fields}),
+      'update_mask': ','.join(changed_fields)}
+  index.add(property_id, response)
+  return (
+      link_index.Decision(link_index.Resolution.UPDATE, link, changed_fields),
+      response)
+
+
+def resolve_steps(
+    link_type: str,
+    indexes: Mapping[str, link_index.LinkIndex],
+    property_id: str,
+    platform_id: str,
+    settings: Mapping[str, Any],
+) -> Generator[Request, Any, link_index.Decision]:
+  """Looks up a link in its index, yielding a list request if needed."""
+  resource = get(link_type)
+  index = indexes[ALIASES.get(link_type, link_type)]
+  links = yield from list_steps(resource, index, property_id)
+  return index.resolve(property_id, platform_id, settings, lambda: links)
+
+
+def list_steps(
+    resource: LinkResource,
+    index: link_index.LinkIndex,
+    property_id: str,
+) -> Generator[Request, Any, list[Any] | None]:
+  """Lists the links of a property unless they are indexed or being listed.
+
+  Returns:
+      The links of the property, or None if they were already indexed.
+  """
+  listing, owner = index.start_listing(property_id)
+  if listing is None:
+    return None
+  if not owner:
+    return (yield WAIT_FOR_LISTING, {'listing': listing})
+  try:
+    links = yield resource.list_method, {'parent': f'properties/{property_id}'}
+  except Exception as e:
+    index.finish_listing(property_id, error=e)
+    raise
+  index.finish_listing(property_id, links)
+  return links
+
+
+def drive(
+    steps: Generator[Request, Any, Any],
+    ga_client: Any,
+    limiter: rate_limiter.AdaptiveRateLimiter,
+) -> Any:
+  """Sends the requests of a generator with the synchronous client.
+
+  Args:
+      steps: A generator like create_steps().
+      ga_client: The Admin API client.
+      limiter: The limiter shared by every caller of the same API.
+
+  Returns:
+      The value returned by the generator.
+  """
+  response = None
+  error = None
+  while True:
+    try:
+      if error is None:
+        method, kwargs = steps.send(response)
+      else:
+        method, kwargs = steps.throw(error)
+    except StopIteration as stop:
+      return stop.value
+    response = None
+    error = None
+    try:
+      if method == WAIT_FOR_LISTING:
+        response = kwargs['listing'].result()
+      else:
+        response = rate_limiter.call_with_retry(
+            limiter, getattr(ga_client, method), **kwargs)
+        if method.startswith('list_'):
+          response = list(response)
+    except Exception as e:
+      error = e
+
+
+async def drive_async(
+    steps: Generator[Request, Any, Any],
+    ga_client: Any,
+    limiter: rate_limiter.AdaptiveRateLimiter,
+) -> Any:
+  """Sends the requests of a generator with the async client.
+
+  Args:
+      steps: A generator like create_steps().
+      ga_client: The async Admin API client.
+      limiter: The limiter shared by every caller of the same API.
+
+  Returns:
+      The value returned by the generator.
+  """
+  response = None
+  error = None
+  while True:
+    try:
+      if error is None:
+        method, kwargs = steps.send(response)
+      else:
+        method, kwargs = steps.throw(error)
+    except StopIteration as stop:
+      return stop.value
+    response = None
+    error = None
+    try:
+      if method == WAIT_FOR_LISTING:
+        response = await asyncio.wrap_future(kwargs['listing'])
+      else:
+        response = await rate_limiter.call_with_retry_async(
+            limiter, getattr(ga_client, method), **kwargs)
+        if method.startswith('list_'):
+          response = [link async for link in response]
+    except Exception as e:
+      error = e
@@ -0,0 +1,217 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the link registry."""
+
+import asyncio
+import inspect
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from google.analytics.admin import AnalyticsAdminServiceClient
+from google.analytics.admin_v1alpha.types import BigQueryLink
+from google.analytics.admin_v1alpha.types import DisplayVideo360AdvertiserLink
+from google.analytics.admin_v1alpha.types import GoogleAdsLink
+
+from shared import link_index
+from shared import link_resources
+from shared import rate_limiter
+
+
+async def pager(links):
+  for link in links:
+    yield link
+
+
+class LinkResourcesTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.indexes = link_resources.new_indexes()
+    self.limiter = rate_limiter.AdaptiveRateLimiter(rate=1000, max_rate=1000)
+
+  @parameterized.parameters(*link_resources.LINK_TYPES)
+  def test_link_type_matches_client(self, link_type):
+    resource = link_resources.LINK_TYPES[link_type]
+    fields = resource.message.meta.fields
+    for setting in (resource.id_field, *resource.settings):
+      self.assertIn(setting, fields)
+    self.assertContainsSubset(resource.mutable_settings, resource.settings)
+    self.assertIn(
+        resource.field,
+        inspect.signature(getattr(
+            AnalyticsAdminServiceClient, resource.create_method)).parameters)
+    methods = [resource.list_method, resource.delete_method]
+    if resource.mutable_settings:
+      methods.append(resource.update_method)
+    for method in methods:
+      self.assertTrue(hasattr(AnalyticsAdminServiceClient, method), method)
+
+  def test_get_resolves_aliases(self):
+    self.assertIs(
+        link_resources.LINK_TYPES['ads_link'], link_resources.get('ads'))
+    with self.assertRaisesRegex(ValueError, 'Unknown link type: tiktok'):
+      link_resources.get('tiktok')
+
+  def test_create_steps_lists_then_creates(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.return_value = []
+    ga_client.create_google_ads_link.return_value = GoogleAdsLink(
+        name='properties/1/googleAdsLinks/a', customer_id='111')
+    decision, response = link_resources.drive(
+        link_resources.create_steps(
+            'ads', self.indexes, '1',
+            {'customer_id': 111, 'ads_personalization_enabled': True}),
+        ga_client, self.limiter)
+    self.assertEqual(link_index.Resolution.CREATE, decision.resolution)
+    self.assertEqual('properties/1/googleAdsLinks/a', response.name)
+    ga_client.create_google_ads_link.assert_called_once_with(
+        parent='properties/1',
+        google_ads_link=GoogleAdsLink(
+            customer_id='111', ads_personalization_enabled=True))
+    # The created link was added to the index of the link type.
+    self.assertEqual(
+        link_index.Resolution.SKIP,
+        self.indexes['ads_link'].resolve(
+            '1', '111', {}, mock.Mock()).resolution)
+
+  def test_create_steps_skips_proposal_for_linked_advertiser(self):
+    ga_client = mock.Mock()
+    link = DisplayVideo360AdvertiserLink(
+        name='properties/1/displayVideo360AdvertiserLinks/a',
+        advertiser_id='222')
+    ga_client.list_display_video360_advertiser_links.return_value = [link]
+    decision, response = link_resources.drive(
+        link_resources.create_steps(
+            'dv360_link_proposal', self.indexes, '1',
+            {'advertiser_id': '222', 'validation_email': 'a@example.com'}),
+        ga_client, self.limiter)
+    self.assertEqual(link_index.Resolution.SKIP, decision.resolution)
+    self.assertEqual(link, response)
+    ga_client.list_display_video360_advertiser_link_proposals.assert_not_called()
+    ga_client.create_display_video360_advertiser_link_proposal.assert_not_called()
+
+  def test_update_steps_sends_only_changed_settings(self):
+    ga_client = mock.Mock()
+    ga_client.list_big_query_links.return_value = [BigQueryLink(
+        name='properties/1/bigQueryLinks/a',
+        project='projects/42',
+        daily_export_enabled=True,
+        streaming_export_enabled=True)]
+    ga_client.update_big_query_link.return_value = 'updated'
+    decision, response = link_resources.drive(
+        link_resources.update_steps(
+            'bigquery_link', self.indexes, 'properties/1/bigQueryLinks/a',
+            {'daily_export_enabled': True,
+             'streaming_export_enabled': False}),
+        ga_client, self.limiter)
+    self.assertEqual(link_index.Resolution.UPDATE, decision.resolution)
+    self.assertEqual('updated', response)
+    ga_client.update_big_query_link.assert_called_once_with(
+        bigquery_link=BigQueryLink(
+            name='properties/1/bigQueryLinks/a',
+            streaming_export_enabled=False),
+        update_mask='streaming_export_enabled')
+
+  def test_update_steps_skips_unchanged_link(self):
+    ga_client = mock.Mock()
+    link = GoogleAdsLink(
+        name='properties/1/googleAdsLinks/a',
+        customer_id='111',
+        ads_personalization_enabled=True)
+    ga_client.list_google_ads_links.return_value = [link]
+    for _ in range(2):
+      decision, response = link_resources.drive(
+          link_resources.update_steps(
+              'ads_link', self.indexes, 'properties/1/googleAdsLinks/a',
+              {'ads_personalization_enabled': True}),
+          ga_client, self.limiter)
+      self.assertEqual(link_index.Resolution.SKIP, decision.resolution)
+      self.assertEqual(link, response)
+    ga_client.list_google_ads_links.assert_called_once()
+    ga_client.update_google_ads_link.assert_not_called()
+
+  def test_update_steps_updates_link_missing_from_index(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.return_value = []
+    link_resources.drive(
+        link_resources.update_steps(
+            'ads_link', self.indexes, 'properties/1/googleAdsLinks/a',
+            {'ads_personalization_enabled': False}),
+        ga_client, self.limiter)
+    ga_client.update_google_ads_link.assert_called_once_with(
+        google_ads_link=GoogleAdsLink(
+            name='properties/1/googleAdsLinks/a',
+            ads_personalization_enabled=False),
+        update_mask='ads_personalization_enabled')
+
+  def test_drive_throws_errors_into_steps(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links.side_effect = ValueError('denied')
+    with self.assertRaisesRegex(ValueError, 'denied'):
+      link_resources.drive(
+          link_resources.create_steps(
+              'ads_link', self.indexes, '1', {'customer_id': '111'}),
+          ga_client, self.limiter)
+
+  def concurrent_creates(self, ga_client, customer_ids):
+    async def create_links():
+      return await asyncio.gather(
+          *(link_resources.drive_async(
+              link_resources.create_steps(
+                  'ads_link', self.indexes, '1', {'customer_id': customer_id}),
+              ga_client, self.limiter)
+            for customer_id in customer_ids),
+          return_exceptions=True)
+    return asyncio.run(create_links())
+
+  def test_drive_async_lists_property_once_for_concurrent_rows(self):
+    ga_client = mock.Mock()
+
+    async def list_links(parent):
+      del parent
+      await asyncio.sleep(0)
+      return pager([GoogleAdsLink(
+          name='properties/1/googleAdsLinks/a', customer_id='111')])
+
+    ga_client.list_google_ads_links = mock.AsyncMock(side_effect=list_links)
+    ga_client.create_google_ads_link = mock.AsyncMock(
+        side_effect=lambda parent, google_ads_link: google_ads_link)
+    outcomes = self.concurrent_creates(ga_client, ['111', '222', '333'])
+    ga_client.list_google_ads_links.assert_awaited_once()
+    self.assertEqual(
+        [link_index.Resolution.SKIP, link_index.Resolution.CREATE,
+         link_index.Resolution.CREATE],
+        [decision.resolution for decision, _ in outcomes])
+    self.assertEqual(2, ga_client.create_google_ads_link.await_count)
+
+  def test_drive_async_fails_rows_waiting_for_failed_list(self):
+    ga_client = mock.Mock()
+    ga_client.list_google_ads_links = mock.AsyncMock(
+        side_effect=ValueError('denied'))
+    outcomes = self.concurrent_creates(ga_client, ['111', '222'])
+    self.assertEqual(['denied'] * 2, [str(outcome) for outcome in outcomes])
+    ga_client.list_google_ads_links.assert_awaited_once()
+    # The next row lists the property again.
+    ga_client.list_google_ads_links.side_effect = None
+    ga_client.list_google_ads_links.return_value = pager([])
+    ga_client.create_google_ads_link = mock.AsyncMock(return_value='created')
+    self.assertEqual(['created'], [
+        response for _, response in self.concurrent_creates(
+            ga_client, ['111'])])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,219 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collects timings and counts for each function invocation.
+
+A function decorated with instrumented() gets a Metrics collector for the
+duration of each invocation. The shared helpers record into the collector of
+the current invocation through the module-level span(), count() and observe()
+functions, which do nothing outside of an invocation. When the invocation
+ends, the collected values are printed as a single structured log entry that
+Cloud Logging parses into a JSON payload.
+
+The collector is held in a context variable. Threads started by a function do
+not inherit it unless the work is submitted with contextvars.copy_context(),
+while asyncio tasks and asyncio.to_thread inherit it automatically.
+"""
+
+import bisect
+from collections.abc import Callable, Iterator
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+from typing import Any, TypeVar
+
+_T = TypeVar('_T')
+
+# Upper bounds in milliseconds of the latency histogram buckets.
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_current = contextvars.ContextVar('metrics', default=None)
+
+
+class Metrics:
+  """The timings and counts collected during one invocation."""
+
+  def __init__(
+      self,
+      function: str,
+      clock: Callable[[], float] = time.perf_counter,
+  ) -> None:
+    """Initializes the collector.
+
+    Args:
+        function: The name of the function, included in the log entry.
+        clock: Returns the current time in seconds.
+    """
+    self.function = function
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._spans = {}
+    self._counters = {}
+    self._histograms = {}
+
+  @contextlib.contextmanager
+  def span(self, stage: str) -> Iterator[None]:
+    """Adds the time spent in the block to the total for a stage.
+
+    Spans may be nested, and spans for the same stage on different threads
+    add up, so the total for a stage can be longer than the invocation.
+
+    Args:
+        stage: The name of the stage, such as "csv_read".
+    """
+    start = self._clock()
+    try:
+      yield
+    finally:
+      elapsed = self._clock() - start
+      with self._lock:
+        span = self._spans.setdefault(stage, {'count': 0, 'seconds': 0.0})
+        span['count'] += 1
+        span['seconds'] += elapsed
+
+  def count(self, name: str, value: int = 1) -> None:
+    """Adds to a counter, such as "api_calls.RESOURCE_EXHAUSTED"."""
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def observe(self, name: str, seconds: float) -> None:
+    """Adds a latency to a histogram with the BUCKETS_MS bounds."""
+    milliseconds = seconds * 1000
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = {
+            'count': 0,
+            'sum_ms': 0.0,
+            'max_ms': 0.0,
+            'buckets': [0] * (len(BUCKETS_MS) + 1),
+        }
+        self._histograms[name] = histogram
+      histogram['count'] += 1
+      histogram['sum_ms'] += milliseconds
+      histogram['max_ms'] = max(histogram['max_ms'], milliseconds)
+      histogram['buckets'][bisect.bisect_left(BUCKETS_MS, milliseconds)] += 1
+
+  def snapshot(self) -> dict[str, Any]:
+    """Returns the collected values as a JSON serializable dictionary."""
+    with self._lock:
+      histograms = {}
+      for name, histogram in self._histograms.items():
+        bounds = [f'le_{bound}ms' for bound in BUCKETS_MS] + ['inf']
+        histograms[name] = {
+            'count': histogram['count'],
+            'sum_ms': round(histogram['sum_ms'], 3),
+            'max_ms': round(histogram['max_ms'], 3),
+            'buckets': {
+                bound: count
+                for bound, count in zip(bounds, histogram['buckets'])
+                if count},
+        }
+      return {
+          'function': self.function,
+          'spans': {
+              stage: {
+                  'count': span['count'],
+                  'seconds': round(span['seconds'], 6)}
+              for stage, span in self._spans.items()},
+          'counters': dict(self._counters),
+          'histograms': histograms,
+      }
+
+  def emit(self) -> None:
+    """Prints the collected values as a structured log entry."""
+    entry = self.snapshot()
+    entry['severity'] = 'INFO'
+    entry['message'] = f'{self.function} metrics'
+    print(json.dumps(entry), flush=True)
+
+
+def current() -> Metrics | None:
+  """Returns the collector of the current invocation, if there is one."""
+  return _current.get()
+
+
+@contextlib.contextmanager
+def invocation(function: str) -> Iterator[Metrics]:
+  """Collects metrics for the block and logs them when it ends.
+
+  Args:
+      function: The name of the function, included in the log entry.
+
+  Yields:
+      The collector for the block.
+  """
+  collector = Metrics(function)
+  token = _current.set(collector)
+  try:
+    with collector.span('total'):
+      yield collector
+  finally:
+    _current.reset(token)
+    collector.emit()
+
+
+def instrumented(
+    function: str) -> Callable[[Callable[..., _T]], Callable[..., _T]]:
+  """Decorates a function entry point to collect metrics per invocation.
+
+  Args:
+      function: The name of the function, included in the log entry.
+
+  Returns:
+      A decorator for the entry point.
+  """
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with invocation(function):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+@contextlib.contextmanager
+def span(stage: str) -> Iterator[None]:
+  """Times the block in the current invocation, if there is one."""
+  collector = _current.get()
+  if collector is None:
+    yield
+    return
+  with collector.span(stage):
+    yield
+
+
+def count(name: str, value: int = 1) -> None:
+  """Adds to a counter of the current invocation, if there is one."""
+  collector = _current.get()
+  if collector is not None:
+    collector.count(name, value)
+
+
+def observe(name: str, seconds: float) -> None:
+  """Adds a latency to a histogram of the current invocation, if any."""
+  collector = _current.get()
+  if collector is not None:
+    collector.observe(name, seconds)
+
+
+def status_name(error: BaseException | None) -> str:
+  """Returns the gRPC status name of an API error, or OK for no error."""
+  if error is None:
+    return 'OK'
+  code = getattr(error, 'grpc_status_code', None)
+  return code.name if code is not None else type(error).__name__
@@ -0,0 +1,93 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the invocation metrics."""
+
+import contextlib
+import io
+import json
+from unittest import mock
+
+from absl.testing import absltest
+from google.api_core import exceptions
+
+from shared import metrics
+from shared import rate_limiter
+
+
+class MetricsTest(absltest.TestCase):
+
+  def test_span_count_and_observe(self):
+    now = [0.0]
+    collector = metrics.Metrics('test', clock=lambda: now[0])
+    with collector.span('csv_read'):
+      now[0] = 1.5
+    collector.count('api_calls.OK')
+    collector.count('api_calls.OK', 2)
+    collector.observe('api_latency.list', 0.02)
+    collector.observe('api_latency.list', 20)
+    snapshot = collector.snapshot()
+    self.assertEqual(
+        {'csv_read': {'count': 1, 'seconds': 1.5}}, snapshot['spans'])
+    self.assertEqual({'api_calls.OK': 3}, snapshot['counters'])
+    self.assertEqual(
+        {'count': 2, 'sum_ms': 20020.0, 'max_ms': 20000.0,
+         'buckets': {'le_25ms': 1, 'inf': 1}},
+        snapshot['histograms']['api_latency.list'])
+
+  def test_module_functions_do_nothing_outside_invocation(self):
+    self.assertIsNone(metrics.current())
+    with metrics.span('stage'):
+      metrics.count('counter')
+      metrics.observe('histogram', 1.0)
+
+  def test_instrumented_logs_metrics_of_each_invocation(self):
+
+    @metrics.instrumented('test_function')
+    def handler(value):
+      metrics.count('rows')
+      with metrics.span('work'):
+        return value * 2
+
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      self.assertEqual(4, handler(2))
+    entry = json.loads(stdout.getvalue())
+    self.assertEqual('test_function', entry['function'])
+    self.assertEqual('INFO', entry['severity'])
+    self.assertEqual({'rows': 1}, entry['counters'])
+    self.assertCountEqual(['total', 'work'], entry['spans'])
+    self.assertIsNone(metrics.current())
+
+  def test_call_with_retry_counts_calls_by_status(self):
+    limiter = rate_limiter.AdaptiveRateLimiter(
+        rate=1000, sleep=lambda _: None)
+    func = mock.Mock(
+        __name__='list_google_ads_links',
+        side_effect=[exceptions.ResourceExhausted('quota'), []])
+    with contextlib.redirect_stdout(io.StringIO()):
+      with metrics.invocation('test') as collector:
+        rate_limiter.call_with_retry(limiter, func)
+    snapshot = collector.snapshot()
+    self.assertEqual(
+        {'api_calls.RESOURCE_EXHAUSTED': 1, 'api_calls.OK': 1,
+         'api_retries': 1},
+        snapshot['counters'])
+    self.assertEqual(
+        2, snapshot['histograms']['api_latency.list_google_ads_links']['count'])
+    self.assertIn('backoff', snapshot['spans'])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,255 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Paces and retries Google Analytics Admin API requests.
+
+The limiter is a token bucket whose rate is adjusted with additive increase
+and multiplicative decrease (AIMD): every successful request raises the rate
+slightly and every RESOURCE_EXHAUSTED or UNAVAILABLE response halves it. This
+keeps callers close to the quota ceiling instead of at a fixed conservative
+rate. Throttled requests are retried with jittered exponential backoff.
+"""
+
+import asyncio
+from collections.abc import Awaitable, Callable
+import os
+import random
+import threading
+import time
+from typing import Any, TypeVar
+
+from google.api_core import exceptions
+
+from shared import metrics
+
+_T = TypeVar('_T')
+
+# Errors that mean the request should be slowed down and tried again.
+RETRYABLE_ERRORS = (
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+)
+
+DEFAULT_RATE = 5.0
+DEFAULT_MIN_RATE = 0.5
+DEFAULT_MAX_RATE = 20.0
+MAX_ATTEMPTS = 5
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 32.0
+
+
+class AdaptiveRateLimiter:
+  """A thread-safe token bucket with an AIMD-adjusted refill rate."""
+
+  def __init__(
+      self,
+      rate: float = DEFAULT_RATE,
+      min_rate: float = DEFAULT_MIN_RATE,
+      max_rate: float = DEFAULT_MAX_RATE,
+      increase: float = 0.5,
+      decrease: float = 0.5,
+      clock: Callable[[], float] = time.monotonic,
+      sleep: Callable[[float], None] = time.sleep,
+  ) -> None:
+    """Initializes the limiter.
+
+    Args:
+        rate: The initial number of requests per second.
+        min_rate: The rate is never decreased below this value.
+        max_rate: The rate is never increased above this value.
+        increase: Requests per second added for each second of successful
+          requests.
+        decrease: The factor the rate is multiplied by when throttled.
+        clock: Returns the current time in seconds.
+        sleep: Blocks for the given number of seconds.
+    """
+    self._min_rate = min_rate
+    self._max_rate = max_rate
+    self._rate = min(max(rate, min_rate), max_rate)
+    self._increase = increase
+    self._decrease = decrease
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = 1.0
+    self._updated = clock()
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_env(cls) -> 'AdaptiveRateLimiter':
+    """Creates a limiter configured by the REQUESTS_PER_SECOND,
+    MIN_REQUESTS_PER_SECOND and MAX_REQUESTS_PER_SECOND environment variables.
+    """
+    return cls(
+        rate=float(os.environ.get('REQUESTS_PER_SECOND', DEFAULT_RATE)),
+        min_rate=float(
+            os.environ.get('MIN_REQUESTS_PER_SECOND', DEFAULT_MIN_RATE)),
+        max_rate=float(
+            os.environ.get('MAX_REQUESTS_PER_SECOND', DEFAULT_MAX_RATE)))
+
+  @property
+  def rate(self) -> float:
+    """The current number of requests per second."""
+    return self._rate
+
+  def acquire(self) -> None:
+    """Blocks until the caller is allowed to send one request."""
+    wait = self.reserve()
+    if wait > 0:
+      self._sleep(wait)
+
+  def reserve(self) -> float:
+    """Reserves one request without blocking.
+
+    Returns:
+        The number of seconds the caller has to wait before sending the
+        request.
+    """
+    with self._lock:
+      now = self._clock()
+      # The bucket holds at most one second worth of tokens.
+      self._tokens = min(
+          max(self._rate, 1.0),
+          self._tokens + (now - self._updated) * self._rate)
+      self._updated = now
+      # Reserving the token before sleeping lets concurrent callers queue up
+      # behind each other instead of all waking at the same moment.
+      self._tokens -= 1.0
+      return -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+  def record_success(self) -> None:
+    """Additively increases the rate after a successful request."""
+    with self._lock:
+      self._rate = min(self._max_rate, self._rate + self._increase / self._rate)
+
+  def record_throttle(self) -> None:
+    """Multiplicatively decreases the rate after a throttled request."""
+    with self._lock:
+      self._rate = max(self._min_rate, self._rate * self._decrease)
+      self._tokens = min(self._tokens, 0.0)
+
+  def backoff(self, attempt: int) -> None:
+    """Sleeps before retrying a request that has failed attempt times."""
+    self._sleep(backoff_delay(attempt))
+
+
+def backoff_delay(attempt: int) -> float:
+  """Returns a jittered exponential delay for the given retry attempt.
+
+  Args:
+      attempt: The number of attempts that have already failed, starting at 1.
+
+  Returns:
+      A random number of seconds between zero and the exponential backoff cap.
+  """
+  return random.uniform(
+      0, min(MAX_BACKOFF, INITIAL_BACKOFF * 2 ** (attempt - 1)))
+
+
+def call_with_retry(
+    limiter: AdaptiveRateLimiter,
+    func: Callable[..., _T],
+    *args: Any,
+    **kwargs: Any,
+) -> _T:
+  """Calls an Admin API method paced by the limiter.
+
+  RESOURCE_EXHAUSTED and UNAVAILABLE errors slow the limiter down and the call
+  is retried up to MAX_ATTEMPTS times. Any other error is raised immediately.
+
+  Args:
+      limiter: The limiter shared by every caller of the same API.
+      func: The API method to call.
+      *args: Positional arguments passed to func.
+      **kwargs: Keyword arguments passed to func.
+
+  Returns:
+      The value returned by func.
+  """
+  method = getattr(func, '__name__', 'unknown')
+  attempt = 0
+  while True:
+    attempt += 1
+    with metrics.span('rate_limit_wait'):
+      limiter.acquire()
+    start = time.perf_counter()
+    try:
+      response = func(*args, **kwargs)
+    except RETRYABLE_ERRORS as e:
+      _record_attempt(method, start, e)
+      limiter.record_throttle()
+      if attempt >= MAX_ATTEMPTS:
+        raise
+      metrics.count('api_retries')
+      with metrics.span('backoff'):
+        limiter.backoff(attempt)
+    except Exception as e:
+      _record_attempt(method, start, e)
+      raise
+    else:
+      _record_attempt(method, start, None)
+      limiter.record_success()
+      return response
+
+
+async def call_with_retry_async(
+    limiter: AdaptiveRateLimiter,
+    func: Callable[..., Awaitable[_T]],
+    *args: Any,
+    **kwargs: Any,
+) -> _T:
+  """Awaits an async Admin API method paced by the limiter.
+
+  This behaves like call_with_retry, but waits for the limiter and the
+  backoff without blocking the event loop.
+
+  Args:
+      limiter: The limiter shared by every caller of the same API.
+      func: The async API method to call.
+      *args: Positional arguments passed to func.
+      **kwargs: Keyword arguments passed to func.
+
+  Returns:
+      The value returned by awaiting func.
+  """
+  method = getattr(func, '__name__', 'unknown')
+  attempt = 0
+  while True:
+    attempt += 1
+    with metrics.span('rate_limit_wait'):
+      await asyncio.sleep(limiter.reserve())
+    start = time.perf_counter()
+    try:
+      response = await func(*args, **kwargs)
+    except RETRYABLE_ERRORS as e:
+      _record_attempt(method, start, e)
+      limiter.record_throttle()
+      if attempt >= MAX_ATTEMPTS:
+        raise
+      metrics.count('api_retries')
+      with metrics.span('backoff'):
+        await asyncio.sleep(backoff_delay(attempt))
+    except Exception as e:
+      _record_attempt(method, start, e)
+      raise
+    else:
+      _record_attempt(method, start, None)
+      limiter.record_success()
+      return response
+
+
+def _record_attempt(
+    method: str, start: float, error: Exception | None) -> None:
+  """Records the latency and gRPC status of one request attempt."""
+  metrics.observe(f'api_latency.{method}', time.perf_counter() - start)
+  metrics.count(f'api_calls.{metrics.status_name(error)}')
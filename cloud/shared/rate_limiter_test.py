@@ -0,0 +1,91 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the adaptive rate limiter."""
+
+import asyncio
+from unittest import mock
+
+from absl.testing import absltest
+from google.api_core import exceptions
+
+from shared import rate_limiter
+from shared import testing
+
+
+class AdaptiveRateLimiterTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.clock = testing.FakeClock()
+    self.limiter = rate_limiter.AdaptiveRateLimiter(
+        rate=2.0, min_rate=0.5, max_rate=4.0,
+        clock=self.clock.time, sleep=self.clock.sleep)
+
+  def test_acquire_paces_requests_at_rate(self):
+    for _ in range(5):
+      self.limiter.acquire()
+    self.assertEqual([0.5, 0.5, 0.5, 0.5], self.clock.sleeps)
+
+  def test_record_throttle_halves_rate(self):
+    self.limiter.record_throttle()
+    self.assertEqual(1.0, self.limiter.rate)
+    self.limiter.record_throttle()
+    self.limiter.record_throttle()
+    self.assertEqual(0.5, self.limiter.rate)
+
+  def test_record_success_increases_rate_up_to_max(self):
+    self.limiter.record_success()
+    self.assertGreater(self.limiter.rate, 2.0)
+    for _ in range(100):
+      self.limiter.record_success()
+    self.assertEqual(4.0, self.limiter.rate)
+
+  def test_call_with_retry_retries_throttled_calls(self):
+    func = mock.Mock(side_effect=[
+        exceptions.ResourceExhausted('quota'),
+        exceptions.ServiceUnavailable('unavailable'),
+        'created'])
+    self.assertEqual(
+        'created', rate_limiter.call_with_retry(self.limiter, func, name='x'))
+    self.assertEqual(3, func.call_count)
+    func.assert_called_with(name='x')
+
+  def test_call_with_retry_raises_after_max_attempts(self):
+    func = mock.Mock(side_effect=exceptions.ResourceExhausted('quota'))
+    with self.assertRaises(exceptions.ResourceExhausted):
+      rate_limiter.call_with_retry(self.limiter, func)
+    self.assertEqual(rate_limiter.MAX_ATTEMPTS, func.call_count)
+
+  def test_call_with_retry_raises_other_errors_immediately(self):
+    func = mock.Mock(side_effect=exceptions.PermissionDenied('denied'))
+    with self.assertRaises(exceptions.PermissionDenied):
+      rate_limiter.call_with_retry(self.limiter, func)
+    self.assertEqual(1, func.call_count)
+
+  def test_call_with_retry_async_retries_throttled_calls(self):
+    func = mock.AsyncMock(side_effect=[
+        exceptions.ResourceExhausted('quota'), 'created'])
+    with mock.patch.object(asyncio, 'sleep', mock.AsyncMock()) as sleep:
+      response = asyncio.run(
+          rate_limiter.call_with_retry_async(self.limiter, func, name='x'))
+    self.assertEqual('created', response)
+    self.assertEqual(2, func.await_count)
+    func.assert_awaited_with(name='x')
+    self.assertLess(self.limiter.rate, 2.0)
+    self.assertEqual(3, sleep.await_count)
+
+
+if __name__ == '__main__':
+  absltest.main()
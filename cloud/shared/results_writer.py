@@ -0,0 +1,318 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streams result records to Cloud Storage.
+
+ResultsWriter buffers records in memory only until the next flush, which
+uploads them as a new part file under a common prefix. Each part is named
+after the offset of its first record, so a run that resumes from a checkpoint
+and produces the same records again overwrites the parts it had already
+written instead of duplicating them.
+
+ExportWriter streams records into a single object, such as a Cloud Storage
+blob opened with blob.open('wb'), which uploads the data in chunks as it is
+written.
+
+Records can be written as CSV, newline delimited JSON or Parquet. Parquet
+needs the optional pyarrow package. read_part reads the records of a part
+back, such as to carry them over into a new part.
+"""
+
+from collections.abc import Iterator, Mapping
+import csv
+import datetime
+import io
+import json
+from typing import Any, BinaryIO, TYPE_CHECKING
+
+from shared import csv_reader
+from shared import metrics
+
+if TYPE_CHECKING:
+  # Only needed for annotations, so that functions that only write exports
+  # do not import the Cloud Storage library when they start.
+  from google.cloud import storage  # pylint: disable=g-import-not-at-top
+
+FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'ndjson': ('ndjson', 'application/x-ndjson'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+
+class ResultsWriter:
+  """Writes result records to numbered part files."""
+
+  def __init__(
+      self,
+      bucket: 'storage.Bucket',
+      prefix: str,
+      file_format: str = 'csv',
+      offset: int = 0,
+      part_rows: int | None = None,
+  ) -> None:
+    """Initializes the writer.
+
+    Args:
+        bucket: The bucket the parts are written to.
+        prefix: The prefix of the part names, such as "results/input.csv/1/".
+        file_format: One of FORMATS.
+        offset: The offset of the first record, such as the row of the input
+          file that a resumed run starts from.
+        part_rows: Parts are flushed once they hold this many records. None
+          only flushes them when flush() is called.
+
+    Raises:
+        ValueError: If the format is not one of FORMATS.
+    """
+    if file_format not in FORMATS:
+      raise ValueError(
+          f"Unknown results format {file_format}, expected one of "
+          f"{','.join(FORMATS)}")
+    self._bucket = bucket
+    self._prefix = prefix
+    self._format = file_format
+    self._offset = offset
+    self._part_rows = part_rows
+    self._records = []
+    self.parts = []
+
+  def __enter__(self) -> 'ResultsWriter':
+    return self
+
+  def __exit__(self, *args: Any) -> None:
+    self.close()
+
+  def write(self, record: Mapping[str, Any]) -> None:
+    """Buffers a record until the next flush.
+
+    Values that are not strings, numbers, booleans or None, such as
+    exceptions, are written as strings.
+
+    Args:
+        record: The values of one result, keyed by column name.
+    """
+    self._records.append(_plain(record))
+    if self._part_rows and len(self._records) >= self._part_rows:
+      self.flush()
+
+  def flush(
+      self,
+      offset: int | None = None,
+      custom_time: datetime.datetime | None = None,
+  ) -> str | None:
+    """Uploads the buffered records as a new part.
+
+    Args:
+        offset: The offset the part is named after, such as the input row
+          the part starts at when only some rows have a record. Defaults to
+          the number of records written before the part.
+        custom_time: The custom time of the part object, such as the time
+          the retries it holds are due.
+
+    Returns:
+        The name of the part, or None if there were no records to write.
+    """
+    if not self._records:
+      return None
+    if offset is not None:
+      self._offset = offset
+    extension, content_type = FORMATS[self._format]
+    name = f'{self._prefix}part-{self._offset:09d}.{extension}'
+    blob = self._bucket.blob(name)
+    if custom_time is not None:
+      blob.custom_time = custom_time
+    with metrics.span('results_upload'):
+      blob.upload_from_string(
+          self._encode(self._records), content_type=content_type)
+    self._offset += len(self._records)
+    self._records = []
+    self.parts.append(name)
+    return name
+
+  def close(self) -> None:
+    """Uploads any buffered records."""
+    self.flush()
+
+  def _encode(self, records: list[dict[str, Any]]) -> str | bytes:
+    if self._format == 'csv':
+      file = io.StringIO()
+      # Records may leave out columns, such as the blank cells of input rows.
+      csv_reader.write_records(
+          records, file, list(dict.fromkeys(
+              key for record in records for key in record)))
+      return file.getvalue()
+    if self._format == 'ndjson':
+      return ''.join(json.dumps(record) + '\n' for record in records)
+    return _encode_parquet(records)
+
+
+class ExportWriter:
+  """Streams records into a single file."""
+
+  def __init__(
+      self,
+      file: BinaryIO,
+      file_format: str = 'ndjson',
+      row_group_rows: int = 10000,
+  ) -> None:
+    """Initializes the writer.
+
+    Args:
+        file: A binary file opened for writing, such as a Cloud Storage blob
+          opened with blob.open('wb'). It is closed by close().
+        file_format: One of FORMATS.
+        row_group_rows: The number of records buffered for each Parquet row
+          group. CSV and NDJSON records are written as they arrive.
+
+    Raises:
+        ValueError: If the format is not one of FORMATS.
+    """
+    if file_format not in FORMATS:
+      raise ValueError(
+          f"Unknown export format {file_format}, expected one of "
+          f"{','.join(FORMATS)}")
+    self._file = file
+    self._format = file_format
+    self._row_group_rows = row_group_rows
+    self._text = None
+    self._csv = None
+    self._parquet = None
+    self._records = []
+    self.count = 0
+    if file_format != 'parquet':
+      self._text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+
+  def __enter__(self) -> 'ExportWriter':
+    return self
+
+  def __exit__(self, *args: Any) -> None:
+    self.close()
+
+  def write(self, record: Mapping[str, Any]) -> None:
+    """Writes a record. The columns are taken from the first record."""
+    record = _plain(record)
+    self.count += 1
+    if self._format == 'ndjson':
+      self._text.write(json.dumps(record) + '\n')
+    elif self._format == 'csv':
+      if self._csv is None:
+        self._csv = csv.DictWriter(
+            self._text, fieldnames=list(record), extrasaction='ignore')
+        self._csv.writeheader()
+      self._csv.writerow(record)
+    else:
+      self._records.append(record)
+      if len(self._records) >= self._row_group_rows:
+        self._write_row_group()
+
+  def close(self) -> None:
+    """Writes any buffered records and closes the file."""
+    with metrics.span('results_upload'):
+      if self._text is not None:
+        self._text.close()
+        return
+      if self._records:
+        self._write_row_group()
+      if self._parquet is not None:
+        self._parquet.close()
+      self._file.close()
+
+  def _write_row_group(self) -> None:
+    # Imported here so that only functions that write Parquet need pyarrow.
+    import pyarrow.parquet  # pylint: disable=g-import-not-at-top
+    # Every row group has the columns of the first record.
+    table = _parquet_table(
+        self._records,
+        self._parquet.schema.names if self._parquet else None)
+    if self._parquet is None:
+      self._parquet = pyarrow.parquet.ParquetWriter(self._file, table.schema)
+    self._parquet.write_table(table)
+    self._records = []
+
+
+def read_part(bucket: 'storage.Bucket', name: str) -> Iterator[dict[str, Any]]:
+  """Yields the records of a part written by a ResultsWriter.
+
+  The format is taken from the extension of the name. CSV values are read
+  back as strings, with blank cells as empty strings.
+
+  Args:
+      bucket: The bucket the part was written to.
+      name: The name of the part.
+
+  Yields:
+      The records of the part, in the order they were written.
+  """
+  with metrics.span('results_download'):
+    data = bucket.blob(name).download_as_bytes()
+  if name.endswith('.parquet'):
+    import pyarrow.parquet  # pylint: disable=g-import-not-at-top
+    yield from pyarrow.parquet.read_table(io.BytesIO(data)).to_pylist()
+  elif name.endswith('.csv'):
+    yield from csv.DictReader(io.StringIO(data.decode('utf-8'), newline=''))
+  else:
+    for line in data.decode('utf-8').splitlines():
+      yield json.loads(line)
+
+
+def _plain(record: Mapping[str, Any]) -> dict[str, Any]:
+  """Converts values to types that every format can hold.
+
+  Lists and dictionaries become JSON and other objects, such as exceptions,
+  become strings.
+  """
+  plain = {}
+  for key, value in record.items():
+    if value is None or isinstance(value, (str, int, float, bool)):
+      plain[key] = value
+    elif isinstance(value, (list, dict)):
+      plain[key] = json.dumps(value, default=str)
+    else:
+      plain[key] = str(value)
+  return plain
+
+
+def _parquet_table(
+    records: list[dict[str, Any]], columns: list[str] | None = None) -> Any:
+  """Builds a table with a string column for each of the columns.
+
+  Args:
+      records: The records in the table.
+      columns: The columns of the table. Defaults to the keys of the first
+        record.
+
+  Returns:
+      A pyarrow table.
+  """
+  # Imported here so that only functions that write Parquet need pyarrow.
+  import pyarrow  # pylint: disable=g-import-not-at-top
+  columns = columns or list(records[0])
+  schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+  return pyarrow.Table.from_pylist(
+      [{column: None if record.get(column) is None else str(record[column])
+        for column in columns} for record in records],
+      schema=schema)
+
+
+def _encode_parquet(records: list[dict[str, Any]]) -> bytes:
+  """Encodes records as a Parquet file with a string column per key."""
+  import pyarrow.parquet  # pylint: disable=g-import-not-at-top
+  file = io.BytesIO()
+  # Records may leave out columns, such as unset fields of a resource.
+  pyarrow.parquet.write_table(
+      _parquet_table(records, list(dict.fromkeys(
+          key for record in records for key in record))),
+      file)
+  return file.getvalue()
@@ -0,0 +1,168 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the results writer."""
+
+import datetime
+import importlib.util
+import io
+import json
+
+from absl.testing import absltest
+
+from shared import results_writer
+from shared import testing
+
+
+class ResultsWriterTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.bucket = testing.FakeBucket()
+
+  def test_flush_writes_csv_parts_named_by_offset(self):
+    writer = results_writer.ResultsWriter(
+        self.bucket, 'results/links.csv/1/', offset=500)
+    writer.write({'platform_id': '1', 'result': 'created'})
+    writer.write({'platform_id': '2', 'result': ValueError('bad id')})
+    self.assertEqual('results/links.csv/1/part-000000500.csv', writer.flush())
+    writer.write({'platform_id': '3', 'result': 'exists'})
+    writer.close()
+    self.assertEqual(
+        ['results/links.csv/1/part-000000500.csv',
+         'results/links.csv/1/part-000000502.csv'],
+        writer.parts)
+    self.assertEqual('text/csv', self.bucket.content_types[writer.parts[0]])
+    self.assertEqual(
+        'platform_id,result\r\n1,created\r\n2,bad id\r\n',
+        self.bucket.text(writer.parts[0]))
+
+  def test_flush_names_part_after_given_offset_and_joins_columns(self):
+    writer = results_writer.ResultsWriter(self.bucket, 'retries/links.csv/1/')
+    writer.write({'ga4_property_id': '1', 'attempt': 2})
+    writer.write({'ga4_property_id': '2', 'ads_customer_id': '3'})
+    self.assertEqual(
+        'retries/links.csv/1/part-000000500.csv', writer.flush(500))
+    self.assertEqual(
+        'ga4_property_id,attempt,ads_customer_id\r\n1,2,\r\n2,,3\r\n',
+        self.bucket.text('retries/links.csv/1/part-000000500.csv'))
+
+  def test_flush_sets_custom_time(self):
+    due = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+    writer = results_writer.ResultsWriter(self.bucket, 'retries/links.csv/1/')
+    writer.write({'ga4_property_id': '1', 'attempt': 2})
+    name = writer.flush(custom_time=due)
+    self.assertEqual(due, self.bucket.custom_times[name])
+
+  def test_flush_without_records_writes_nothing(self):
+    writer = results_writer.ResultsWriter(self.bucket, 'results/')
+    self.assertIsNone(writer.flush())
+    self.assertEmpty(self.bucket.objects)
+
+  def test_part_rows_flushes_automatically(self):
+    with results_writer.ResultsWriter(
+        self.bucket, 'results/', 'ndjson', part_rows=2) as writer:
+      for index in range(5):
+        writer.write({'index': index})
+      self.assertLen(writer.parts, 2)
+    self.assertLen(writer.parts, 3)
+    self.assertEqual(
+        [{'index': 2}, {'index': 3}],
+        [json.loads(line) for line in self.bucket.text(
+            'results/part-000000002.ndjson').splitlines()])
+
+  def test_read_part_reads_records_back(self):
+    expected = {
+        'csv': [{'id': '1', 'name': 'One'}, {'id': '2', 'name': ''}],
+        'ndjson': [{'id': '1', 'name': 'One'}, {'id': '2'}],
+    }
+    for file_format, records in expected.items():
+      writer = results_writer.ResultsWriter(
+          self.bucket, f'{file_format}/', file_format)
+      writer.write({'id': '1', 'name': 'One'})
+      writer.write({'id': '2'})
+      part = writer.flush()
+      self.assertEqual(
+          records, list(results_writer.read_part(self.bucket, part)))
+
+  def test_unknown_format_raises_error(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown results format xml'):
+      results_writer.ResultsWriter(self.bucket, 'results/', 'xml')
+
+  @absltest.skipUnless(
+      importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+  def test_flush_writes_parquet(self):
+    import pyarrow.parquet  # pylint: disable=g-import-not-at-top
+    writer = results_writer.ResultsWriter(self.bucket, 'results/', 'parquet')
+    writer.write({'platform_id': 1, 'result': 'created'})
+    writer.write({'platform_id': '2', 'result': None})
+    writer.flush()
+    data = self.bucket.objects['results/part-000000000.parquet']
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+    self.assertEqual(
+        [{'platform_id': '1', 'result': 'created'},
+         {'platform_id': '2', 'result': None}],
+        table.to_pylist())
+
+
+class ExportWriterTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.bucket = testing.FakeBucket()
+
+  def test_writes_ndjson_and_closes_file(self):
+    file = self.bucket.blob('export').open('wb')
+    with results_writer.ExportWriter(file) as writer:
+      writer.write({'property_id': '1', 'name': 'properties/1/links/1'})
+      writer.write({'property_id': '2', 'settings': {'enabled': True}})
+    self.assertTrue(file.closed)
+    self.assertEqual(2, writer.count)
+    self.assertEqual(
+        [{'property_id': '1', 'name': 'properties/1/links/1'},
+         {'property_id': '2', 'settings': '{"enabled": true}'}],
+        [json.loads(line)
+         for line in self.bucket.text('export').splitlines()])
+
+  def test_writes_csv_with_columns_of_first_record(self):
+    file = self.bucket.blob('export').open('wb')
+    with results_writer.ExportWriter(file, 'csv') as writer:
+      writer.write({'property_id': '1', 'name': 'a'})
+      writer.write({'property_id': '2', 'name': 'b', 'extra': 'ignored'})
+    self.assertEqual(
+        b'property_id,name\r\n1,a\r\n2,b\r\n', self.bucket.objects['export'])
+
+  def test_unknown_format_raises_error(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown export format xml'):
+      results_writer.ExportWriter(io.BytesIO(), 'xml')
+
+  @absltest.skipUnless(
+      importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+  def test_writes_parquet_row_groups(self):
+    import pyarrow.parquet  # pylint: disable=g-import-not-at-top
+    file = self.bucket.blob('export').open('wb')
+    with results_writer.ExportWriter(
+        file, 'parquet', row_group_rows=2) as writer:
+      for index in range(5):
+        writer.write({'index': index})
+    parquet_file = pyarrow.parquet.ParquetFile(
+        io.BytesIO(self.bucket.objects['export']))
+    self.assertEqual(3, parquet_file.num_row_groups)
+    self.assertEqual(
+        [{'index': str(index)} for index in range(5)],
+        parquet_file.read().to_pylist())
+
+
+if __name__ == '__main__':
+  absltest.main()
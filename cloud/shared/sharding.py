@@ -0,0 +1,79 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Splits large CSV files into byte ranges that can be read independently.
+
+Only a small window around each split point is downloaded to move it to the
+start of the next line, so splitting costs a few requests whatever the size
+of the file. Values with line breaks inside quotes are not supported, since a
+split point could fall inside them.
+"""
+
+from typing import Any
+
+# The number of bytes downloaded at a time while looking for a line break.
+WINDOW = 64 * 1024
+
+
+def shard_count(size: int, max_shards: int, min_shard_bytes: int) -> int:
+  """Returns the number of shards to split a file of the given size into.
+
+  Args:
+      size: The size of the file in bytes.
+      max_shards: The largest number of shards.
+      min_shard_bytes: The smallest size of a shard, so that small files are
+        not split.
+  """
+  return max(1, min(max_shards, size // max(min_shard_bytes, 1)))
+
+
+def line_ranges(
+    blob: Any, size: int, count: int) -> tuple[str, list[tuple[int, int]]]:
+  """Splits a CSV file into byte ranges that start at a line.
+
+  Args:
+      blob: The Cloud Storage blob of the file.
+      size: The size of the file in bytes.
+      count: The number of ranges to split the rows into. Fewer ranges are
+        returned if the file has fewer lines.
+
+  Returns:
+      The header line of the file, including its line break, and the start
+      and end offset of each range of rows.
+  """
+  header_end = _next_line(blob, 0, size)
+  header = blob.download_as_bytes(start=0, end=header_end - 1).decode('utf-8')
+  starts = [header_end]
+  for index in range(1, count):
+    point = header_end + (size - header_end) * index // count
+    # Searching from the byte before the split point keeps a split point
+    # that is already at the start of a line.
+    start = _next_line(blob, point - 1, size)
+    if starts[-1] < start < size:
+      starts.append(start)
+  return header, list(zip(starts, [*starts[1:], size]))
+
+
+def _next_line(blob: Any, position: int, size: int) -> int:
+  """Returns the offset after the first line break at or after a position."""
+  while position < size:
+    data = blob.download_as_bytes(
+        start=position, end=min(position + WINDOW, size) - 1)
+    index = data.find(b'\n')
+    if index >= 0:
+      return position + index + 1
+    if not data:
+      break
+    position += len(data)
+  return size
@@ -0,0 +1,68 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for splitting files into shards."""
+
+from unittest import mock
+
+from absl.testing import absltest
+
+from shared import sharding
+from shared import testing
+
+CONTENTS = b'property_id,customer_id\n' + b''.join(
+    b'%d,%d\n' % (index, 1000 + index) for index in range(100))
+
+
+def csv_blob(contents):
+  blob = testing.FakeBucket().blob('links.csv')
+  blob.upload_from_string(contents)
+  return blob
+
+
+class ShardingTest(absltest.TestCase):
+
+  def test_shard_count_keeps_shards_above_min_size(self):
+    self.assertEqual(1, sharding.shard_count(5000, 8, 10000))
+    self.assertEqual(3, sharding.shard_count(30000, 8, 10000))
+    self.assertEqual(8, sharding.shard_count(10 ** 9, 8, 10000))
+
+  def test_line_ranges_start_at_lines_and_cover_every_row(self):
+    blob = csv_blob(CONTENTS)
+    header, ranges = sharding.line_ranges(blob, len(CONTENTS), 4)
+    self.assertEqual('property_id,customer_id\n', header)
+    self.assertLen(ranges, 4)
+    self.assertEqual(len(header), ranges[0][0])
+    self.assertEqual(len(CONTENTS), ranges[-1][1])
+    rows = []
+    for start, end in ranges:
+      self.assertEqual(b'\n', CONTENTS[start - 1:start])
+      rows.append(CONTENTS[start:end])
+    self.assertEqual(CONTENTS[len(header):], b''.join(rows))
+
+  def test_line_ranges_returns_fewer_ranges_for_few_lines(self):
+    contents = b'property_id\n1\n'
+    _, ranges = sharding.line_ranges(csv_blob(contents), len(contents), 8)
+    self.assertEqual([(12, 14)], ranges)
+
+  def test_line_ranges_downloads_windows_until_line_break(self):
+    contents = b'a\n' + b'x' * 10 + b'\n' + b'y' * 10 + b'\n'
+    blob = csv_blob(contents)
+    with mock.patch.object(sharding, 'WINDOW', 4):
+      _, ranges = sharding.line_ranges(blob, len(contents), 2)
+    self.assertEqual([(2, 13), (13, 24)], ranges)
+
+
+if __name__ == '__main__':
+  absltest.main()
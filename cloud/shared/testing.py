@@ -0,0 +1,193 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory fakes of Cloud Storage and of the clock for tests.
+
+The storage fake keeps the contents of every object in memory, counts the
+calls made to it and supports the parts of the client the functions use:
+uploads, ranged downloads, streaming reads and writes, listing and deletes.
+The benchmarks use it too.
+"""
+
+import collections
+import datetime
+import io
+import threading
+from typing import Any
+
+from google.api_core import exceptions
+
+
+class FakeStorageClient:
+  """An in-memory fake of the Cloud Storage client."""
+
+  def __init__(self) -> None:
+    self.calls = collections.Counter()
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def bucket(self, name: str) -> 'FakeBucket':
+    with self._lock:
+      if name not in self._buckets:
+        self._buckets[name] = FakeBucket(self, name)
+      return self._buckets[name]
+
+  get_bucket = bucket
+
+
+class FakeBucket:
+  """A bucket of a FakeStorageClient."""
+
+  def __init__(
+      self, client: FakeStorageClient | None = None, name: str = 'bucket'
+  ) -> None:
+    """Initializes the bucket.
+
+    Args:
+        client: The client the bucket belongs to. A bucket without one has
+          a client of its own.
+        name: The name of the bucket.
+    """
+    self.client = client or FakeStorageClient()
+    self.name = name
+    # Object contents keyed by name. Local files added with add_file are
+    # stored as their path and read lazily.
+    self.objects = {}
+    # The content type, custom time and custom metadata objects were
+    # uploaded with, keyed by name.
+    self.content_types = {}
+    self.custom_times = {}
+    self.metadata = {}
+
+  def blob(self, name: str, generation: int | None = None) -> 'FakeBlob':
+    del generation  # Every object has a single generation.
+    return FakeBlob(self, name)
+
+  def add_file(self, name: str, path: str) -> None:
+    """Adds a local file as an object without reading it into memory."""
+    self.objects[name] = path
+
+  def list_blobs(self, prefix: str = '') -> list['FakeBlob']:
+    self.client.calls['list_blobs'] += 1
+    return [
+        FakeBlob(self, name) for name in sorted(self.objects)
+        if name.startswith(prefix)]
+
+  def text(self, name: str) -> str:
+    """Returns the contents of an object as text."""
+    return self.blob(name).download_as_text()
+
+
+class FakeBlob:
+  """An object in a FakeBucket."""
+
+  def __init__(self, bucket: FakeBucket, name: str) -> None:
+    self.bucket = bucket
+    self.name = name
+    self.custom_time: datetime.datetime | None = None
+    self.metadata: dict[str, str] | None = None
+
+  def exists(self) -> bool:
+    return self.name in self.bucket.objects
+
+  def upload_from_string(
+      self, data: str | bytes, content_type: str | None = None) -> None:
+    self.bucket.client.calls['upload'] += 1
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    self._save(data, content_type)
+
+  def download_as_bytes(
+      self, start: int | None = None, end: int | None = None) -> bytes:
+    """Downloads the object, or the bytes from start to end inclusive."""
+    self.bucket.client.calls['download'] += 1
+    contents = self.bucket.objects.get(self.name)
+    if contents is None:
+      raise exceptions.NotFound(f'{self.name} not found.')
+    start = start or 0
+    length = None if end is None else end + 1 - start
+    if isinstance(contents, str):
+      with open(contents, 'rb') as file:
+        file.seek(start)
+        return file.read() if length is None else file.read(length)
+    return contents[start:None if end is None else end + 1]
+
+  def download_as_text(self) -> str:
+    return self.download_as_bytes().decode('utf-8')
+
+  def delete(self) -> None:
+    self.bucket.client.calls['delete'] += 1
+    if self.bucket.objects.pop(self.name, None) is None:
+      raise exceptions.NotFound(f'{self.name} not found.')
+
+  def open(self, mode: str = 'r', **kwargs: Any) -> Any:
+    """Opens the object for streaming reads or writes."""
+    if 'w' in mode:
+      self.bucket.client.calls['upload'] += 1
+      return _FakeWriter(
+          self, binary='b' in mode, content_type=kwargs.get('content_type'))
+    self.bucket.client.calls['download'] += 1
+    contents = self.bucket.objects.get(self.name)
+    if contents is None:
+      raise exceptions.NotFound(f'{self.name} not found.')
+    if isinstance(contents, str):
+      return open(contents, mode)
+    stream = io.BytesIO(contents)
+    return stream if 'b' in mode else io.TextIOWrapper(stream)
+
+  def _save(self, data: bytes, content_type: str | None) -> None:
+    self.bucket.objects[self.name] = data
+    self.bucket.content_types[self.name] = content_type
+    self.bucket.custom_times[self.name] = self.custom_time
+    self.bucket.metadata[self.name] = self.metadata
+
+
+class _FakeWriter(io.BytesIO):
+  """Saves the written bytes to the blob when closed."""
+
+  def __init__(
+      self, blob: FakeBlob, binary: bool, content_type: str | None) -> None:
+    super().__init__()
+    self._blob = blob
+    self._binary = binary
+    self._content_type = content_type
+
+  def write(self, data: str | bytes) -> int:
+    if not self._binary:
+      data = data.encode('utf-8')
+    return super().write(data)
+
+  def close(self) -> None:
+    if not self.closed:
+      # pylint: disable-next=protected-access
+      self._blob._save(self.getvalue(), self._content_type)
+    super().close()
+
+
+class FakeClock:
+  """A clock that only moves when it sleeps or is set."""
+
+  def __init__(self, now: float = 0.0) -> None:
+    self.now = now
+    self.sleeps = []
+
+  def __call__(self) -> float:
+    return self.now
+
+  def time(self) -> float:
+    return self.now
+
+  def sleep(self, seconds: float) -> None:
+    self.sleeps.append(seconds)
+    self.now += seconds
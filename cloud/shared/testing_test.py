@@ -0,0 +1,68 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the test fakes."""
+
+import datetime
+
+from absl.testing import absltest
+from google.api_core import exceptions
+
+from shared import testing
+
+
+class FakeStorageClientTest(absltest.TestCase):
+
+  def test_upload_and_download(self):
+    client = testing.FakeStorageClient()
+    client.bucket('b').blob('a.txt').upload_from_string('hello')
+    self.assertEqual('hello', client.get_bucket('b').blob('a.txt')
+                     .download_as_text())
+    with client.bucket('b').blob('a.txt').open('rb') as file:
+      self.assertEqual(b'hello', file.read())
+    with self.assertRaises(exceptions.NotFound):
+      client.bucket('b').blob('missing').download_as_text()
+
+  def test_open_for_writing(self):
+    client = testing.FakeStorageClient()
+    with client.bucket('b').blob('a.txt').open('w') as file:
+      file.write('hello')
+    self.assertEqual('hello', client.bucket('b').blob('a.txt')
+                     .download_as_text())
+
+  def test_keeps_object_attributes(self):
+    bucket = testing.FakeBucket()
+    blob = bucket.blob('a.json')
+    blob.custom_time = datetime.datetime(2024, 5, 1)
+    blob.metadata = {'key': 'value'}
+    blob.upload_from_string('{}', content_type='application/json')
+    self.assertEqual('application/json', bucket.content_types['a.json'])
+    self.assertEqual(blob.custom_time, bucket.custom_times['a.json'])
+    self.assertEqual({'key': 'value'}, bucket.metadata['a.json'])
+    blob.delete()
+    self.assertFalse(blob.exists())
+
+
+class FakeClockTest(absltest.TestCase):
+
+  def test_only_moves_when_it_sleeps(self):
+    clock = testing.FakeClock(10.0)
+    clock.sleep(5)
+    self.assertEqual(15.0, clock())
+    self.assertEqual(15.0, clock.time())
+    self.assertEqual([5], clock.sleeps)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,341 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Validates and normalizes the rows of input CSV files.
+
+Each chunk of an input file is checked with column operations on the whole
+data frame rather than row by row, so a file can be checked in full before the
+first request is sent. A row is rejected with the first problem found:
+  - a required column is missing or blank,
+  - the row has an unknown type,
+  - an ID is not a number once spaces and dashes are removed,
+  - a boolean is not one of true, false, yes, no, 1 or 0,
+  - an email address is malformed.
+
+IDs are read as strings and normalized, booleans are converted to bool and
+blank cells are left out of the rows. A row that is repeated by a later row in
+the same chunk, for the same link, is coalesced into the later row.
+
+Rows are checked CHUNK_SIZE at a time, or as many as the VALIDATION_CHUNK_SIZE
+environment variable sets, since each column operation has a fixed cost that
+small chunks would repeat.
+"""
+
+from collections.abc import Callable, Iterator, Mapping
+import dataclasses
+import itertools
+import os
+from typing import Any, BinaryIO, TextIO, TYPE_CHECKING
+
+from shared import csv_reader
+from shared import metrics
+
+if TYPE_CHECKING:
+  import pandas  # pylint: disable=g-import-not-at-top
+
+CHUNK_SIZE = 10000
+
+# The key of validated rows that holds the reason the row was rejected.
+REJECTED_KEY = 'rejected'
+# The statuses of rows that are not sent.
+REJECTED = 'rejected'
+DUPLICATE = 'duplicate'
+# The reason given for rows that are coalesced into a later row.
+DUPLICATE_REASON = 'repeated by a later row'
+
+# Link fields that hold numeric account IDs, which may be written with dashes
+# such as 123-456-7890.
+ID_FIELDS = ('property_id', 'customer_id', 'advertiser_id')
+BOOLEAN_FIELDS = (
+    'ads_personalization_enabled',
+    'campaign_data_sharing_enabled',
+    'cost_data_sharing_enabled',
+    'site_stats_sharing_enabled',
+    'daily_export_enabled',
+    'streaming_export_enabled',
+    'fresh_daily_export_enabled',
+    'include_advertising_id',
+)
+EMAIL_FIELDS = ('validation_email',)
+# Fields that identify the link an operation applies to.
+KEY_FIELDS = (
+    'action', 'property_id', 'name', 'customer_id', 'advertiser_id',
+    'project', 'ad_client_code')
+
+_BOOLEANS = {
+    'true': True, 'yes': True, '1': True,
+    'false': False, 'no': False, '0': False,
+}
+_ID_SEPARATORS = str.maketrans('', '', ' -')
+_EMAIL = r'[^@\s]+@[^@\s]+\.[^@\s]+'
+
+
+@dataclasses.dataclass(frozen=True)
+class Schema:
+  """The columns of one type of row.
+
+  Attributes:
+      required: Columns that must not be blank.
+      ids: Columns that hold numeric IDs.
+      booleans: Columns that hold booleans.
+      emails: Columns that hold email addresses.
+      key: Columns that together identify the link a row applies to. Rows
+        with the same values are coalesced into the last one.
+  """
+  required: tuple[str, ...] = ()
+  ids: tuple[str, ...] = ()
+  booleans: tuple[str, ...] = ()
+  emails: tuple[str, ...] = ()
+  key: tuple[str, ...] = ()
+
+
+# The rows of message publisher files, which are named after the link fields.
+MESSAGE_SCHEMA = Schema(
+    required=('action',),
+    ids=ID_FIELDS,
+    booleans=BOOLEAN_FIELDS,
+    emails=EMAIL_FIELDS,
+    key=KEY_FIELDS)
+
+
+def link_schema(
+    resource: Any,
+    columns: Mapping[str, str],
+    property_column: str,
+) -> Schema:
+  """Returns the schema of rows that create one type of link.
+
+  Args:
+      resource: The link type, a link_resources.LinkResource.
+      columns: The columns that link fields are read from, where they are
+        named differently from the field.
+      property_column: The column with the property ID.
+  """
+  fields = (resource.id_field, *resource.settings)
+  id_column = columns.get(resource.id_field, resource.id_field)
+  return Schema(
+      required=(property_column, id_column),
+      ids=(property_column, *(
+          columns.get(field, field) for field in fields
+          if field in ID_FIELDS)),
+      booleans=tuple(
+          columns.get(field, field) for field in fields
+          if field in BOOLEAN_FIELDS),
+      emails=tuple(
+          columns.get(field, field) for field in fields
+          if field in EMAIL_FIELDS),
+      key=(property_column, id_column))
+
+
+@dataclasses.dataclass
+class Report:
+  """The outcome of checking a file.
+
+  Attributes:
+      rows: The number of rows read.
+      rejected: The number of rejected rows, including malformed lines.
+      duplicates: The number of rows coalesced into a later row.
+      reasons: The number of rejected rows for each reason.
+  """
+  rows: int = 0
+  rejected: int = 0
+  duplicates: int = 0
+  reasons: dict[str, int] = dataclasses.field(default_factory=dict)
+
+  def add(self, reason: str, count: int = 1) -> None:
+    if reason == DUPLICATE_REASON:
+      self.duplicates += count
+    else:
+      self.rejected += count
+      self.reasons[reason] = self.reasons.get(reason, 0) + count
+
+
+def status(reason: str) -> str:
+  """Returns the status recorded for a row that was not sent."""
+  return DUPLICATE if reason == DUPLICATE_REASON else REJECTED
+
+
+def validate(
+    frame: 'pandas.DataFrame',
+    schemas: Mapping[str | None, Schema],
+    type_column: str | None = None,
+) -> tuple['pandas.DataFrame', 'pandas.Series']:
+  """Checks and normalizes a chunk of rows.
+
+  Args:
+      frame: The rows, as read by csv_reader.read_frames.
+      schemas: The schema of each type of row, keyed by the value of the type
+        column. If there is no type column, every row has the schema keyed
+        by None.
+      type_column: The column with the type of each row.
+
+  Returns:
+      The normalized rows, and the reason each row was rejected or an empty
+      string for the rows that passed.
+  """
+  import pandas  # pylint: disable=g-import-not-at-top
+  frame = frame.astype(object).apply(lambda column: column.str.strip())
+  reasons = pandas.Series('', index=frame.index, dtype=object)
+
+  def reject(rows, reason):
+    reasons[rows & (reasons == '')] = reason
+
+  if type_column is None:
+    types = pandas.Series(None, index=frame.index, dtype=object)
+  elif type_column in frame:
+    types = frame[type_column].str.lower()
+    frame[type_column] = types
+    reject(~types.isin(list(schemas)), f'unknown {type_column}')
+  else:
+    reject(reasons == '', f'missing column {type_column}')
+    return frame, reasons
+  for name, schema in schemas.items():
+    rows = types.isna() if name is None else types == name
+    if not rows.any():
+      continue
+    for column in schema.required:
+      if column not in frame:
+        reject(rows, f'missing column {column}')
+      else:
+        reject(rows & (frame[column] == ''), f'missing {column}')
+    for column in schema.ids:
+      if column in frame:
+        values = frame[column].str.translate(_ID_SEPARATORS)
+        frame.loc[rows, column] = values[rows]
+        reject(
+            rows & (values != '') & ~values.str.isdecimal(),
+            f'invalid {column}')
+    for column in schema.booleans:
+      if column in frame:
+        values = frame[column].str.lower().map(_BOOLEANS)
+        reject(
+            rows & (frame[column] != '') & values.isna(), f'invalid {column}')
+        parsed = rows & values.notna()
+        frame.loc[parsed, column] = values[parsed]
+    for column in schema.emails:
+      if column in frame:
+        reject(
+            rows & (frame[column] != '')
+            & ~frame[column].str.fullmatch(_EMAIL),
+            f'invalid {column}')
+    key = [column for column in schema.key if column in frame]
+    if key:
+      valid = rows & (reasons == '')
+      if type_column is not None:
+        key.append(type_column)
+      repeated = frame[valid].duplicated(subset=key, keep='last')
+      reject(
+          repeated.reindex(frame.index, fill_value=False), DUPLICATE_REASON)
+  return frame, reasons
+
+
+def validated_records(
+    file_name: str | BinaryIO,
+    schemas: Mapping[str | None, Schema],
+    type_column: str | None = None,
+    chunk_size: int | None = None,
+) -> Iterator[dict[str, Any]]:
+  """Lazily yields the normalized rows of a CSV file.
+
+  Rejected and coalesced rows are still yielded, with the reason under
+  REJECTED_KEY, so that the rows keep their position in the file.
+
+  Args:
+      file_name: A local path of the CSV file, or a file opened for reading.
+      schemas: The schema of each type of row, as for validate().
+      type_column: The column with the type of each row.
+      chunk_size: The number of rows checked at a time. Defaults to the
+        VALIDATION_CHUNK_SIZE environment variable or CHUNK_SIZE.
+
+  Yields:
+      A dictionary for each row without its blank cells.
+  """
+  for frame in csv_reader.read_frames(file_name, _chunk_size(chunk_size)):
+    frame, reasons = validate(frame, schemas, type_column)
+    for record, reason in zip(frame.to_dict('records'), reasons):
+      row = {key: value for key, value in record.items() if value != ''}
+      if reason:
+        row[REJECTED_KEY] = reason
+      yield row
+
+
+def check_file(
+    file_name: str | BinaryIO,
+    schemas: Mapping[str | None, Schema],
+    open_rejects: Callable[[], TextIO],
+    type_column: str | None = None,
+    chunk_size: int | None = None,
+) -> Report:
+  """Checks every row of a CSV file and writes the rows that are not sent.
+
+  Lines with more fields than the header are also rejected, unlike when the
+  rows are read with validated_records, which skips them.
+
+  Args:
+      file_name: A local path of the CSV file, or a file opened for reading.
+      schemas: The schema of each type of row, as for validate().
+      open_rejects: Opens the file the rejected and coalesced rows are
+        written to as CSV. It is only called if there are such rows.
+      type_column: The column with the type of each row.
+      chunk_size: The number of rows checked at a time. Must match the chunk
+        size the rows are read with later, so that the same rows are
+        coalesced. Defaults as for validated_records().
+
+  Returns:
+      The number of rows read, rejected and coalesced.
+  """
+  report = Report()
+  records = _rejected_records(file_name, schemas, type_column, chunk_size,
+                              report)
+  with metrics.span('validate'):
+    first = next(records, None)
+    if first is not None:
+      with open_rejects() as rejects:
+        csv_reader.write_records(itertools.chain([first], records), rejects)
+  return report
+
+
+def _rejected_records(
+    file_name: str | BinaryIO,
+    schemas: Mapping[str | None, Schema],
+    type_column: str | None,
+    chunk_size: int | None,
+    report: Report,
+) -> Iterator[dict[str, Any]]:
+  """Yields the rejected and coalesced rows of a file as they are found."""
+  bad_lines = []
+  for frame in csv_reader.read_frames(
+      file_name, _chunk_size(chunk_size), bad_lines.append):
+    _, reasons = validate(frame, schemas, type_column)
+    for fields in bad_lines:
+      reason = f'malformed line with {len(fields)} fields'
+      report.add(reason)
+      yield {
+          'row': '',
+          'reason': reason,
+          **dict(zip(frame.columns, fields))}
+    bad_lines.clear()
+    failed = reasons != ''
+    if failed.any():
+      for reason, count in reasons[failed].value_counts().items():
+        report.add(reason, count)
+      rejected = frame[failed].copy()
+      rejected.insert(0, 'reason', reasons[failed])
+      rejected.insert(0, 'row', failed.to_numpy().nonzero()[0] + report.rows)
+      yield from rejected.to_dict('records')
+    report.rows += len(frame)
+
+
+def _chunk_size(chunk_size: int | None) -> int:
+  return chunk_size or int(os.environ.get('VALIDATION_CHUNK_SIZE', CHUNK_SIZE))
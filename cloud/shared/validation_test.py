@@ -0,0 +1,153 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either expressed or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the validation of input CSV files."""
+
+import csv
+import io
+from unittest import mock
+
+from absl.testing import absltest
+
+from shared import link_resources
+from shared import validation
+
+ADS_SCHEMAS = {
+    'ads': validation.link_schema(
+        link_resources.get('ads'),
+        {'customer_id': 'ads_customer_id'},
+        'ga4_property_id'),
+}
+
+
+class KeptStringIO(io.StringIO):
+  """Keeps the written text after it has been closed."""
+
+  def close(self):
+    if not self.closed:
+      self.contents = self.getvalue()
+    super().close()
+
+
+def csv_file(text):
+  return io.BytesIO(text.encode('utf-8'))
+
+
+class ValidationTest(absltest.TestCase):
+
+  def test_link_schema_uses_columns_of_link_fields(self):
+    self.assertEqual(
+        validation.Schema(
+            required=('ga4_property_id', 'ads_customer_id'),
+            ids=('ga4_property_id', 'ads_customer_id'),
+            booleans=('ads_personalization_enabled',),
+            key=('ga4_property_id', 'ads_customer_id')),
+        ADS_SCHEMAS['ads'])
+
+  def test_message_schema_covers_boolean_settings(self):
+    for resource in link_resources.LINK_TYPES.values():
+      for field in resource.settings:
+        if field.endswith('_enabled') or field.startswith('include_'):
+          self.assertIn(field, validation.BOOLEAN_FIELDS)
+
+  def test_validated_records_normalizes_ids_and_booleans(self):
+    rows = list(validation.validated_records(csv_file(
+        'ga4_property_id,request_type,ads_customer_id,'
+        'ads_personalization_enabled\n'
+        '0123, ADS ,123-456-7890,Yes\n'
+        '2,ads,1112223333,\n'), ADS_SCHEMAS, 'request_type'))
+    self.assertEqual(
+        [{'ga4_property_id': '0123',
+          'request_type': 'ads',
+          'ads_customer_id': '1234567890',
+          'ads_personalization_enabled': True},
+         {'ga4_property_id': '2',
+          'request_type': 'ads',
+          'ads_customer_id': '1112223333'}],
+        rows)
+
+  def test_validated_records_rejects_invalid_rows(self):
+    rows = list(validation.validated_records(csv_file(
+        'ga4_property_id,request_type,ads_customer_id,'
+        'ads_personalization_enabled\n'
+        '1,ads,,true\n'
+        '1,ads,12a,true\n'
+        '1,ads,123,maybe\n'
+        '1,tiktok,123,true\n'), ADS_SCHEMAS, 'request_type'))
+    self.assertEqual(
+        ['missing ads_customer_id',
+         'invalid ads_customer_id',
+         'invalid ads_personalization_enabled',
+         'unknown request_type'],
+        [row[validation.REJECTED_KEY] for row in rows])
+
+  def test_validated_records_rejects_rows_without_required_column(self):
+    rows = list(validation.validated_records(
+        csv_file('ga4_property_id,request_type\n1,ads\n'),
+        ADS_SCHEMAS, 'request_type'))
+    self.assertEqual(
+        'missing column ads_customer_id', rows[0][validation.REJECTED_KEY])
+
+  def test_validated_records_coalesces_repeated_rows(self):
+    rows = list(validation.validated_records(csv_file(
+        'action,property_id,customer_id,ads_personalization_enabled\n'
+        'create,1,123,true\n'
+        'create,1,456,true\n'
+        'create,1,123,false\n'), {None: validation.MESSAGE_SCHEMA}))
+    self.assertEqual(
+        [validation.DUPLICATE_REASON, None, None],
+        [row.get(validation.REJECTED_KEY) for row in rows])
+    self.assertEqual(
+        validation.DUPLICATE,
+        validation.status(rows[0][validation.REJECTED_KEY]))
+
+  def test_check_file_writes_rejected_rows(self):
+    rejects = KeptStringIO()
+    report = validation.check_file(
+        csv_file(
+            'ga4_property_id,request_type,ads_customer_id\n'
+            '1,ads,123\n'
+            '1,ads,abc\n'
+            '2,ads,456,extra\n'
+            '1,ads,123\n'),
+        ADS_SCHEMAS,
+        lambda: rejects,
+        'request_type')
+    self.assertEqual(3, report.rows)
+    self.assertEqual(2, report.rejected)
+    self.assertEqual(1, report.duplicates)
+    self.assertEqual(
+        {'invalid ads_customer_id': 1, 'malformed line with 4 fields': 1},
+        report.reasons)
+    written = list(csv.DictReader(io.StringIO(rejects.contents)))
+    self.assertEqual(
+        [('', 'malformed line with 4 fields', '2'),
+         ('0', validation.DUPLICATE_REASON, '1'),
+         ('1', 'invalid ads_customer_id', '1')],
+        [(row['row'], row['reason'], row['ga4_property_id'])
+         for row in written])
+
+  def test_check_file_does_not_open_rejects_for_valid_file(self):
+    open_rejects = mock.Mock()
+    report = validation.check_file(
+        csv_file('ga4_property_id,request_type,ads_customer_id\n1,ads,123\n'),
+        ADS_SCHEMAS,
+        open_rejects,
+        'request_type')
+    self.assertEqual(validation.Report(rows=1), report)
+    open_rejects.assert_not_called()
+
+
+if __name__ == '__main__':
+  absltest.main()